@@ -0,0 +1,279 @@
+""" Time and memory benchmarks of the loaders and analyses on synthetic colonies.
+
+Run from the repository root:
+
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --quick --compare benchmarks/results/<commit>.json
+
+Results are saved as benchmarks/results/<commit>.json so runs from
+different commits (on the same machine) can be compared.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+BENCHMARKS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+REPO_FOLDER = os.path.dirname(BENCHMARKS_FOLDER)
+sys.path.append(os.path.join(REPO_FOLDER, "functions"))
+
+import comb_growth
+import comb_loading
+import contents_processing
+import mask_processing
+from frame_positions import FramePositionIndex
+from synthetic_colony import (COMB_CLASS, WOOD_CLASS, make_synthetic_colony,
+                              write_synthetic_tree)
+
+
+def measure(run, setup=None, repeat=5):
+    """ Wall time of run() and peak memory allocated while it runs.
+
+    Times are measured without tracemalloc (it slows allocation down),
+    then run is called once more with tracemalloc for the peak. Only
+    allocations Python knows about (like numpy arrays) are counted.
+
+    Args:
+        run: function with no arguments
+        setup: function called (untimed) before every call of run,
+            like clearing caches
+        repeat: number of timed calls
+
+    Return:
+        dict with min, median and max seconds and peak_bytes
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"min_seconds": min(times),
+            "median_seconds": float(np.median(times)),
+            "max_seconds": max(times),
+            "peak_bytes": peak_bytes
+           }
+
+def baseline_colonies_summary(colonies, comb_class, wood_class):
+    """ Wood and comb pixels of every frame counted like create_colonies_summary
+    did before it counted every class (two full comparisons per frame).
+    Benchmarked to show the speedup of create_colonies_summary."""
+    frame_summaries = []
+    for colony_dict in colonies:
+        for week_num, week in enumerate(colony_dict['colony']):
+            for frame_num, frame in enumerate(week):
+                frame_summaries.append({'colony': colony_dict['name'],
+                                        'week': week_num,
+                                        'frame': frame_num,
+                                        'type': colony_dict['type'],
+                                        'wood_pixels': np.sum(frame==wood_class),
+                                        'comb_pixels': np.sum(frame==comb_class)
+                                       })
+    return frame_summaries
+
+def get_benchmarks(folder_root, beeframe_meta, colony, num_weeks, label_type):
+    """ List of (name, run, setup) for every benchmark."""
+    colony_name = beeframe_meta['colony'].iloc[0]
+    dates = sorted(beeframe_meta['date'].unique())
+    frame_positions = FramePositionIndex(beeframe_meta).subset(colony_name=colony_name)
+    colony_folder = os.path.join(folder_root, colony_name)
+    class_names = contents_processing.get_content_types()
+    summary_colonies = [{"colony": colony, "name": colony_name, "type": "synthetic"}]
+
+    mask0 = colony[0, 0]
+    mask1 = colony[min(1, num_weeks-1), 0]
+    side_b = np.ascontiguousarray(mask1[:, ::-1])
+    contours = mask_processing.get_class_contours(mask0, COMB_CLASS)
+    contour = max(contours, key=len)
+    contour_ind = len(contour) // 2
+    # Point in the middle of the frame, away from the comb
+    point = np.array([mask0.shape[0] // 2, 3])
+    comb_field = mask_processing.ClassDistanceField(mask0, COMB_CLASS)
+    mask0_hash = mask_processing.get_mask_hash(mask0)
+    contents_colony = contents_processing.load_colony(colony_folder, label_type,
+                                                      [str(date) for date in dates],
+                                                      frame_positions, verbose=False)
+
+    return [
+        ("load_colony_comb",
+         lambda: comb_loading.load_colony_comb(beeframe_meta, colony_name, folder_root,
+                                               "masks", combine_ab=True, mirror_b=True),
+         None),
+        ("load_colony_comb_threads",
+         lambda: comb_loading.load_colony_comb(beeframe_meta, colony_name, folder_root,
+                                               "masks", combine_ab=True, mirror_b=True,
+                                               num_workers=8),
+         None),
+        ("load_colony",
+         lambda: contents_processing.load_colony(colony_folder, label_type,
+                                                 [str(date) for date in dates],
+                                                 frame_positions, verbose=False),
+         None),
+        ("_combine_ab_mask",
+         lambda: comb_loading._combine_ab_mask(mask0, side_b, mirror_b=True),
+         None),
+        ("get_class_contours",
+         lambda: mask_processing.get_class_contours(mask0, COMB_CLASS),
+         None),
+        ("extract_class_contours_cached",
+         lambda: mask_processing.extract_class_contours(mask0, [COMB_CLASS], 
+                                                        mask0_hash),
+         None),
+        ("get_distance_to_class",
+         lambda: mask_processing.get_distance_to_class(point, mask0, COMB_CLASS),
+         mask_processing.clear_distance_field_cache),
+        ("get_distance_to_class_cached",
+         lambda: mask_processing.get_distance_to_class(point, mask0, COMB_CLASS),
+         None),
+        ("get_distance_to_class_field",
+         lambda: mask_processing.get_distance_to_class(point, mask0, COMB_CLASS,
+                                                       field=comb_field),
+         None),
+        ("get_perpendicular_growth_at_point",
+         lambda: comb_growth.get_perpendicular_growth_at_point(mask0, mask1, contour,
+                                                               contour_ind, 5,
+                                                               COMB_CLASS, 0, 10),
+         comb_growth.clear_contour_geometry_cache),
+        ("create_colonies_summary",
+         lambda: comb_loading.create_colonies_summary(summary_colonies,
+                                                      COMB_CLASS, WOOD_CLASS),
+         None),
+        ("create_colonies_summary_baseline",
+         lambda: baseline_colonies_summary(summary_colonies, COMB_CLASS, WOOD_CLASS),
+         None),
+        ("create_class_count_df",
+         lambda: contents_processing.create_class_count_df(contents_colony, class_names),
+         None),
+    ]
+
+def get_commit():
+    """ Short hash of the checked out commit (with -dirty if there are changes)."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_FOLDER,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                cwd=REPO_FOLDER, capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    if status:
+        commit += "-dirty"
+    return commit
+
+def compare_results(old_results, new_results, threshold=0.1):
+    """ Print change in median time and peak memory of every benchmark.
+
+    Args:
+        old_results: results dict (like loaded from an earlier json)
+        new_results: results dict
+        threshold: relative change to flag as slower/faster
+    """
+    print(f"{'benchmark':<36}{'time':>10}{'memory':>10}")
+    for name, new in new_results['benchmarks'].items():
+        old = old_results['benchmarks'].get(name)
+        if old is None:
+            print(f"{name:<36}{'new':>10}")
+            continue
+        time_ratio = new['median_seconds'] / old['median_seconds']
+        memory_ratio = (new['peak_bytes'] / old['peak_bytes']
+                        if old['peak_bytes'] else np.nan)
+        flag = ""
+        if time_ratio > 1 + threshold:
+            flag = " slower"
+        elif time_ratio < 1 - threshold:
+            flag = " faster"
+        print(f"{name:<36}{time_ratio:>9.2f}x{memory_ratio:>9.2f}x{flag}")
+
+def run_benchmarks(shape=(3200, 4960), num_weeks=3, num_frames=10, repeat=5,
+                   seed=0, names=None, verbose=True):
+    """ Build a synthetic tree in a temporary folder and run the benchmarks.
+
+    Args:
+        shape: (height, width) of synthetic masks
+        num_weeks: number of weeks in the synthetic colony
+        num_frames: number of frames in the synthetic colony
+        repeat: timed calls of each benchmark
+        seed: random seed for the synthetic data
+        names: names of benchmarks to run, if None run all
+        verbose: if True print each result
+
+    Return:
+        results dict
+    """
+    label_type = "content_predictions"
+    results = {"commit": get_commit(),
+               "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "python": platform.python_version(),
+               "numpy": np.__version__,
+               "machine": platform.machine(),
+               "cpu_count": os.cpu_count(),
+               "params": {"shape": list(shape), "num_weeks": num_weeks,
+                          "num_frames": num_frames, "repeat": repeat, "seed": seed},
+               "benchmarks": {}
+              }
+    with tempfile.TemporaryDirectory() as folder_root:
+        beeframe_meta = write_synthetic_tree(folder_root, ["SYN1"], num_weeks,
+                                             num_frames, shape, seed=seed,
+                                             label_type=label_type)
+        colony = make_synthetic_colony(num_weeks, num_frames, shape, seed=seed)
+        benchmarks = get_benchmarks(folder_root, beeframe_meta, colony, num_weeks,
+                                    label_type)
+        for name, run, setup in benchmarks:
+            if names is not None and name not in names:
+                continue
+            result = measure(run, setup, repeat)
+            results['benchmarks'][name] = result
+            if verbose:
+                print(f"{name:<36}{result['median_seconds']:>10.4f} s"
+                      f"{result['peak_bytes'] / 1024**2:>10.1f} MiB")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true",
+                        help="use 800 x 1240 masks instead of 3200 x 4960")
+    parser.add_argument("--weeks", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", nargs="+", help="names of benchmarks to run")
+    parser.add_argument("--output-folder", default=os.path.join(BENCHMARKS_FOLDER, "results"))
+    parser.add_argument("--compare", help="earlier results json to compare with")
+    args = parser.parse_args()
+
+    shape = (800, 1240) if args.quick else (3200, 4960)
+    results = run_benchmarks(shape, args.weeks, repeat=args.repeat, seed=args.seed,
+                             names=args.only)
+
+    os.makedirs(args.output_folder, exist_ok=True)
+    suffix = "-quick" if args.quick else ""
+    results_file = os.path.join(args.output_folder, f"{results['commit']}{suffix}.json")
+    with open(results_file, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved {results_file}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+""" Deterministic synthetic colonies and fake nest_photos trees for benchmarks.
+
+Everything is generated from a seed so the same arguments always give
+the same arrays and files.
+"""
+
+import os
+
+import cv2
+import numpy as np
+import pandas as pd
+
+
+WOOD_CLASS = 1
+COMB_CLASS = 2
+# Content classes drawn on comb (values from contents_processing.get_content_types)
+CONTENT_CLASSES = (2, 3, 4, 5, 6, 7, 8)
+# Keypoints in the order of the real keypoint files, as fractions of
+# (width, height) of the 15% sized image
+KEYPOINT_FRACTIONS = np.array([[0.05, 0.08], [0.3, 0.08], [0.05, 0.95],
+                               [0.95, 0.95], [0.7, 0.08], [0.8, 0.08],
+                               [0.9, 0.08], [0.95, 0.08]])
+
+
+def _get_frame_blobs(rng, shape, num_blobs):
+    """ Center, axes, angle and growth per week of each comb blob in a frame."""
+    height, width = shape
+    centers = np.stack([rng.uniform(0.15, 0.85, num_blobs) * width,
+                        rng.uniform(0.2, 0.85, num_blobs) * height], axis=1)
+    axes = np.stack([rng.uniform(0.02, 0.12, num_blobs) * width,
+                     rng.uniform(0.02, 0.12, num_blobs) * height], axis=1)
+    angles = rng.uniform(0, 180, num_blobs)
+    growth = rng.uniform(0.1, 0.35, num_blobs)
+    holes = rng.uniform(0, 1, (num_blobs, 2))
+    return centers, axes, angles, growth, holes
+
+def make_synthetic_frame(shape, blobs, week):
+    """ Comb mask of one frame at week.
+
+    Wood border and top bar, with comb blobs that grow every week and
+    have a background hole near their middle.
+
+    Args:
+        shape: (height, width)
+        blobs: from _get_frame_blobs
+        week: week number (blobs are bigger every week)
+    """
+    height, width = shape
+    mask = np.zeros(shape, dtype=np.uint8)
+    border = max(1, height // 60)
+    mask[:4*border] = WOOD_CLASS
+    mask[-border:] = WOOD_CLASS
+    mask[:, :border] = WOOD_CLASS
+    mask[:, -border:] = WOOD_CLASS
+    for center, axes, angle, growth, hole in zip(*blobs):
+        blob_axes = axes * (1 + growth * week)
+        cv2.ellipse(mask, tuple(int(c) for c in center),
+                    tuple(int(a) for a in blob_axes), angle, 0, 360,
+                    COMB_CLASS, -1)
+        hole_center = center + (hole - 0.5) * blob_axes
+        cv2.circle(mask, tuple(int(c) for c in hole_center),
+                   max(1, int(blob_axes.min() / 5)), 0, -1)
+    # Keep wood on top of comb
+    mask[:4*border][mask[:4*border] == COMB_CLASS] = WOOD_CLASS
+    return mask
+
+def make_synthetic_colony(num_weeks, num_frames=10, shape=(3200, 4960), seed=0,
+                          num_blobs=4):
+    """ Comb colony array (weeks x frames x height x width) with growing comb.
+
+    Args:
+        num_weeks: number of weeks
+        num_frames: number of frames
+        shape: (height, width) of each frame
+        seed: random seed
+        num_blobs: comb blobs per frame
+
+    Return:
+        uint8 array with background 0, wood 1 and comb 2
+    """
+    rng = np.random.default_rng(seed)
+    colony = np.zeros((num_weeks, num_frames, *shape), dtype=np.uint8)
+    for frame in range(num_frames):
+        blobs = _get_frame_blobs(rng, shape, num_blobs)
+        for week in range(num_weeks):
+            colony[week, frame] = make_synthetic_frame(shape, blobs, week)
+    return colony
+
+def make_synthetic_contents(comb_mask, seed=0, block_size=64):
+    """ Contents mask for comb_mask with blocks of content classes on the comb.
+
+    Args:
+        comb_mask: 2D comb mask (like from make_synthetic_frame)
+        seed: random seed
+        block_size: size in pixels of blocks of the same content
+
+    Return:
+        uint8 array with wood, background and a content class for every
+        comb pixel
+    """
+    rng = np.random.default_rng(seed)
+    height, width = comb_mask.shape
+    blocks = rng.choice(CONTENT_CLASSES,
+                        size=(-(-height // block_size), -(-width // block_size)))
+    contents = np.repeat(np.repeat(blocks.astype(np.uint8), block_size, axis=0),
+                         block_size, axis=1)[:height, :width]
+    return np.where(comb_mask == COMB_CLASS, contents, comb_mask)
+
+def get_synthetic_keypoints(rng, shape):
+    """ Keypoints (8 x 2, for the 15% sized image) of a frame of size shape."""
+    height, width = shape
+    keypoints = KEYPOINT_FRACTIONS * np.array([width, height]) * 0.15
+    return keypoints + rng.normal(scale=2, size=keypoints.shape)
+
+def write_synthetic_tree(folder_root, colony_names, num_weeks, num_frames=10,
+                         shape=(3200, 4960), seed=0, masks_folder_name="masks",
+                         label_type="content_predictions",
+                         keypoints_folder_name="keypoints", first_date=20210412):
+    """ Write fake nest_photos tree like the one the loaders read.
+
+    For each colony and weekly date: a .png comb mask, .npy contents mask
+    and .csv keypoint file for both sides of every frame (side b is the
+    mirrored mask, as if photographed from the back).
+
+    Args:
+        folder_root: folder to write to (the 'nest_photos' folder)
+        colony_names: list of colony names
+        num_weeks: number of weekly dates per colony
+        num_frames: number of frames
+        shape: (height, width) of masks
+        seed: random seed
+        masks_folder_name: name of comb mask folders
+        label_type: name of contents folders
+        keypoints_folder_name: name of keypoint folders
+        first_date: date of first week as yyyymmdd int
+
+    Return:
+        beeframe_meta dataframe with columns like 'img_to_text_df_TOEDIT.csv'
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(pd.to_datetime(str(first_date)), periods=num_weeks, freq="7D")
+    dates = [int(date.strftime("%Y%m%d")) for date in dates]
+    rows = []
+    image_num = 0
+    for colony_ind, colony_name in enumerate(colony_names):
+        colony = make_synthetic_colony(num_weeks, num_frames, shape,
+                                       seed=seed + colony_ind)
+        for week, date in enumerate(dates):
+            date_folder = os.path.join(folder_root, colony_name, str(date))
+            folders = [os.path.join(date_folder, name)
+                       for name in (masks_folder_name, label_type, keypoints_folder_name)]
+            for folder in folders:
+                os.makedirs(folder, exist_ok=True)
+            masks_folder, contents_folder, keypoints_folder = folders
+            for frame in range(num_frames):
+                mask = colony[week, frame]
+                contents = make_synthetic_contents(mask, seed=seed + image_num)
+                for side in ["a", "b"]:
+                    filename = f"DSC_{image_num:04d}"
+                    image_num += 1
+                    side_mask = mask if side == "a" else mask[:, ::-1]
+                    side_contents = contents if side == "a" else contents[:, ::-1]
+                    cv2.imwrite(os.path.join(masks_folder, f"{filename}.png"), side_mask)
+                    np.save(os.path.join(contents_folder, f"{filename}.npy"),
+                            np.ascontiguousarray(side_contents))
+                    np.savetxt(os.path.join(keypoints_folder, f"{filename}.csv"),
+                               get_synthetic_keypoints(rng, shape), delimiter=",")
+                    rows.append({"colony": colony_name,
+                                 "date": date,
+                                 "beeframe": float(frame + 1),
+                                 "side": side,
+                                 "filename": f"{filename}.JPG"
+                                })
+    return pd.DataFrame(rows)
@@ -1,7 +1,30 @@
+import functools
+import hashlib
+import inspect
+import json
 import os
+from concurrent.futures import ProcessPoolExecutor
+
 import cv2
 import numpy as np
 import matplotlib.pyplot as plt
+import pandas as pd
+
+try:
+    from instrumentation import instrument, record_file_read
+except ImportError:
+    # functions folder isn't on the path, run without instrumentation
+    def instrument(function):
+        return function
+
+    def record_file_read(file):
+        pass
+
+
+# Reference assets already loaded, see _memoize_reference
+_reference_cache = {}
+# Change when get_warp_matrix settings change so old cached transforms aren't used
+TRANSFORM_CACHE_VERSION = 1
 
 
 def keypoints_match_image(keypoints_file, image_file):
@@ -33,6 +56,7 @@ def show_keypoints_on_image(image, keypoints, figsize=(5,5)):
     plt.imshow(image)
     plt.scatter(keypoints[:, 0], keypoints[:, 1])
     
+@instrument
 def get_warp_matrix(keypoints, reference_keypoints, 
                     return_inliers=False, verbose=True):
     """ Get the matrix needed to warp keypoints onto the reference keypoints.
@@ -66,6 +90,32 @@ def get_frames_not_to_warp():
            ]
 
 
+def _memoize_reference(load_function):
+    """ Only load reference assets once per folder and arguments.
+    Returns copies so callers can't change the cached arrays. Missing 
+    assets (None) aren't cached so they are loaded once they exist."""
+    signature = inspect.signature(load_function)
+    
+    @functools.wraps(load_function)
+    def load_reference(*args, **kwargs):
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        arguments = dict(arguments.arguments)
+        arguments['nest_photos_folder'] = os.path.abspath(arguments['nest_photos_folder'])
+        key = (load_function.__name__, *sorted(arguments.items()))
+        if key not in _reference_cache:
+            reference = load_function(*args, **kwargs)
+            if reference is None:
+                return None
+            _reference_cache[key] = reference
+        return np.copy(_reference_cache[key])
+    return load_reference
+
+def clear_reference_cache():
+    """ Forget loaded reference assets (if the reference files changed)."""
+    _reference_cache.clear()
+
+@_memoize_reference
 def load_reference_mask(nest_photos_folder, resize=False):
     """ Load mask that all other frames are aligned to.
     
@@ -93,6 +143,7 @@ def load_reference_mask(nest_photos_folder, resize=False):
     return reference_mask
         
     
+@_memoize_reference
 def load_reference_image(nest_photos_folder, resize=False):
     """ Load image that all other frames are aligned to.
     
@@ -116,6 +167,7 @@ def load_reference_image(nest_photos_folder, resize=False):
                            )
     return image
    
+@instrument
 def load_keypoints(keypoints_file, resize=False, 
                    return_upper=False
                   ):   
@@ -129,6 +181,7 @@ def load_keypoints(keypoints_file, resize=False,
         keypoint array
     """
     keypoints = np.genfromtxt(keypoints_file, delimiter=',')
+    record_file_read(keypoints_file)
     if resize:
         keypoints /= .15
         
@@ -136,6 +189,7 @@ def load_keypoints(keypoints_file, resize=False,
         keypoints = get_upper_keypoints(keypoints)
     return keypoints
     
+@_memoize_reference
 def load_reference_keypoints(nest_photos_folder, resize=False, 
                              return_upper=False
                             ):
@@ -178,5 +232,780 @@ def mirror_keypoints_horizontal(keypoints, image_width):
     keypoints = np.concatenate([keypoints[3:], keypoints[:3]])
     
     return keypoints
+
+def get_keypoint_table_columns():
+    return ["colony", "date", "frame", "side", "filename", "keypoint", "x", "y"]
+
+@instrument
+def build_keypoint_table(beeframe_meta, nest_photos_folder, colony_names=None):
+    """ Read the keypoints of every frame side into one table.
+    
+    Args:
+        beeframe_meta: dataframe with columns like 'img_to_text_df_TOEDIT.csv'
+        nest_photos_folder: full path to the nest_photos folder
+        colony_names: if given only these colonies
+        
+    Returns:
+        dataframe with get_keypoint_table_columns() columns, one row per 
+        keypoint. filename has no extension. Coordinates are at mask size
+        like load_keypoints. Frame sides without a keypoints file are left out.
+    """
+    sides_meta = beeframe_meta.loc[(beeframe_meta['side']=='a')
+                                   |(beeframe_meta['side']=='b')
+                                  ]
+    if colony_names is not None:
+        sides_meta = sides_meta.loc[sides_meta['colony'].isin(colony_names)]
+    
+    tables = []
+    columns = ['colony', 'date', 'beeframe', 'side', 'filename']
+    sides_meta = sides_meta.drop_duplicates(columns)
+    for colony_name, date, frame_num, side, filename in sides_meta[columns].itertuples(index=False):
+        frame_name = os.path.splitext(filename)[0]
+        keypoints_file = os.path.join(nest_photos_folder, colony_name, str(date),
+                                      "keypoints", f"{frame_name}.csv")
+        if not os.path.exists(keypoints_file):
+            continue
+        keypoints = load_keypoints(keypoints_file)
+        tables.append(pd.DataFrame({"colony": colony_name,
+                                    "date": date,
+                                    "frame": int(frame_num),
+                                    "side": side,
+                                    "filename": frame_name,
+                                    "keypoint": np.arange(len(keypoints)),
+                                    "x": keypoints[:, 0],
+                                    "y": keypoints[:, 1]
+                                   }))
+    if len(tables) == 0:
+        return pd.DataFrame(columns=get_keypoint_table_columns())
+    return pd.concat(tables, ignore_index=True)
+
+def save_keypoint_table(keypoint_table, keypoint_table_file):
+    keypoint_table.to_csv(keypoint_table_file, index=False)
+
+def load_keypoint_table(keypoint_table_file):
+    """ Load table saved with save_keypoint_table."""
+    return pd.read_csv(keypoint_table_file, float_precision="round_trip")
+
+def get_keypoint_arrays(keypoint_table):
+    """ Keypoints of every frame side as one array.
+    
+    Args:
+        keypoint_table: see build_keypoint_table, every frame side
+            must have the same number of keypoints
+    
+    Returns:
+        dataframe with colony, date, frame, side and filename of each frame side,
+        n frame sides x keypoints x 2 array
+    """
+    id_columns = ["colony", "date", "frame", "side", "filename"]
+    keypoint_table = keypoint_table.sort_values(id_columns + ["keypoint"], 
+                                                kind="stable")
+    frame_sides = keypoint_table.drop_duplicates(id_columns)[id_columns]
+    frame_sides = frame_sides.reset_index(drop=True)
+    if len(frame_sides) == 0:
+        return frame_sides, np.zeros((0, 0, 2))
+    num_keypoints = len(keypoint_table) // len(frame_sides)
+    sizes = keypoint_table.groupby(id_columns, sort=False).size()
+    if np.any(sizes.to_numpy() != num_keypoints):
+        raise RuntimeError("Every frame side must have the same number of keypoints.")
+    keypoints = keypoint_table[["x", "y"]].to_numpy(dtype=float)
+    return frame_sides, keypoints.reshape(len(frame_sides), num_keypoints, 2)
+
+def get_upper_keypoints_batch(keypoints):
+    """ get_upper_keypoints for n x keypoints x 2 array."""
+    return np.concatenate([keypoints[:, 0:2], keypoints[:, -4:]], axis=1)
+
+def mirror_keypoints_horizontal_batch(keypoints, image_widths):
+    """ mirror_keypoints_horizontal for n x keypoints x 2 array.
+    
+    Args:
+        keypoints: n x keypoints x 2
+        image_widths: width of image each keypoint set comes from (or one width)
+    Return:
+        new n x keypoints x 2 array
+    """
+    image_widths = np.broadcast_to(image_widths, keypoints.shape[:1])
+    mirrored = np.array(keypoints, dtype=float)
+    mirrored[:, :, 0] = image_widths[:, None] - mirrored[:, :, 0]
+    return np.concatenate([mirrored[:, 3:], mirrored[:, :3]], axis=1)
+
+def resize_keypoints(keypoints):
+    """ Scale keypoints at mask size to raw image size (like load_keypoints(resize=True))."""
+    return keypoints / .15
+
+@instrument
+def get_warp_matrices(keypoints, reference_keypoints, verbose=False):
+    """ get_warp_matrix for every keypoint set in n x keypoints x 2 array.
+    
+    Args:
+        keypoints: n x keypoints x 2
+        reference_keypoints: keypoints x 2
+        verbose: see get_warp_matrix
+        
+    Returns:
+        n x 2 x 3 transforms (nan where none found), number of inliers of each
+    """
+    transforms = np.full((len(keypoints), 2, 3), np.nan)
+    num_inliers = np.zeros(len(keypoints), dtype=int)
+    for ind, frame_keypoints in enumerate(keypoints):
+        transform, inliers = get_warp_matrix(frame_keypoints, reference_keypoints,
+                                             return_inliers=True, verbose=verbose)
+        if transform is not None:
+            transforms[ind] = transform
+            num_inliers[ind] = np.sum(inliers)
+    return transforms, num_inliers
+
+def get_file_hash(file):
+    """ sha1 hex digest of file contents."""
+    file_hash = hashlib.sha1()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def get_array_hash(array):
+    """ sha1 hex digest of array shape, dtype and values."""
+    array = np.ascontiguousarray(array)
+    array_hash = hashlib.sha1()
+    array_hash.update(str((array.shape, array.dtype.str)).encode())
+    array_hash.update(array.tobytes())
+    return array_hash.hexdigest()
+
+def write_image_atomic(image_file, image):
+    """ Write image so readers never see a partially written file."""
+    os.makedirs(os.path.dirname(image_file), exist_ok=True)
+    extension = os.path.splitext(image_file)[1]
+    success, encoded = cv2.imencode(extension, image)
+    if not success:
+        raise RuntimeError(f"Couldn't encode image for {image_file}.")
+    temp_file = f"{image_file}.{os.getpid()}.tmp"
+    with open(temp_file, "wb") as f:
+        f.write(encoded.tobytes())
+    os.replace(temp_file, image_file)
+
+def get_b_side_transform(b_side_keypoints, mask_width, reference_keypoints,
+                         verbose=True):
+    """ Transform from mirrored b side onto the reference frame.
+    
+    Args:
+        b_side_keypoints: upper keypoints of b side (not mirrored)
+        mask_width: width of b side mask
+        reference_keypoints: upper reference keypoints
+        verbose: see get_warp_matrix
+        
+    Returns:
+        2x3 transform (None if not found), number of inliers
+    """
+    b_side_keypoints = mirror_keypoints_horizontal(np.array(b_side_keypoints), 
+                                                   mask_width
+                                                  )
+    transform, inliers = get_warp_matrix(b_side_keypoints, reference_keypoints,
+                                         return_inliers=True, verbose=verbose
+                                        )
+    if transform is None:
+        return None, 0
+    return transform, int(np.sum(inliers))
+
+def get_a_side_transform(a_side_keypoints, reference_keypoints, verbose=True):
+    """ Transform from a side onto the reference frame.
+    
+    Args:
+        a_side_keypoints: upper keypoints of a side
+        reference_keypoints: upper reference keypoints
+        verbose: see get_warp_matrix
+        
+    Returns:
+        2x3 transform (None if not found), number of inliers
+    """
+    transform, inliers = get_warp_matrix(a_side_keypoints, reference_keypoints,
+                                         return_inliers=True, verbose=verbose
+                                        )
+    if transform is None:
+        return None, 0
+    return transform, int(np.sum(inliers))
+
+def include_mirror_in_transform(transform, image_width):
+    """ Transform that does image[:, ::-1] and then transform, so 
+    cv2.warpAffine(image, M=result) == cv2.warpAffine(image[:, ::-1], M=transform).
+    
+    Args:
+        transform: 2x3 affine matrix
+        image_width: width of image before mirroring
+    """
+    mirror = np.array([[-1, 0, image_width - 1],
+                       [0, 1, 0],
+                       [0, 0, 1]], dtype=float)
+    return np.asarray(transform, dtype=float) @ mirror
+
+def warp_b_side_mask(b_mask, transform, reference_shape):
+    """ Mirror b side mask and warp it onto the reference frame with transform."""
+    return cv2.warpAffine(b_mask[:, ::-1], M=transform, 
+                          dsize=(reference_shape[1], reference_shape[0])
+                         )
+
+@instrument
+def align_b_side_mask(b_mask, b_side_keypoints, reference_keypoints, 
+                      reference_shape, verbose=True):
+    """ Mirror b side mask and warp it onto the reference frame.
+    
+    Args:
+        b_mask: 2D mask of b side as saved (not mirrored)
+        b_side_keypoints: upper keypoints of b side (not mirrored)
+        reference_keypoints: upper reference keypoints
+        reference_shape: (height, width) of reference mask
+        verbose: see get_warp_matrix
+        
+    Returns:
+        warped mask (None if no transform found), 2x3 transform, number of inliers
+    """
+    transform, inliers = get_b_side_transform(b_side_keypoints, b_mask.shape[1],
+                                              reference_keypoints, verbose)
+    if transform is None:
+        return None, None, 0
+    return warp_b_side_mask(b_mask, transform, reference_shape), transform, inliers
+
+def align_a_side_mask(a_mask, reference_shape):
+    """ Resize (already warped) a side mask to the reference mask size."""
+    return cv2.resize(a_mask, (reference_shape[1], reference_shape[0]),
+                      interpolation=cv2.INTER_LINEAR
+                     )
+
+def get_reference_hash(reference_keypoints, reference_shape):
+    """ Hash identifying the reference frame transforms are estimated for."""
+    return get_array_hash(np.concatenate([np.ravel(reference_keypoints), 
+                                          reference_shape]))
+
+def get_transform_key(keypoints_hash, reference_hash, mirror_width=None):
+    """ Transform cache key for keypoint file contents and reference.
+    
+    Args:
+        keypoints_hash: sha1 of keypoints file (see get_file_hash)
+        reference_hash: see get_reference_hash
+        mirror_width: mask width if keypoints are mirrored (b sides)
+    """
+    return f"{TRANSFORM_CACHE_VERSION}:{keypoints_hash}:{reference_hash}:{mirror_width}"
+
+class TransformCache:
+    """ Estimated warp transforms saved in a json file.
+    
+    Keys come from get_transform_key, so a transform is only reused when
+    the keypoint file contents, the reference and the mirroring are the same.
+    """
+    
+    def __init__(self, cache_file=None):
+        """
+        Args:
+            cache_file: path to json file, loaded if it exists. If None
+                the cache is only kept in memory.
+        """
+        self.cache_file = cache_file
+        self.transforms = {}
+        if cache_file is not None and os.path.exists(cache_file):
+            with open(cache_file) as f:
+                self.transforms = json.load(f)
+    
+    def __len__(self):
+        return len(self.transforms)
+    
+    def __contains__(self, key):
+        return key in self.transforms
+    
+    def get(self, key):
+        """ Return 2x3 transform array (None if none was found) and 
+        number of inliers, or None if key isn't cached."""
+        entry = self.transforms.get(key)
+        if entry is None:
+            return None
+        transform = entry['transform']
+        if transform is not None:
+            transform = np.array(transform)
+        return transform, entry['inliers']
+    
+    def add(self, key, transform, inliers):
+        if transform is not None:
+            transform = np.asarray(transform).tolist()
+        self.transforms[key] = {"transform": transform, "inliers": inliers}
+    
+    def update(self, transforms):
+        """ Add entries from another cache's transforms dict."""
+        self.transforms.update(transforms)
+    
+    def save(self):
+        """ Write cache file (atomically)."""
+        if self.cache_file is None:
+            return
+        cache_folder = os.path.dirname(os.path.abspath(self.cache_file))
+        os.makedirs(cache_folder, exist_ok=True)
+        temp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+        with open(temp_file, "w") as f:
+            json.dump(self.transforms, f)
+        os.replace(temp_file, self.cache_file)
+    
+    def _get_reference_hash(self, reference_keypoints, reference_hash, 
+                            reference_shape):
+        if reference_hash is not None:
+            return reference_hash
+        if reference_shape is None:
+            raise ValueError("reference_hash or reference_shape is needed so keys "
+                             "match the ones of align_ab_masks.")
+        return get_reference_hash(reference_keypoints, reference_shape)
+    
+    def get_a_side_transform(self, keypoints_file, reference_keypoints,
+                             reference_hash=None, verbose=True, reference_shape=None):
+        """ Cached get_a_side_transform for keypoints_file (see get_b_side_transform)."""
+        reference_hash = self._get_reference_hash(reference_keypoints, reference_hash,
+                                                  reference_shape)
+        key = get_transform_key(get_file_hash(keypoints_file), reference_hash)
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        keypoints = load_keypoints(keypoints_file, return_upper=True)
+        transform, inliers = get_a_side_transform(keypoints, reference_keypoints,
+                                                  verbose)
+        self.add(key, transform, inliers)
+        return transform, inliers
+    
+    def get_b_side_transform(self, keypoints_file, mask_width, reference_keypoints,
+                             reference_hash=None, verbose=True, reference_shape=None):
+        """ Cached get_b_side_transform for keypoints_file.
+        
+        Args:
+            keypoints_file: full path to keypoints file of b side
+            mask_width: width of b side mask
+            reference_keypoints: upper reference keypoints
+            reference_hash: see get_reference_hash, if None it is computed
+                from reference_keypoints and reference_shape
+            verbose: see get_warp_matrix
+            reference_shape: (height, width) of reference mask, only used
+                if reference_hash is None
+            
+        Returns:
+            2x3 transform (None if not found), number of inliers
+        """
+        reference_hash = self._get_reference_hash(reference_keypoints, reference_hash,
+                                                  reference_shape)
+        key = get_transform_key(get_file_hash(keypoints_file), reference_hash,
+                                mask_width)
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        keypoints = load_keypoints(keypoints_file, return_upper=True)
+        transform, inliers = get_b_side_transform(keypoints, mask_width, 
+                                                  reference_keypoints, verbose)
+        self.add(key, transform, inliers)
+        return transform, inliers
+
+@instrument
+def get_colony_transforms(beeframe_meta, nest_photos_folder, colony_name,
+                          masks_folder_name="masks", transform_cache=None, 
+                          verbose=True):
+    """ Transforms that align each frame side mask of a colony with the 
+    reference frame when used as comb_loading.load_colony_comb(transforms=...).
+    
+    b side transforms include the mirroring (use mirror_b=False) and give 
+    the same result as the b sides of align_ab_masks. a sides are not the 
+    same as in align_ab_masks: there the already warped a side mask 
+    (warped_{masks_folder_name}) is resized to the reference, but the 
+    loaders read every side from masks_folder_name, so here the a side 
+    mask is warped with its own upper keypoints instead. Use 
+    compare_a_side_alignment to check how closely the two agree. Frame 
+    sides without keypoints or without a transform found are left out.
+    
+    Args:
+        beeframe_meta: dataframe with columns like 'img_to_text_df_TOEDIT.csv'
+        nest_photos_folder: full path to the nest_photos folder
+        colony_name: name of colony
+        masks_folder_name: name of the folder with the masks that will be loaded
+        transform_cache: TransformCache (or path to its file) to reuse 
+            transforms from and save new ones to
+        verbose: see get_warp_matrix
+        
+    Returns:
+        dict with (date, frame_num, side) keys and 2x3 transforms as values
+        and reference mask (height, width) to use as aligned_shape
+    """
+    reference_mask = load_reference_mask(nest_photos_folder, resize=False)
+    reference_keypoints = load_reference_keypoints(nest_photos_folder, resize=False,
+                                                   return_upper=True
+                                                  )
+    reference_shape = reference_mask.shape[:2]
+    reference_hash = get_reference_hash(reference_keypoints, reference_shape)
+    if isinstance(transform_cache, str):
+        transform_cache = TransformCache(transform_cache)
+    if transform_cache is None:
+        transform_cache = TransformCache()
+    
+    sides_meta = beeframe_meta.loc[(beeframe_meta['colony']==colony_name)
+                                   & ((beeframe_meta['side']=='a')
+                                      |(beeframe_meta['side']=='b'))
+                                  ]
+    # Like the loaders, use the first file at each position
+    sides_meta = sides_meta.drop_duplicates(['date', 'beeframe', 'side'])
+    transforms = {}
+    for date, frame_num, side, filename in zip(sides_meta['date'], 
+                                               sides_meta['beeframe'],
+                                               sides_meta['side'], 
+                                               sides_meta['filename']):
+        date_folder = os.path.join(nest_photos_folder, colony_name, str(date))
+        frame_name = os.path.splitext(filename)[0]
+        keypoints_file = os.path.join(date_folder, "keypoints", f"{frame_name}.csv")
+        if not os.path.exists(keypoints_file):
+            continue
+        if side == 'b':
+            mask_file = os.path.join(date_folder, masks_folder_name, 
+                                     f"{frame_name}.png")
+            mask = cv2.imread(mask_file, cv2.IMREAD_GRAYSCALE)
+            if mask is None:
+                continue
+            transform, _ = transform_cache.get_b_side_transform(
+                keypoints_file, mask.shape[1], reference_keypoints, 
+                reference_hash, verbose
+            )
+            if transform is not None:
+                transform = include_mirror_in_transform(transform, mask.shape[1])
+        else:
+            transform, _ = transform_cache.get_a_side_transform(
+                keypoints_file, reference_keypoints, reference_hash, verbose
+            )
+        if transform is not None:
+            transforms[(date, int(frame_num), side)] = transform
+    transform_cache.save()
+    return transforms, reference_shape
+
+def get_alignment_manifest_file(aligned_folder):
+    return os.path.join(aligned_folder, "alignment_manifest.json")
+
+def load_alignment_manifest(aligned_folder):
+    """ Load manifest of already aligned masks in aligned_folder.
+    
+    Returns:
+        dict with aligned mask filenames as keys and dicts with keys
+        inputs (file: sha1), stats (file: [size, mtime_ns]), reference, 
+        transform and inliers as values
+    """
+    manifest_file = get_alignment_manifest_file(aligned_folder)
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+def save_alignment_manifest(aligned_folder, manifest):
+    os.makedirs(aligned_folder, exist_ok=True)
+    manifest_file = get_alignment_manifest_file(aligned_folder)
+    temp_file = f"{manifest_file}.{os.getpid()}.tmp"
+    with open(temp_file, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(temp_file, manifest_file)
+
+def get_input_hashes(date_folder, input_files, entry=None):
+    """ sha1 of each input file, only reading files that changed.
+    
+    Args:
+        date_folder: folder the manifest keys are relative to
+        input_files: full paths of input files
+        entry: manifest entry of the output (see load_alignment_manifest),
+            its hashes are reused for files with the same size and 
+            modification time
+        
+    Returns:
+        dict with relative path keys and sha1 values, dict with relative
+        path keys and [size, mtime_ns] values
+    """
+    hashes = {}
+    stats = {}
+    if entry is None:
+        entry = {}
+    for input_file in input_files:
+        name = os.path.relpath(input_file, date_folder)
+        stat = os.stat(input_file)
+        stats[name] = [stat.st_size, stat.st_mtime_ns]
+        if (entry.get('stats', {}).get(name) == stats[name] 
+                and name in entry.get('inputs', {})):
+            hashes[name] = entry['inputs'][name]
+        else:
+            hashes[name] = get_file_hash(input_file)
+    return hashes, stats
+
+def compare_a_side_alignment(beeframe_meta, nest_photos_folder, colony_name,
+                             transforms, reference_shape, 
+                             masks_folder_name="masks", max_frame_sides=None):
+    """ How closely the a sides aligned with get_colony_transforms agree with
+    the a sides of align_ab_masks (warped mask resized to the reference).
+    
+    Args:
+        beeframe_meta: dataframe with columns like 'img_to_text_df_TOEDIT.csv'
+        nest_photos_folder: full path to the nest_photos folder
+        colony_name: name of colony
+        transforms: transforms from get_colony_transforms
+        reference_shape: reference shape from get_colony_transforms
+        masks_folder_name: see get_colony_transforms
+        max_frame_sides: if given only compare this many a sides
+        
+    Returns:
+        dataframe with columns date, frame, agreement (fraction of pixels 
+        with the same value), for every a side with a transform and a 
+        warped mask
+    """
+    sides_meta = beeframe_meta.loc[(beeframe_meta['colony']==colony_name)
+                                   & (beeframe_meta['side']=='a')]
+    sides_meta = sides_meta.drop_duplicates(['date', 'beeframe', 'side'])
+    rows = []
+    for date, frame_num, filename in zip(sides_meta['date'], 
+                                         sides_meta['beeframe'],
+                                         sides_meta['filename']):
+        if max_frame_sides is not None and len(rows) >= max_frame_sides:
+            break
+        transform = transforms.get((date, int(frame_num), 'a'))
+        if transform is None:
+            continue
+        date_folder = os.path.join(nest_photos_folder, colony_name, str(date))
+        frame_name = os.path.splitext(filename)[0]
+        mask = cv2.imread(os.path.join(date_folder, masks_folder_name, 
+                                       f"{frame_name}.png"), cv2.IMREAD_GRAYSCALE)
+        warped_mask = cv2.imread(os.path.join(date_folder, 
+                                              f"warped_{masks_folder_name}",
+                                              f"{frame_name}.png"), 
+                                 cv2.IMREAD_GRAYSCALE)
+        if mask is None or warped_mask is None:
+            continue
+        # Same as comb_loading.load_colony_comb(transforms=transforms)
+        transformed = cv2.warpAffine(mask, M=np.asarray(transform, dtype=float),
+                                     dsize=(reference_shape[1], reference_shape[0]))
+        resized = align_a_side_mask(warped_mask, reference_shape)
+        rows.append({"date": date, "frame": int(frame_num), 
+                     "agreement": np.mean(transformed == resized)})
+    return pd.DataFrame(rows, columns=["date", "frame", "agreement"])
+
+def _get_side_input_files(date_folder, side, frame_name, masks_folder_name):
+    """ Files aligning a frame side reads (mask first, then keypoints for b sides)."""
+    if side == 'b':
+        return [os.path.join(date_folder, masks_folder_name, f"{frame_name}.png"),
+                os.path.join(date_folder, "keypoints", f"{frame_name}.csv")
+               ]
+    return [os.path.join(date_folder, f"warped_{masks_folder_name}",
+                         f"{frame_name}.png")]
+
+def _get_group_transforms(date_folder, frames, new_masks_folder_name, 
+                          reference_hash, transforms_by_prefix):
+    """ Cached transforms the b sides of one colony date can use.
+    
+    Args:
+        date_folder: see get_ab_alignment_groups
+        frames: see get_ab_alignment_groups
+        new_masks_folder_name: see align_ab_masks
+        reference_hash: see get_reference_hash
+        transforms_by_prefix: dict with get_transform_key keys without the
+            mirror width as keys and dicts of cache entries as values
+    
+    Returns:
+        dict of TransformCache entries
+    """
+    if not transforms_by_prefix:
+        return {}
+    manifest = load_alignment_manifest(os.path.join(date_folder, 
+                                                    new_masks_folder_name))
+    transforms = {}
+    for side, frame_name in frames:
+        if side != 'b':
+            continue
+        keypoints_file = os.path.join(date_folder, "keypoints", f"{frame_name}.csv")
+        if not os.path.exists(keypoints_file):
+            continue
+        hashes, _ = get_input_hashes(date_folder, [keypoints_file], 
+                                     manifest.get(f"{frame_name}.png"))
+        prefix = get_transform_key(hashes.popitem()[1], reference_hash).rsplit(":", 1)[0]
+        transforms.update(transforms_by_prefix.get(prefix, {}))
+    return transforms
+
+def get_ab_alignment_groups(beeframe_meta, nest_photos_folder, 
+                            masks_folder_name="masks", colony_names=None):
+    """ Group the frame sides that need aligning by colony and date.
+    
+    Like the align_b_side notebook, every b side row is aligned and for
+    a sides only the first file at each frame position is used.
+    
+    Args:
+        beeframe_meta: dataframe with columns like 'img_to_text_df_TOEDIT.csv'
+        nest_photos_folder: full path to the nest_photos folder
+        masks_folder_name: name of the folder with the masks to align
+        colony_names: if given only these colonies
+        
+    Returns:
+        list of (date_folder, [(side, frame_name), ...])
+    """
+    sides_meta = beeframe_meta.loc[(beeframe_meta['side']=='a')
+                                   |(beeframe_meta['side']=='b')
+                                  ]
+    if colony_names is not None:
+        sides_meta = sides_meta.loc[sides_meta['colony'].isin(colony_names)]
+    a_rows = sides_meta['side'] == 'a'
+    first_a = ~sides_meta.duplicated(['colony', 'date', 'beeframe', 'side'])
+    sides_meta = sides_meta.loc[~a_rows | first_a]
+    
+    groups = []
+    for (colony_name, date), date_meta in sides_meta.groupby(['colony', 'date'], 
+                                                             sort=True):
+        date_folder = os.path.join(nest_photos_folder, colony_name, str(date))
+        frames = [(side, os.path.splitext(filename)[0]) 
+                  for side, filename in zip(date_meta['side'], date_meta['filename'])]
+        groups.append((date_folder, frames))
+    return groups
+
+def _align_date_group(task):
+    """ Align all frame sides of one colony date. Return counts of what was done."""
+    (date_folder, frames, reference_keypoints, reference_shape, reference_hash, 
+     masks_folder_name, new_masks_folder_name, overwrite, verbose, 
+     cached_transforms) = task
+    aligned_folder = os.path.join(date_folder, new_masks_folder_name)
+    manifest = load_alignment_manifest(aligned_folder)
+    new_transforms = {}
+    counts = {"aligned": 0, "skipped": 0, "missing": 0, "failed": 0}
+    # If sizes or modification times of up to date inputs changed
+    stats_changed = False
+    
+    for side, frame_name in frames:
+        input_files = _get_side_input_files(date_folder, side, frame_name, 
+                                            masks_folder_name)
+        if not all(os.path.exists(input_file) for input_file in input_files):
+            counts["missing"] += 1
+            continue
+        output_name = f"{frame_name}.png"
+        output_file = os.path.join(aligned_folder, output_name)
+        entry = manifest.get(output_name)
+        inputs, stats = get_input_hashes(date_folder, input_files, entry)
+        up_to_date = (entry is not None and entry['inputs'] == inputs
+                      and entry['reference'] == reference_hash
+                      and os.path.exists(output_file))
+        if up_to_date and not overwrite:
+            if entry.get('stats') != stats:
+                # Save so unchanged files aren't hashed again next run
+                entry['stats'] = stats
+                stats_changed = True
+            counts["skipped"] += 1
+            continue
+        
+        mask = cv2.imread(input_files[0], cv2.IMREAD_GRAYSCALE)
+        if mask is None:
+            counts["missing"] += 1
+            continue
+        transform = None
+        inliers = None
+        if side == 'b':
+            keypoints_file = os.path.relpath(input_files[1], date_folder)
+            transform_key = get_transform_key(inputs[keypoints_file], 
+                                              reference_hash, mask.shape[1])
+            cached = cached_transforms.get(transform_key)
+            if cached is None:
+                keypoints = load_keypoints(input_files[1], return_upper=True)
+                transform, inliers = get_b_side_transform(keypoints, mask.shape[1],
+                                                          reference_keypoints, 
+                                                          verbose)
+                if transform is not None:
+                    transform = transform.tolist()
+                new_transforms[transform_key] = {"transform": transform, 
+                                                 "inliers": inliers}
+            else:
+                transform, inliers = cached['transform'], cached['inliers']
+            if transform is None:
+                if verbose:
+                    print(f"No transform found for {input_files[0]}.")
+                counts["failed"] += 1
+                continue
+            aligned_mask = warp_b_side_mask(mask, np.array(transform), 
+                                            reference_shape)
+        else:
+            aligned_mask = align_a_side_mask(mask, reference_shape)
+        write_image_atomic(output_file, aligned_mask)
+        manifest[output_name] = {"inputs": inputs,
+                                 "stats": stats,
+                                 "reference": reference_hash,
+                                 "transform": transform,
+                                 "inliers": inliers
+                                }
+        counts["aligned"] += 1
+        
+    if counts["aligned"] or stats_changed:
+        save_alignment_manifest(aligned_folder, manifest)
+    return counts, new_transforms
+
+@instrument
+def align_ab_masks(beeframe_meta, nest_photos_folder, masks_folder_name="masks",
+                   new_masks_folder_name="ab_aligned_masks", colony_names=None,
+                   num_workers=None, overwrite=False, verbose=True,
+                   transform_cache=None):
+    """ Align every a and b side mask to the reference frame (like the 
+    align_b_side notebook) and save in new_masks_folder_name.
+    
+    b side masks are mirrored and warped with their upper keypoints. a side 
+    masks are read from f"warped_{masks_folder_name}" and resized to the 
+    reference mask. Each colony date is done in a worker process. Outputs
+    are written atomically and recorded in a manifest in each output folder
+    with the input file hashes and transform, so masks whose inputs and 
+    reference haven't changed are skipped on later runs. Inputs are only
+    hashed again when their size or modification time changed.
+    
+    Args:
+        beeframe_meta: dataframe with columns like 'img_to_text_df_TOEDIT.csv'
+        nest_photos_folder: full path to the nest_photos folder
+        masks_folder_name: name of the folder with the masks to align
+        new_masks_folder_name: name of the folder to save aligned masks in
+        colony_names: if given only align these colonies
+        num_workers: number of processes to use. If None use os.cpu_count(),
+            if 1 don't start any extra processes.
+        overwrite: if True realign masks that are up to date
+        verbose: if True print progress and warnings
+        transform_cache: TransformCache (or path to its file) to reuse 
+            b side transforms from and save new ones to
+        
+    Returns:
+        dict with number of frame sides aligned, skipped (up to date), 
+        missing (no input files) and failed (no transform found)
+    """
+    reference_mask = load_reference_mask(nest_photos_folder, resize=False)
+    reference_keypoints = load_reference_keypoints(nest_photos_folder, resize=False,
+                                                   return_upper=True
+                                                  )
+    reference_shape = reference_mask.shape[:2]
+    reference_hash = get_reference_hash(reference_keypoints, reference_shape)
+    if isinstance(transform_cache, str):
+        transform_cache = TransformCache(transform_cache)
+    # Cached transforms by key without mirror width, so each task is only
+    # sent the transforms of its own b sides
+    transforms_by_prefix = {}
+    if transform_cache is not None:
+        for key, entry in transform_cache.transforms.items():
+            prefix = key.rsplit(":", 1)[0]
+            transforms_by_prefix.setdefault(prefix, {})[key] = entry
+    groups = get_ab_alignment_groups(beeframe_meta, nest_photos_folder, 
+                                     masks_folder_name, colony_names)
+    tasks = [(date_folder, frames, reference_keypoints, reference_shape, 
+              reference_hash, masks_folder_name, new_masks_folder_name, 
+              overwrite, verbose, 
+              _get_group_transforms(date_folder, frames, new_masks_folder_name, 
+                                    reference_hash, transforms_by_prefix)) 
+             for date_folder, frames in groups]
+    
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    executor = None
+    if num_workers == 1:
+        all_counts = map(_align_date_group, tasks)
+    else:
+        executor = ProcessPoolExecutor(max_workers=num_workers)
+        all_counts = executor.map(_align_date_group, tasks)
     
-    
\ No newline at end of file
+    total_counts = {"aligned": 0, "skipped": 0, "missing": 0, "failed": 0}
+    try:
+        for group_ind, (counts, new_transforms) in enumerate(all_counts):
+            for key, count in counts.items():
+                total_counts[key] += count
+            if transform_cache is not None:
+                transform_cache.update(new_transforms)
+            if verbose and (group_ind + 1) % 10 == 0:
+                print(f"{group_ind+1} of {len(tasks)} colony dates, {total_counts}")
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if transform_cache is not None:
+            transform_cache.save()
+    return total_counts
@@ -1,21 +1,41 @@
-import pandas as pd
+import hashlib
+import json
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import StringIO
-from boxsdk import Client, JWTAuth
 
+import pandas as pd
+try:
+    from boxsdk import Client, JWTAuth
+except ImportError:
+    # Only needed to connect to box, cached metadata can still be loaded
+    Client = None
+    JWTAuth = None
+
+
+# Authenticated clients by (config file, user_id), see get_box_client
+_box_clients = {}
+# Name of file in synced folders recording what has been downloaded
+SYNC_STATE_NAME = ".box_sync_state.json"
+
+
+def get_box_client(box_config_file, user_id):
+    """ Get box client authenticated as user_id.
+    Authenticates once, later calls with the same arguments reuse the client.
 
-def load_beeframe_meta_from_box(meta_name, box_config_file, user_id, folder_id):
-    """ Download file like 'img_to_text_df_TOEDIT.csv' from box and load as pandas df.
-    Uses the box sdk to download and load direct from server.
-    
     Args:
-        meta_name: name of csv file. i.e. 'img_to_text_df_TOEDIT.csv'
         box_config_file: full path to local config.json file for box sdk
         user_id: box user_id
-        folder_id: folder id for folder that contains the meta file
-        
+
     Returns:
-        meta_file loaded as pandas dataframe
+        boxsdk Client
     """
+    key = (os.path.abspath(box_config_file), user_id)
+    if key in _box_clients:
+        return _box_clients[key]
+    if JWTAuth is None:
+        raise ImportError("boxsdk is needed to connect to box.")
 
     sdk = JWTAuth.from_settings_file(box_config_file)
     client = Client(sdk)
@@ -24,9 +44,295 @@ def load_beeframe_meta_from_box(meta_name, box_config_file, user_id, folder_id):
     sdk = JWTAuth.from_settings_file(box_config_file, access_token=auth_user)
     client = Client(sdk)
 
-    items = client.folder(folder_id=folder_id).get_items()
-    for item in items:
-        if item.name == meta_name:
-            content = client.file(item.id).content()
-            beeframe_meta =  pd.read_csv(StringIO(content.decode("utf-8")))
-            return beeframe_meta
\ No newline at end of file
+    _box_clients[key] = client
+    return client
+
+def get_content_sha1(content):
+    """ sha1 of bytes in the form box reports for files."""
+    return hashlib.sha1(content).hexdigest()
+
+def get_meta_snapshot_file(cache_folder, meta_name, folder_id):
+    """ Snapshot file of meta_name in box folder folder_id, so files with
+    the same name in different folders don't share a snapshot."""
+    name = os.path.splitext(meta_name)[0]
+    return os.path.join(cache_folder, f"{name}_{folder_id}.pkl")
+
+def load_meta_snapshot(cache_folder, meta_name, folder_id):
+    """ Load cached snapshot of meta file in box folder folder_id.
+
+    Returns:
+        dict with keys file_id, sha1 and meta (dataframe) or None if not cached
+    """
+    snapshot_file = get_meta_snapshot_file(cache_folder, meta_name, folder_id)
+    if not os.path.exists(snapshot_file):
+        return None
+    with open(snapshot_file, "rb") as f:
+        return pickle.load(f)
+
+def save_meta_snapshot(cache_folder, meta_name, folder_id, snapshot):
+    os.makedirs(cache_folder, exist_ok=True)
+    snapshot_file = get_meta_snapshot_file(cache_folder, meta_name, folder_id)
+    temp_file = f"{snapshot_file}.{os.getpid()}.tmp"
+    with open(temp_file, "wb") as f:
+        pickle.dump(snapshot, f)
+    os.replace(temp_file, snapshot_file)
+
+def _get_box_file_sha1(client, file_id):
+    """ Current sha1 of box file, or None if there is no file with file_id
+    anymore (deleted, or replaced by a new upload with another id)."""
+    try:
+        return client.file(file_id).get(fields=['sha1']).sha1
+    except Exception as error:
+        # boxsdk raises BoxAPIException with status 404
+        if getattr(error, 'status', None) != 404:
+            raise
+        return None
+
+def _find_folder_item(client, folder_id, name):
+    for item in client.folder(folder_id=folder_id).get_items(fields=['name', 'sha1']):
+        if item.name == name:
+            return item
+    return None
+
+def load_beeframe_meta_from_box(meta_name, box_config_file, user_id, folder_id,
+                                cache_folder=None, client=None, offline=False):
+    """ Download file like 'img_to_text_df_TOEDIT.csv' from box and load as pandas df.
+    Uses the box sdk to download and load direct from server.
+
+    If cache_folder is given, the loaded dataframe is saved there with the
+    file's id and sha1 (one snapshot per folder_id and meta_name). Later 
+    calls only ask box for the current sha1 and download again if the file 
+    changed. If the file id isn't found anymore the folder is listed again.
+
+    Args:
+        meta_name: name of csv file. i.e. 'img_to_text_df_TOEDIT.csv'
+        box_config_file: full path to local config.json file for box sdk
+        user_id: box user_id
+        folder_id: folder id for folder that contains the meta file
+        cache_folder: folder to keep the loaded dataframe in
+        client: client to use instead of get_box_client. Anything with
+            folder(folder_id=...).get_items(fields=...) yielding items with
+            name, id and sha1, file(file_id).get(fields=...) returning an
+            item with sha1 (or raising an error with status 404) and 
+            file(file_id).content() returning bytes.
+        offline: if True, load from cache_folder without connecting to box
+
+    Returns:
+        meta_file loaded as pandas dataframe (None if not in folder)
+    """
+    snapshot = None
+    if cache_folder is not None:
+        snapshot = load_meta_snapshot(cache_folder, meta_name, folder_id)
+    if offline:
+        if snapshot is None:
+            raise FileNotFoundError(f"No cached {meta_name} in {cache_folder}.")
+        return snapshot['meta']
+
+    if client is None:
+        client = get_box_client(box_config_file, user_id)
+
+    file_id = None
+    remote_sha1 = None
+    if snapshot is not None:
+        remote_sha1 = _get_box_file_sha1(client, snapshot['file_id'])
+        if remote_sha1 is not None:
+            if remote_sha1 == snapshot['sha1']:
+                return snapshot['meta']
+            file_id = snapshot['file_id']
+    if file_id is None:
+        item = _find_folder_item(client, folder_id, meta_name)
+        if item is None:
+            return None
+        file_id = item.id
+        remote_sha1 = item.sha1
+
+    content = client.file(file_id).content()
+    beeframe_meta = pd.read_csv(StringIO(content.decode("utf-8")))
+    if cache_folder is not None:
+        content_sha1 = get_content_sha1(content)
+        if remote_sha1 is not None and content_sha1 != remote_sha1:
+            raise RuntimeError(f"Downloaded {meta_name} doesn't match box sha1.")
+        save_meta_snapshot(cache_folder, meta_name, folder_id, 
+                           {"file_id": file_id,
+                            "sha1": content_sha1,
+                            "meta": beeframe_meta
+                           })
+    return beeframe_meta
+
+def get_file_sha1(file):
+    """ sha1 of local file contents (same as box reports)."""
+    file_hash = hashlib.sha1()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def walk_box_folder(client, folder_id, include_folder=None, include_file=None,
+                    page_size=1000):
+    """ Find every file in box folder and its subfolders.
+
+    Args:
+        client: box client (see sync_box_folder)
+        folder_id: id of folder to walk
+        include_folder: function taking subfolder path (relative to folder,
+            like 'DD1/20210412/masks') and returning if it should be walked.
+            If None walk all subfolders.
+        include_file: function taking file path (relative to folder) and
+            returning if it should be included. If None include all files.
+        page_size: number of items to get per folder listing request
+
+    Yields:
+        (relative path, item) for every file
+    """
+    folders = [(folder_id, "")]
+    while folders:
+        current_id, current_path = folders.pop()
+        items = client.folder(folder_id=current_id).get_items(
+            limit=page_size, fields=['name', 'type', 'sha1', 'size']
+        )
+        for item in items:
+            item_path = os.path.join(current_path, item.name)
+            if item.type == 'folder':
+                if include_folder is None or include_folder(item_path):
+                    folders.append((item.id, item_path))
+            elif item.type == 'file':
+                if include_file is None or include_file(item_path):
+                    yield item_path, item
+
+def _load_sync_state(local_folder):
+    state_file = os.path.join(local_folder, SYNC_STATE_NAME)
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file) as f:
+        return json.load(f)
+
+def _save_sync_state(local_folder, state):
+    os.makedirs(local_folder, exist_ok=True)
+    state_file = os.path.join(local_folder, SYNC_STATE_NAME)
+    temp_file = f"{state_file}.{os.getpid()}.tmp"
+    with open(temp_file, "w") as f:
+        json.dump(state, f)
+    os.replace(temp_file, state_file)
+
+def _get_file_stat(file):
+    stat = os.stat(file)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def _is_synced(local_file, remote_sha1, state_entry):
+    """ Check if local_file has remote_sha1. Only rehash the file if it
+    changed since it was recorded in the sync state."""
+    if not os.path.exists(local_file):
+        return False
+    if (state_entry is not None and state_entry['sha1'] == remote_sha1
+            and state_entry['stat'] == _get_file_stat(local_file)):
+        return True
+    return get_file_sha1(local_file) == remote_sha1
+
+def _download_box_file(client, file_id, local_file, remote_sha1):
+    """ Download to .part file and move into place once complete and checked."""
+    os.makedirs(os.path.dirname(local_file), exist_ok=True)
+    part_file = f"{local_file}.part"
+    try:
+        with open(part_file, "wb") as f:
+            client.file(file_id).download_to(f)
+    except BaseException:
+        # Don't hide the original error if the .part file was never made
+        if os.path.exists(part_file):
+            os.remove(part_file)
+        raise
+    if remote_sha1 is not None and get_file_sha1(part_file) != remote_sha1:
+        os.remove(part_file)
+        raise RuntimeError(f"Downloaded {local_file} doesn't match box sha1.")
+    os.replace(part_file, local_file)
+
+def sync_box_folder(client, folder_id, local_folder, include_folder=None,
+                    include_file=None, num_workers=8, page_size=1000, verbose=True):
+    """ Mirror box folder tree to local_folder.
+
+    Files whose local copy already has the box sha1 are skipped, so an
+    interrupted sync can be run again and only fetches what is missing.
+    Files are downloaded to a .part file and only moved into place when
+    complete. What has been synced is recorded in local_folder so unchanged
+    files don't have to be rehashed.
+
+    Args:
+        client: box client (like get_box_client). Anything with
+            folder(folder_id=...).get_items(limit=..., fields=...) yielding
+            items with name, id, type ('file' or 'folder') and sha1, and
+            file(file_id).download_to(writeable_stream).
+        folder_id: id of box folder to mirror
+        local_folder: local folder to mirror it to
+        include_folder: see walk_box_folder
+        include_file: see walk_box_folder
+        num_workers: number of files to download at once
+        page_size: number of items to get per folder listing request
+        verbose: if True print progress
+
+    Returns:
+        dict with number of files downloaded, skipped (already synced) and failed
+    """
+    state = _load_sync_state(local_folder)
+    counts = {"downloaded": 0, "skipped": 0, "failed": 0}
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {}
+        for item_path, item in walk_box_folder(client, folder_id, include_folder,
+                                               include_file, page_size):
+            local_file = os.path.join(local_folder, item_path)
+            if _is_synced(local_file, item.sha1, state.get(item_path)):
+                state[item_path] = {"sha1": item.sha1,
+                                    "stat": _get_file_stat(local_file)}
+                counts["skipped"] += 1
+                continue
+            future = executor.submit(_download_box_file, client, item.id,
+                                     local_file, item.sha1)
+            futures[future] = (item_path, item.sha1)
+
+        try:
+            for future in as_completed(futures):
+                item_path, sha1 = futures[future]
+                try:
+                    future.result()
+                except Exception as error:
+                    counts["failed"] += 1
+                    if verbose:
+                        print(f"Failed to download {item_path}: {error}")
+                    continue
+                local_file = os.path.join(local_folder, item_path)
+                state[item_path] = {"sha1": sha1, "stat": _get_file_stat(local_file)}
+                counts["downloaded"] += 1
+                if counts["downloaded"] % 100 == 0:
+                    _save_sync_state(local_folder, state)
+                    if verbose:
+                        print(f"{counts['downloaded']} of {len(futures)} files downloaded.")
+        finally:
+            for future in futures:
+                future.cancel()
+            _save_sync_state(local_folder, state)
+    return counts
+
+def sync_box_masks(client, folder_id, local_folder, masks_folder_names=("masks",),
+                   num_workers=8, verbose=True):
+    """ Mirror colony/date/mask folders of box nest_photos folder to local_folder.
+
+    Args:
+        client: box client, see sync_box_folder
+        folder_id: id of box nest_photos folder
+        local_folder: local nest_photos folder
+        masks_folder_names: names of the folders in each date folder to sync
+        num_workers: number of files to download at once
+        verbose: if True print progress
+
+    Returns:
+        see sync_box_folder
+    """
+    def include_folder(folder_path):
+        parts = folder_path.split(os.sep)
+        return len(parts) < 3 or parts[2] in masks_folder_names
+
+    def include_file(file_path):
+        # Only files inside the mask folders, not files in colony or date folders
+        return len(file_path.split(os.sep)) == 4
+
+    return sync_box_folder(client, folder_id, local_folder, include_folder,
+                           include_file, num_workers=num_workers, verbose=verbose)
@@ -0,0 +1,349 @@
+""" Tests of box_io with an in memory fake of the box client.
+
+Run from the repository root with: python -m pytest functions/box_io_test.py
+"""
+
+import hashlib
+import threading
+
+import pandas as pd
+import pytest
+
+import box_io
+
+
+class FakeBoxAPIException(Exception):
+    """ Like boxsdk.exception.BoxAPIException."""
+
+    def __init__(self, status):
+        super().__init__(f"Box API error {status}")
+        self.status = status
+
+
+class FakeItem:
+    def __init__(self, item_id, name, item_type, content=None):
+        self.id = item_id
+        self.name = name
+        self.type = item_type
+        self.content = content
+        self.children = []
+
+    @property
+    def sha1(self):
+        if self.content is None:
+            return None
+        return hashlib.sha1(self.content).hexdigest()
+
+
+class FakeFile:
+    def __init__(self, client, file_id):
+        self.client = client
+        self.file_id = file_id
+
+    def _get_item(self):
+        item = self.client.items.get(self.file_id)
+        if item is None:
+            raise FakeBoxAPIException(404)
+        return item
+
+    def get(self, fields=None):
+        self.client.record("get", self.file_id)
+        status = self.client.get_errors.get(self.file_id)
+        if status is not None:
+            raise FakeBoxAPIException(status)
+        return self._get_item()
+
+    def content(self):
+        self.client.record("content", self.file_id)
+        return self._get_item().content
+
+    def download_to(self, writeable_stream):
+        self.client.record("download", self.file_id)
+        content = self._get_item().content
+        if self.client.on_download is not None:
+            self.client.on_download(self.file_id, writeable_stream)
+        fail_after = self.client.fail_downloads.get(self.file_id)
+        chunk_size = self.client.chunk_size
+        for start in range(0, len(content), chunk_size):
+            if fail_after is not None and start >= fail_after:
+                raise ConnectionError(f"Download of {self.file_id} interrupted.")
+            writeable_stream.write(content[start:start+chunk_size])
+
+
+class FakeFolder:
+    def __init__(self, client, folder_id):
+        self.client = client
+        self.folder_id = folder_id
+
+    def get_items(self, limit=100, offset=0, fields=None):
+        """ Like boxsdk, lazily request one page of limit items at a time."""
+        children = self.client.items[self.folder_id].children
+        while True:
+            self.client.record("list", (self.folder_id, offset))
+            page = children[offset:offset+limit]
+            yield from page
+            if len(page) < limit:
+                return
+            offset += limit
+
+
+class FakeBoxClient:
+    """ In memory box with the parts of the boxsdk Client box_io uses."""
+
+    def __init__(self):
+        self.items = {"0": FakeItem("0", "All Files", "folder")}
+        self.calls = []
+        # file_id: status of error raised by file(file_id).get()
+        self.get_errors = {}
+        # file_id: number of bytes written before the download fails
+        self.fail_downloads = {}
+        # Called with (file_id, writeable_stream) at the start of every download
+        self.on_download = None
+        self.chunk_size = 4
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def record(self, *call):
+        with self._lock:
+            self.calls.append(call)
+
+    def get_calls(self, name):
+        return [call[1] for call in self.calls if call[0] == name]
+
+    def _add_item(self, parent_id, name, item_type, content=None):
+        item_id = str(self._next_id)
+        self._next_id += 1
+        item = FakeItem(item_id, name, item_type, content)
+        self.items[item_id] = item
+        self.items[parent_id].children.append(item)
+        return item_id
+
+    def add_folder(self, parent_id, name):
+        return self._add_item(parent_id, name, "folder")
+
+    def add_file(self, parent_id, name, content):
+        return self._add_item(parent_id, name, "file", content)
+
+    def delete(self, item_id, parent_id):
+        item = self.items.pop(item_id)
+        self.items[parent_id].children.remove(item)
+
+    def file(self, file_id):
+        return FakeFile(self, file_id)
+
+    def folder(self, folder_id):
+        return FakeFolder(self, folder_id)
+
+
+def make_meta_csv(num_rows):
+    meta = pd.DataFrame({"colony": ["AB1"] * num_rows,
+                         "date": [20210412 + ind for ind in range(num_rows)],
+                         "beeframe": [1.0] * num_rows,
+                         "side": ["a"] * num_rows,
+                         "filename": [f"DSC_{ind}.JPG" for ind in range(num_rows)]
+                        })
+    return meta.to_csv(index=False).encode("utf-8"), meta
+
+def load_meta(client, folder_id, cache_folder, offline=False):
+    return box_io.load_beeframe_meta_from_box("meta.csv", None, None, folder_id,
+                                              cache_folder=cache_folder,
+                                              client=client, offline=offline)
+
+
+def test_meta_snapshot_only_checks_sha1(tmp_path):
+    client = FakeBoxClient()
+    content, meta = make_meta_csv(3)
+    file_id = client.add_file("0", "meta.csv", content)
+
+    pd.testing.assert_frame_equal(load_meta(client, "0", tmp_path), meta)
+    assert client.get_calls("content") == [file_id]
+
+    client.calls.clear()
+    pd.testing.assert_frame_equal(load_meta(client, "0", tmp_path), meta)
+    assert client.get_calls("get") == [file_id]
+    assert client.get_calls("content") == []
+    assert client.get_calls("list") == []
+
+    pd.testing.assert_frame_equal(load_meta(None, "0", tmp_path, offline=True), meta)
+
+def test_meta_snapshot_downloads_changed_file(tmp_path):
+    client = FakeBoxClient()
+    content, _ = make_meta_csv(3)
+    file_id = client.add_file("0", "meta.csv", content)
+    load_meta(client, "0", tmp_path)
+
+    new_content, new_meta = make_meta_csv(5)
+    client.items[file_id].content = new_content
+    pd.testing.assert_frame_equal(load_meta(client, "0", tmp_path), new_meta)
+    pd.testing.assert_frame_equal(load_meta(None, "0", tmp_path, offline=True), new_meta)
+
+def test_meta_snapshot_per_folder(tmp_path):
+    client = FakeBoxClient()
+    folder_ids = [client.add_folder("0", "first"), client.add_folder("0", "second")]
+    metas = []
+    for folder_id, num_rows in zip(folder_ids, [2, 4]):
+        content, meta = make_meta_csv(num_rows)
+        client.add_file(folder_id, "meta.csv", content)
+        metas.append(meta)
+
+    for folder_id, meta in zip(folder_ids, metas):
+        pd.testing.assert_frame_equal(load_meta(client, folder_id, tmp_path), meta)
+    for folder_id, meta in zip(folder_ids, metas):
+        pd.testing.assert_frame_equal(load_meta(None, folder_id, tmp_path, offline=True),
+                                      meta)
+
+def test_meta_snapshot_relists_replaced_file(tmp_path):
+    client = FakeBoxClient()
+    content, _ = make_meta_csv(3)
+    file_id = client.add_file("0", "meta.csv", content)
+    load_meta(client, "0", tmp_path)
+
+    # Replaced by a new upload, which gets a new id
+    client.delete(file_id, "0")
+    new_content, new_meta = make_meta_csv(6)
+    new_file_id = client.add_file("0", "meta.csv", new_content)
+    client.calls.clear()
+    pd.testing.assert_frame_equal(load_meta(client, "0", tmp_path), new_meta)
+    assert client.get_calls("list") == [("0", 0)]
+    assert client.get_calls("content") == [new_file_id]
+
+    client.calls.clear()
+    pd.testing.assert_frame_equal(load_meta(client, "0", tmp_path), new_meta)
+    assert client.get_calls("get") == [new_file_id]
+
+def test_meta_snapshot_deleted_file(tmp_path):
+    client = FakeBoxClient()
+    content, _ = make_meta_csv(3)
+    file_id = client.add_file("0", "meta.csv", content)
+    load_meta(client, "0", tmp_path)
+
+    client.delete(file_id, "0")
+    assert load_meta(client, "0", tmp_path) is None
+
+def test_meta_snapshot_other_errors_raise(tmp_path):
+    client = FakeBoxClient()
+    content, _ = make_meta_csv(3)
+    file_id = client.add_file("0", "meta.csv", content)
+    load_meta(client, "0", tmp_path)
+
+    client.get_errors[file_id] = 500
+    with pytest.raises(FakeBoxAPIException):
+        load_meta(client, "0", tmp_path)
+
+
+def get_local_files(local_folder):
+    """ Relative paths of files in local_folder (without the sync state)."""
+    return sorted(str(path.relative_to(local_folder)) 
+                  for path in local_folder.rglob("*") 
+                  if path.is_file() and path.name != box_io.SYNC_STATE_NAME)
+
+def add_mask_files(client, parent_id, num_files, size=40):
+    """ Add num_files files of size bytes, return {name: content}."""
+    files = {}
+    for ind in range(num_files):
+        name = f"DSC_{ind:04d}.png"
+        content = bytes((ind + byte) % 256 for byte in range(size))
+        client.add_file(parent_id, name, content)
+        files[name] = content
+    return files
+
+
+def test_sync_lists_every_page(tmp_path):
+    client = FakeBoxClient()
+    files = add_mask_files(client, "0", 7)
+    masks_id = client.add_folder("0", "masks")
+    files.update({f"masks/{name}": content 
+                  for name, content in add_mask_files(client, masks_id, 3).items()})
+
+    counts = box_io.sync_box_folder(client, "0", tmp_path, page_size=3, verbose=False)
+    assert counts == {"downloaded": 10, "skipped": 0, "failed": 0}
+    assert sorted(client.get_calls("list")) == [("0", 0), ("0", 3), ("0", 6), 
+                                                (masks_id, 0), (masks_id, 3)]
+    assert get_local_files(tmp_path) == sorted(files)
+    for name, content in files.items():
+        assert (tmp_path / name).read_bytes() == content
+
+def test_sync_skips_files_with_same_sha1(tmp_path):
+    client = FakeBoxClient()
+    files = add_mask_files(client, "0", 4)
+    (tmp_path / "DSC_0000.png").write_bytes(files["DSC_0000.png"])
+    (tmp_path / "DSC_0001.png").write_bytes(b"old version")
+
+    counts = box_io.sync_box_folder(client, "0", tmp_path, verbose=False)
+    assert counts == {"downloaded": 3, "skipped": 1, "failed": 0}
+    downloaded = {client.items[file_id].name for file_id in client.get_calls("download")}
+    assert downloaded == {"DSC_0001.png", "DSC_0002.png", "DSC_0003.png"}
+    assert (tmp_path / "DSC_0001.png").read_bytes() == files["DSC_0001.png"]
+
+    client.calls.clear()
+    counts = box_io.sync_box_folder(client, "0", tmp_path, verbose=False)
+    assert counts == {"downloaded": 0, "skipped": 4, "failed": 0}
+    assert client.get_calls("download") == []
+
+def test_sync_resumes_after_failed_download(tmp_path):
+    client = FakeBoxClient()
+    files = add_mask_files(client, "0", 5)
+    failing_id = client.items["0"].children[2].id
+    failing_name = client.items[failing_id].name
+    client.fail_downloads[failing_id] = 12
+    (tmp_path / failing_name).write_bytes(b"old version")
+
+    counts = box_io.sync_box_folder(client, "0", tmp_path, verbose=False)
+    assert counts == {"downloaded": 4, "skipped": 0, "failed": 1}
+    # The partial download never replaces the old file
+    assert (tmp_path / failing_name).read_bytes() == b"old version"
+    assert get_local_files(tmp_path) == sorted(files)
+
+    client.fail_downloads.clear()
+    client.calls.clear()
+    counts = box_io.sync_box_folder(client, "0", tmp_path, verbose=False)
+    assert counts == {"downloaded": 1, "skipped": 4, "failed": 0}
+    assert client.get_calls("download") == [failing_id]
+    for name, content in files.items():
+        assert (tmp_path / name).read_bytes() == content
+
+def test_sync_concurrent_downloads_are_atomic(tmp_path):
+    client = FakeBoxClient()
+    num_workers = 4
+    files = add_mask_files(client, "0", 5 * num_workers, size=256)
+    for name in files:
+        (tmp_path / name).write_bytes(b"old version")
+    # Every download waits until num_workers downloads are running at once
+    barrier = threading.Barrier(num_workers)
+    written_to = []
+
+    def on_download(file_id, writeable_stream):
+        written_to.append(writeable_stream.name)
+        local_file = tmp_path / client.items[file_id].name
+        assert local_file.read_bytes() == b"old version"
+        barrier.wait(timeout=10)
+
+    client.on_download = on_download
+    counts = box_io.sync_box_folder(client, "0", tmp_path, num_workers=num_workers,
+                                    verbose=False)
+    assert counts == {"downloaded": len(files), "skipped": 0, "failed": 0}
+    assert all(name.endswith(".part") for name in written_to)
+    assert get_local_files(tmp_path) == sorted(files)
+    for name, content in files.items():
+        assert (tmp_path / name).read_bytes() == content
+
+def test_download_error_without_part_file(tmp_path):
+    client = FakeBoxClient()
+    files = add_mask_files(client, "0", 1)
+    file_id = client.items["0"].children[0].id
+    local_file = tmp_path / "DSC_0000.png"
+
+    # The .part file is gone by the time the download fails
+    client.on_download = lambda file_id, writeable_stream: (
+        tmp_path.joinpath(f"{local_file.name}.part").unlink())
+    client.fail_downloads[file_id] = 0
+    with pytest.raises(ConnectionError):
+        box_io._download_box_file(client, file_id, str(local_file), 
+                                  client.items[file_id].sha1)
+    assert get_local_files(tmp_path) == []
+
+    client.on_download = None
+    client.fail_downloads.clear()
+    box_io._download_box_file(client, file_id, str(local_file), 
+                              client.items[file_id].sha1)
+    assert local_file.read_bytes() == files["DSC_0000.png"]
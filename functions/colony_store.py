@@ -0,0 +1,259 @@
+""" Store a whole colony (days x frames x height x width) in one file that can be memory mapped.
+
+File layout:
+    8 bytes  magic (b"COLONY3D")
+    4 bytes  format version (little endian uint32)
+    4 bytes  header length (little endian uint32)
+    header   utf-8 json with dates, frames, shape, dtype, class_names,
+             colony_name and data_offset
+    padding  so the data starts at a multiple of STORE_ALIGNMENT
+    data     raw C order array
+"""
+
+import json
+import os
+import struct
+
+import numpy as np
+
+from comb_loading import load_colony_comb_at_date
+from contents_processing import load_colony
+from frame_positions import FramePositionIndex
+
+
+STORE_MAGIC = b"COLONY3D"
+STORE_VERSION = 1
+STORE_ALIGNMENT = 4096
+# Reserved header space so the header can be rewritten without moving the data
+_MIN_HEADER_SPACE = 4 * STORE_ALIGNMENT
+
+
+def _to_json_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def _write_store_header(f, header):
+    """ Write magic, version and json header at start of open file f."""
+    header_bytes = json.dumps(header).encode("utf-8")
+    prefix = STORE_MAGIC + struct.pack("<II", STORE_VERSION, len(header_bytes))
+    if len(prefix) + len(header_bytes) > header['data_offset']:
+        raise RuntimeError(f"Header ({len(header_bytes)} bytes) doesn't fit before "
+                           f"data offset {header['data_offset']}."
+                          )
+    f.seek(0)
+    f.write(prefix)
+    f.write(header_bytes)
+    f.write(b"\0" * (header['data_offset'] - len(prefix) - len(header_bytes)))
+
+def read_colony_store_header(store_file):
+    """ Read the header of a colony store file.
+
+    Args:
+        store_file: path to colony store file
+
+    Return:
+        dict with keys dates, frames, shape, dtype, class_names, colony_name
+        and data_offset
+    """
+    with open(store_file, "rb") as f:
+        magic = f.read(len(STORE_MAGIC))
+        if magic != STORE_MAGIC:
+            raise RuntimeError(f"{store_file} is not a colony store file.")
+        version, header_length = struct.unpack("<II", f.read(8))
+        if version != STORE_VERSION:
+            raise RuntimeError(f"{store_file} has store version {version}, "
+                               f"only version {STORE_VERSION} is supported."
+                              )
+        header = json.loads(f.read(header_length).decode("utf-8"))
+    return header
+
+def create_colony_store(store_file, shape, dates, frames, class_names=None,
+                        colony_name=None, dtype=np.uint8):
+    """ Create colony store file and return it as a writable memmap.
+
+    Args:
+        store_file: path to file to create
+        shape: (days, frames, height, width)
+        dates: list of dates, one for each day
+        frames: list of frame names, one for each frame (like [1, ..., 10]
+            or ['1a', '1b', ...] for frame sides)
+        class_names: list of class names where the index is the value in the
+            array (like get_combined_classes()), optional
+        colony_name: name of the colony, optional
+        dtype: dtype of the array
+
+    Return:
+        np.memmap of shape opened in 'r+' mode
+    """
+    if len(dates) != shape[0]:
+        raise RuntimeError(f"Got {len(dates)} dates for {shape[0]} days.")
+    if len(frames) != shape[1]:
+        raise RuntimeError(f"Got {len(frames)} frames for {shape[1]} frames.")
+
+    header = {"dates": [_to_json_value(date) for date in dates],
+              "frames": [_to_json_value(frame) for frame in frames],
+              "shape": [int(size) for size in shape],
+              "dtype": np.dtype(dtype).str,
+              "class_names": class_names,
+              "colony_name": colony_name,
+              "data_offset": 0
+             }
+    header_size = len(json.dumps(header).encode("utf-8")) + len(STORE_MAGIC) + 8
+    data_offset = max(_MIN_HEADER_SPACE,
+                      int(np.ceil(2 * header_size / STORE_ALIGNMENT)) * STORE_ALIGNMENT)
+    header['data_offset'] = data_offset
+
+    num_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    with open(store_file, "wb") as f:
+        _write_store_header(f, header)
+        f.truncate(data_offset + num_bytes)
+
+    return np.memmap(store_file, dtype=dtype, mode="r+",
+                     offset=data_offset, shape=tuple(shape))
+
+def truncate_colony_store(store_file, num_days):
+    """ Only keep the first num_days days in colony store file.
+
+    Args:
+        store_file: path to colony store file
+        num_days: number of days to keep
+    """
+    header = read_colony_store_header(store_file)
+    header['dates'] = header['dates'][:num_days]
+    header['shape'][0] = num_days
+    num_bytes = int(np.prod(header['shape'])) * np.dtype(header['dtype']).itemsize
+    with open(store_file, "r+b") as f:
+        _write_store_header(f, header)
+        f.truncate(header['data_offset'] + num_bytes)
+
+def load_colony_store(store_file, mode="r"):
+    """ Open colony store file as memmap. Nothing is read until used.
+
+    Args:
+        store_file: path to colony store file
+        mode: np.memmap mode, 'r' for read only, 'r+' to edit in place,
+            'c' for copy on write
+
+    Return:
+        np.memmap (days x frames x height x width), header dict
+    """
+    header = read_colony_store_header(store_file)
+    colony = np.memmap(store_file, dtype=np.dtype(header['dtype']), mode=mode,
+                       offset=header['data_offset'], shape=tuple(header['shape']))
+    return colony, header
+
+def write_colony_store(store_file, colony, dates, frames=None,
+                       class_names=None, colony_name=None):
+    """ Write colony array to colony store file.
+
+    Args:
+        store_file: path to file to create
+        colony: days x frames x height x width array
+        dates: list of dates, one for each day
+        frames: list of frame names, if None use 1 to number of frames
+        class_names: list of class names, optional
+        colony_name: name of the colony, optional
+    """
+    if frames is None:
+        frames = list(range(1, colony.shape[1]+1))
+    store = create_colony_store(store_file, colony.shape, dates, frames,
+                                class_names, colony_name, colony.dtype)
+    for day_ind, day in enumerate(colony):
+        store[day_ind] = day
+    store.flush()
+    del store
+
+def convert_colony_comb_to_store(beeframe_meta, colony_name, folder_root,
+                                 masks_folder_name, store_file, combine_ab,
+                                 mirror_b=False, class_names=None,
+                                 num_workers=None):
+    """ Load colony comb masks (like load_colony_comb) and save as colony store.
+
+    Loads one day at a time so the whole colony is never in memory.
+    Like load_colony_comb, stops at the first day with missing frame info.
+
+    Args:
+        beeframe_meta: dataframe info like in 'img_to_text_df_TOEDIT.csv'
+            or FramePositionIndex
+        colony_name: name of colony
+        folder_root: path to the "nest_photos" folder
+        masks_folder_name: name of the folder the masks that should be loaded are in.
+        store_file: path to colony store file to create
+        combine_ab: see load_colony_comb
+        mirror_b: see load_colony_comb
+        class_names: list of class names, optional
+        num_workers: if given, read the mask files of each day with this many threads
+
+    Return:
+        number of days saved
+    """
+    if not isinstance(beeframe_meta, FramePositionIndex):
+        beeframe_meta = FramePositionIndex(beeframe_meta, verbose=False)
+    colony_df = beeframe_meta.subset(colony_name)
+    dates = colony_df.dates()
+
+    store = None
+    num_days = 0
+    for day_ind, date in enumerate(dates):
+        colony_day = load_colony_comb_at_date(colony_df, date, folder_root,
+                                              masks_folder_name, combine_ab,
+                                              mirror_b, num_workers=num_workers
+                                             )
+        if colony_day is None:
+            print(f"Colony is missing frame info. Saving days until this point.")
+            break
+        if store is None:
+            store = create_colony_store(store_file,
+                                        (len(dates), *colony_day.shape),
+                                        dates, list(range(1, colony_day.shape[0]+1)),
+                                        class_names, colony_name, colony_day.dtype)
+        store[day_ind] = colony_day
+        num_days += 1
+
+    if store is None:
+        return 0
+    store.flush()
+    del store
+    if num_days < len(dates):
+        truncate_colony_store(store_file, num_days)
+    return num_days
+
+def convert_colony_contents_to_store(colony_folder, label_type, dates,
+                                     colony_frame_positions, store_file,
+                                     class_names=None, downsample=None,
+                                     num_workers=None, verbose=True):
+    """ Load colony contents (like contents_processing.load_colony) and save
+    as colony store with the 20 frame sides as frames.
+
+    Loads one date at a time so the whole colony is never in memory.
+
+    Args:
+        colony_folder: path folder containing colony data in date subfolders
+        label_type: name of folder that contains the .npy files
+        dates: list of dates
+        colony_frame_positions: dataframe info like in 'img_to_text_df_TOEDIT.csv'
+            but just for one colony. Or FramePositionIndex subset to one colony.
+        store_file: path to colony store file to create
+        class_names: list of class names (like get_content_types()), optional
+        downsample: store data arrays with shape / downsample
+        num_workers: if given, read the files of each date with this many threads
+        verbose: if True print info about missing frame data
+    """
+    store = None
+    for day_ind, date in enumerate(dates):
+        colony_day = load_colony(colony_folder, label_type, [date],
+                                 colony_frame_positions, downsample=downsample,
+                                 verbose=verbose, num_workers=num_workers
+                                )[date]
+        if store is None:
+            num_frames = colony_day.shape[0] // 2
+            frames = [f"{frame_num}{side}" for frame_num in range(1, num_frames+1)
+                      for side in ["a", "b"]]
+            store = create_colony_store(store_file, (len(dates), *colony_day.shape),
+                                        dates, frames, class_names,
+                                        os.path.basename(os.path.normpath(colony_folder)),
+                                        colony_day.dtype)
+        store[day_ind] = colony_day
+    if store is not None:
+        store.flush()
@@ -2,10 +2,170 @@ import cv2
 import numpy as np
 import os
 import glob
+import hashlib
+from collections import OrderedDict
 
+from instrumentation import instrument
 
 
-def get_tangent_slope(contour, ind, num_points):
+# Max number of ContourGeometry objects kept by get_contour_geometry
+CONTOUR_GEOMETRY_CACHE_SIZE = 1024
+_contour_geometry_cache = OrderedDict()
+
+
+class ContourGeometry:
+    """ Tangents, normals and curvature for every point on a contour.
+    
+    Uses the same neighbourhoods as get_tangent_slope, but the averages
+    are taken from running sums over the (circular) contour so all points
+    are done at once. Use get_contour_geometry to get a cached instance.
+    
+    Attributes:
+        contour: cv2 contour object (n x 1 x 2)
+        num_points: how many points averaged on each side for the tangent
+        tangents: n x 2 array of unit (dx, dy) tangents
+        normals: n x 2 array of (dx, dy) perpendicular to tangents
+            (what get_perpendicular_to_tangent_slope returns)
+        curvature: n array of signed change in tangent angle per pixel
+            along the contour
+        orientation: 1 if contour goes counter clockwise in image coordinates
+            (x right, y down), -1 if clockwise, 0 if no area
+        outward_normals: normals flipped so they point out of the 
+            region the contour encloses
+    """
+    
+    def __init__(self, contour, num_points):
+        self.contour = contour
+        self.num_points = num_points
+        self.tangents = self._get_tangents(contour, num_points)
+        self.normals = np.stack([-self.tangents[:, 1], self.tangents[:, 0]], 
+                                axis=1)
+        self.curvature = self._get_curvature(contour, self.tangents)
+        self.orientation = self._get_orientation(contour)
+        # For a counter clockwise contour (y down) the normal (-dy, dx) 
+        # points out
+        self.outward_normals = self.normals * self.orientation
+        
+    def __len__(self):
+        return self.tangents.shape[0]
+    
+    @staticmethod
+    def _get_tangents(contour, num_points):
+        points = contour[:, 0].astype(np.int64)
+        num_contour_points = points.shape[0]
+        if num_contour_points < num_points:
+            # Windows of get_tangent_slope are cut short when they would
+            # wrap around more than once, keep those values for short contours
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return np.array([get_tangent_slope(contour, ind, num_points) 
+                                 for ind in range(num_contour_points)])
+        # Enough copies of the contour that every window can be read
+        # without wrapping
+        num_wraps = int(np.ceil((num_points + 1) / num_contour_points))
+        extended = np.tile(points, (2 * num_wraps + 1, 1))
+        running_sum = np.concatenate([np.zeros((1, 2), dtype=np.int64), 
+                                      np.cumsum(extended, axis=0)
+                                     ])
+        inds = np.arange(num_contour_points) + num_wraps * num_contour_points
+
+        point1 = (running_sum[inds] - running_sum[inds-num_points]) / num_points
+
+        # Same as get_tangent_slope: when the upper window wraps around the end
+        # of the contour it also includes the point itself
+        wraps = (np.arange(num_contour_points) + num_points + 1 
+                 >= num_contour_points)
+        lower_inds = np.where(wraps, inds, inds+1)
+        counts = np.where(wraps, num_points+1, num_points)[:, np.newaxis]
+        point2 = (running_sum[inds+num_points+1] - running_sum[lower_inds]) / counts
+
+        dif = point2 - point1
+        # Same dot product as np.linalg.norm on a single vector
+        norm = np.sqrt((dif[:, np.newaxis, :] @ dif[:, :, np.newaxis])[:, 0, 0])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return dif / norm[:, np.newaxis]
+    
+    @staticmethod
+    def _get_curvature(contour, tangents):
+        points = contour[:, 0].astype(float)
+        previous_tangents = np.roll(tangents, 1, axis=0)
+        next_tangents = np.roll(tangents, -1, axis=0)
+        cross = (previous_tangents[:, 0] * next_tangents[:, 1] 
+                 - previous_tangents[:, 1] * next_tangents[:, 0])
+        dot = np.sum(previous_tangents * next_tangents, axis=1)
+        angle_change = np.arctan2(cross, dot)
+        arc_length = np.linalg.norm(np.roll(points, -1, axis=0) 
+                                    - np.roll(points, 1, axis=0), axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return angle_change / arc_length
+    
+    @staticmethod
+    def _get_orientation(contour):
+        # Shoelace signed area is positive for counter clockwise
+        # points in image coordinates
+        points = contour[:, 0].astype(np.int64)
+        next_points = np.roll(points, -1, axis=0)
+        twice_area = np.sum(points[:, 0] * next_points[:, 1] 
+                            - next_points[:, 0] * points[:, 1])
+        return -int(np.sign(twice_area))
+    
+    def away_from_self(self, mask, target=1, contour_inds=None):
+        """ Vectorized away_from_self.
+        
+        Args:
+            mask: blob info
+            target: value of blob in mask
+            contour_inds: which points on contour to use, if None use all
+        
+        returns n array of -1 or 1
+        """
+        if contour_inds is None:
+            contour_inds = slice(None)
+        return get_away_from_self_directions(mask, 
+                                             self.contour[contour_inds, 0],
+                                             self.normals[contour_inds], 
+                                             target
+                                            )
+
+
+def _get_contour_key(contour, num_points):
+    contour = np.ascontiguousarray(contour)
+    contour_hash = hashlib.blake2b(contour.tobytes(), digest_size=16).digest()
+    return (contour.shape, contour.dtype.str, contour_hash, num_points)
+
+@instrument
+def get_contour_geometry(contour, num_points):
+    """ Get (cached) ContourGeometry for contour.
+    
+    Cached on the contour values (not the object) and num_points so 
+    the growth, drawing and analysis functions all share the work.
+    Keeps the CONTOUR_GEOMETRY_CACHE_SIZE most recently used.
+    
+    Args:
+        contour: cv2 contour object
+        num_points: how many points to average on each size when calculating  
+                    tangent
+                    
+    Return:
+        ContourGeometry
+    """
+    key = _get_contour_key(contour, num_points)
+    geometry = _contour_geometry_cache.get(key)
+    if geometry is not None:
+        _contour_geometry_cache.move_to_end(key)
+        return geometry
+    
+    geometry = ContourGeometry(np.array(contour), num_points)
+    _contour_geometry_cache[key] = geometry
+    while len(_contour_geometry_cache) > CONTOUR_GEOMETRY_CACHE_SIZE:
+        _contour_geometry_cache.popitem(last=False)
+    return geometry
+
+def clear_contour_geometry_cache():
+    """ Remove all cached ContourGeometry objects."""
+    _contour_geometry_cache.clear()
+
+
+def get_tangent_slope(contour, ind, num_points, geometry=None):
     """ Get tangent slope at ind on contour.
         But don't actually return slope, instead return 
         dx and dy where (dy/dx) is the slope. This makes getting
@@ -16,7 +176,14 @@ def get_tangent_slope(contour, ind, num_points):
         ind: ind of point want tangent for
         num_points: how many points to average on each size when calculating  
                     tangent
+        geometry: ContourGeometry of contour with num_points (like from 
+            get_contour_geometry) to look the tangent up in instead of
+            computing it, when calling for many points on the same contour
     """
+    
+    if geometry is not None:
+        tangent = geometry.tangents[ind]
+        return tangent[0], tangent[1]
 
     lowwer_bound = ind-num_points
     if lowwer_bound < 0:
@@ -41,7 +208,7 @@ def get_tangent_slope(contour, ind, num_points):
     
     return dif_x, dif_y
 
-def get_perpendicular_to_tangent_slope(contour, ind, num_points):
+def get_perpendicular_to_tangent_slope(contour, ind, num_points, geometry=None):
     """ Perpendicular slope is just negative inverse of tangent slope.
     But return dx and dy instead of actual slope.
     
@@ -49,9 +216,11 @@ def get_perpendicular_to_tangent_slope(contour, ind, num_points):
         contour: cv2 contour object
         ind: ind of point want tangent for
         num_points: how many points to average on each size
+        geometry: optional ContourGeometry, see get_tangent_slope
     """
     
-    dx_tangent, dy_tangent = get_tangent_slope(contour, ind, num_points)
+    dx_tangent, dy_tangent = get_tangent_slope(contour, ind, num_points, 
+                                               geometry)
     
     dx = -dy_tangent
     dy = dx_tangent
@@ -93,8 +262,9 @@ def draw_perpendiculars_on_contour(im, contour, spacing, line_length, buffer):
     """
     
     cv2.drawContours(im, [contour], -1, 4, 1)
+    normals = get_contour_geometry(contour, buffer).normals
     for ind in range(0, len(contour), spacing):
-        slope_dx, slope_dy = get_perpendicular_to_tangent_slope(contour, ind, buffer)
+        slope_dx, slope_dy = normals[ind]
         draw_line_with_slope(im, contour[ind, 0], 
                              slope_dx, slope_dy, 
                              line_length, 7, 1, out=False
@@ -160,6 +330,7 @@ def is_point_in_mask(mask, point):
     else:
         return True
     
+@instrument
 def get_perpendicular_growth_at_point(mask0, mask1, contour, contour_ind, 
                         step_size, target, background, num_points
                        ):
@@ -206,6 +377,7 @@ def get_perpendicular_growth_at_point(mask0, mask1, contour, contour_ind,
 
     
     
+@instrument
 def get_target_intersect(mask, contour, contour_ind, step_size, 
                          direction, target=1,
                          num_points=10, anti_target=False
@@ -293,6 +465,287 @@ def away_from_self(mask, contour, contour_ind, target=1, num_points=10):
         return -1
     else:
         return 1
+
+
+def get_perpendicular_slopes(contour, num_points):
+    """ Perpendicular dx and dy (see get_perpendicular_to_tangent_slope) 
+    for every point on contour at once.
+    
+    Args:
+        contour: cv2 contour object
+        num_points: how many points to average on each size when calculating  
+                    tangent
+    
+    Return:
+        n x 2 array of (dx, dy)
+    """
+    return get_contour_geometry(contour, num_points).normals
+
+def get_mask_values(mask, points):
+    """ Vectorized point_mask_value for (x, y) points.
+    
+    Points outside of mask (or nan) get value 0, which compares the same 
+    way as the False returned by point_mask_value.
+    
+    Args:
+        mask: 2D array
+        points: n x 2 array of (x, y)
+        
+    Return:
+        values: n array of mask values
+        in_mask: n boolean array, True where point is in mask
+    """
+    points = np.asarray(points, dtype=float)
+    with np.errstate(invalid='ignore'):
+        # int() truncates towards 0 so do the same here
+        i = np.trunc(points[:, 1])
+        j = np.trunc(points[:, 0])
+        in_mask = ((i >= 0) & (i < mask.shape[0]) 
+                   & (j >= 0) & (j < mask.shape[1])
+                  )
+    values = np.zeros(points.shape[0], dtype=mask.dtype)
+    values[in_mask] = mask[i[in_mask].astype(np.intp), j[in_mask].astype(np.intp)]
+    return values, in_mask
+
+def _is_in_target(mask, points, target, anti_target):
+    """ Vectorized is_point_in_target, also return is_point_in_mask."""
+    values, in_mask = get_mask_values(mask, points)
+    in_target = values == target
+    if np.ndim(anti_target) or anti_target:
+        in_target = in_target != anti_target
+    return in_target, in_mask
+
+def _march(start_points, steps, num_steps):
+    """ Positions after 1 to num_steps repeated additions of step.
+    
+    Uses cumsum so values are identical to adding step in a loop.
+    
+    Args:
+        start_points: n x 2
+        steps: n x 2
+        num_steps: how many steps to take
+    
+    Return:
+        n x num_steps x 2
+    """
+    sequence = np.empty((start_points.shape[0], num_steps+1, 2))
+    sequence[:, 0] = start_points
+    sequence[:, 1:] = steps[:, np.newaxis]
+    return np.cumsum(sequence, axis=1)[:, 1:]
+
+@instrument
+def get_target_intersects(mask, start_points, perpendiculars, step_size, 
+                          directions, target=1, anti_target=False, 
+                          chunk_size=64
+                         ):
+    """ Vectorized get_target_intersect for many starting points at once.
+    
+    All lines are stepped together chunk_size steps at a time, so the 
+    number of python level iterations only depends on the longest line.
+    
+    Args:
+        mask: 2D array
+        start_points: n x 2 array of (x, y) starting points on the contour
+        perpendiculars: n x 2 array of (dx, dy) to move along
+        step_size: how far along line to look for next intersection
+        directions: n array of 1 or -1 (see get_target_intersect)
+        target: comb value in mask 
+        anti_target: bool or n boolean array, instead looking for target, 
+            looks for any value that is not target
+        chunk_size: how many steps to evaluate per iteration
+        
+    Return:
+        points: n x 2 int array of intersections (-1 where no intersection)
+        distances: n float array of length along line at intersection
+            (nan where no intersection)
+    """
+    if step_size <= 0:
+        raise ValueError(f"step_size must be positive, {step_size} given.")
+    
+    num_lines = start_points.shape[0]
+    anti_target = np.broadcast_to(anti_target, (num_lines,))
+    directions = np.asarray(directions)
+    small_steps = perpendiculars * directions[:, np.newaxis]
+    steps = perpendiculars * step_size * directions[:, np.newaxis]
+    
+    hit_points = np.full((num_lines, 2), np.nan)
+    hit_distances = np.full(num_lines, np.nan)
+    
+    # Lines with undefined tangent never intersect
+    active = np.flatnonzero(np.all(np.isfinite(steps), axis=1))
+    points = start_points.astype(float)
+    distance = 0
+    while active.size > 0:
+        line_points = _march(points[active], steps[active], chunk_size)
+        distances = distance + np.cumsum(np.full(chunk_size, step_size))
+        in_target, in_mask = _is_in_target(mask, 
+                                           line_points.reshape(-1, 2), 
+                                           target,
+                                           np.repeat(anti_target[active], 
+                                                     chunk_size)
+                                          )
+        in_target = in_target.reshape(-1, chunk_size)
+        in_mask = in_mask.reshape(-1, chunk_size)
+        # First step that is either an intersection or leaves the mask
+        finished = in_target | ~in_mask
+        first_step = np.argmax(finished, axis=1)
+        is_finished = finished[np.arange(active.size), first_step]
+        hit = is_finished & in_target[np.arange(active.size), first_step]
+        
+        hit_lines = active[hit]
+        hit_points[hit_lines] = line_points[hit, first_step[hit]]
+        hit_distances[hit_lines] = distances[first_step[hit]]
+        
+        points[active] = line_points[:, -1]
+        distance = distances[-1]
+        active = active[~is_finished]
+    
+    # If step size is greater than one, don't know exact intersection point
+    # Go backwards to find exact intersection
+    result_points = np.full((num_lines, 2), -1, dtype=int)
+    result_distances = np.full(num_lines, np.nan)
+    
+    active = np.flatnonzero(np.isfinite(hit_distances))
+    points = hit_points - small_steps
+    back_steps = np.zeros(num_lines, dtype=int)
+    # The line can't be walked back further than it was walked out
+    max_back_steps = np.nan_to_num(hit_distances).astype(int) + 2
+    
+    if active.size > 0:
+        in_target, _ = _is_in_target(mask, points[active], target, 
+                                     anti_target[active])
+        done = active[~in_target]
+        result_points[done] = (points[done] + small_steps[done]).astype(int)
+        result_distances[done] = hit_distances[done]
+        active = active[in_target]
+    while active.size > 0:
+        line_points = _march(points[active], -small_steps[active], chunk_size)
+        in_target, _ = _is_in_target(mask, line_points.reshape(-1, 2), 
+                                     target, 
+                                     np.repeat(anti_target[active], chunk_size)
+                                    )
+        in_target = in_target.reshape(-1, chunk_size)
+        first_out = np.argmax(~in_target, axis=1)
+        is_done = ~in_target[np.arange(active.size), first_out]
+        
+        done = active[is_done]
+        done_points = line_points[is_done, first_out[is_done]]
+        result_points[done] = (done_points + small_steps[done]).astype(int)
+        result_distances[done] = (hit_distances[done] 
+                                  - back_steps[done] - first_out[is_done] - 1
+                                 )
+        
+        points[active] = line_points[:, -1]
+        back_steps[active] += chunk_size
+        active = active[~is_done]
+        active = active[back_steps[active] <= max_back_steps[active]]
+    
+    return result_points, result_distances
+
+@instrument
+def get_perpendicular_growth_along_contour(mask0, mask1, contour, step_size, 
+                                           target, background, num_points,
+                                           contour_inds=None
+                                          ):
+    """ Vectorized get_perpendicular_growth_at_point for many points
+    on the same contour.
+    
+    Args:
+        mask0: comb mask for starting frame
+        mask1: comb mask for next frame
+        contour: contour in mask0
+        step_size: how far along line to look for next intersection
+        target: comb value in mask 
+        background: background value in mask
+        num_points: how many points to average on each size when calculating tangent
+        contour_inds: which points on contour to use, if None use all
+        
+    Return:
+        points: n x 2 int array of intersections (-1 where no intersection)
+        distances: n float array of length along line at intersection
+            (nan where no intersection)
+    """
+    return get_perpendicular_growth_for_contours(
+        mask0, mask1, [contour], step_size, target, background, num_points,
+        contour_inds=[contour_inds]
+    )[0]
+
+@instrument
+def get_perpendicular_growth_for_contours(mask0, mask1, contours, step_size,
+                                          target, background, num_points,
+                                          spacing=1, contour_inds=None
+                                         ):
+    """ Perpendicular growth for points on every contour in contours.
+    All lines from all contours are searched together.
+    
+    Args:
+        mask0: comb mask for starting frame
+        mask1: comb mask for next frame
+        contours: list of contours in mask0 (like from get_class_contours)
+        step_size: how far along line to look for next intersection
+        target: comb value in mask 
+        background: background value in mask
+        num_points: how many points to average on each size when calculating tangent
+        spacing: use every spacing'th point on each contour
+        contour_inds: optional list (one per contour) of which points to use,
+            overrides spacing. None entries use spacing.
+        
+    Return:
+        list with (points, distances) for each contour. Where points is
+        n x 2 int array of intersections (-1 where no intersection) and 
+        distances is n float array of length along line at intersection
+        (nan where no intersection). n is the number of points used on
+        that contour.
+    """
+    if contour_inds is None:
+        contour_inds = [None] * len(contours)
+    
+    start_points = []
+    perpendiculars = []
+    for contour, inds in zip(contours, contour_inds):
+        if inds is None:
+            inds = np.arange(0, len(contour), spacing)
+        start_points.append(contour[inds, 0])
+        perpendiculars.append(get_perpendicular_slopes(contour, num_points)[inds])
+    if len(start_points) == 0:
+        return []
+    lengths = [len(points) for points in start_points]
+    start_points = np.concatenate(start_points).reshape(-1, 2)
+    perpendiculars = np.concatenate(perpendiculars).reshape(-1, 2)
+    
+    contour_val1, _ = get_mask_values(mask1, start_points)
+    # Search away from the target blob where target is still present
+    # in mask1 (the blob has gotten bigger), otherwise search into the 
+    # target blob (the blob has gotten smaller).
+    grown = contour_val1 == target
+    directions = get_away_from_self_directions(mask0, start_points, 
+                                               perpendiculars, target)
+    directions = np.where(grown, directions, -directions)
+    points, distances = get_target_intersects(mask1, start_points, 
+                                              perpendiculars, step_size, 
+                                              directions, target=target, 
+                                              anti_target=grown
+                                             )
+    
+    split_inds = np.cumsum(lengths)[:-1]
+    return list(zip(np.split(points, split_inds), 
+                    np.split(distances, split_inds)
+                   ))
+
+def get_away_from_self_directions(mask, start_points, perpendiculars, target=1):
+    """ Vectorized away_from_self.
+    
+    Args:
+        mask: blob info
+        start_points: n x 2 array of (x, y) points on the contour
+        perpendiculars: n x 2 array of (dx, dy) perpendicular to contour
+        target: value of blob in mask
+        
+    returns n array of -1 or 1
+    """
+    in_target, _ = _is_in_target(mask, start_points + perpendiculars * 3, 
+                                 target, anti_target=False)
+    return np.where(in_target, -1, 1)
     
     
     
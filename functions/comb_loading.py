@@ -1,37 +1,62 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
+from frame_positions import FramePositionIndex
+from instrumentation import instrument, record_file_read
+from mask_processing import dilate_class, get_interior_mask
+from rle_mask import RLEMask
+
+
+# Max bytes of frames compared with each class at once by create_colonies_summary
+CLASS_COUNT_BLOCK_BYTES = 32 * 1024**2
+# uint8 frames with more classes than this are counted with a histogram instead
+MAX_COMPARE_CLASSES = 16
+# calcHist counts in float32, which is only exact below 2**24 pixels per frame
+CALC_HIST_MAX_PIXELS = 2**24
+
+
 def get_organized_colony_names(beeframe_meta):
     """ Return names of all colonies that have frame and side info.
     NOTE: will also return nests that are only partially organized
     
     Args:
         beeframe_meta: dataframe with columns like 'img_to_text_d_TOEDIT.csv'
+            or FramePositionIndex
     """
+    if isinstance(beeframe_meta, FramePositionIndex):
+        return beeframe_meta.colonies()
     has_frame_info = ~beeframe_meta['beeframe'].isna()
     has_side_info = ~beeframe_meta['side'].isna()
     colonies = beeframe_meta.loc[has_frame_info&has_side_info, 'colony']
     colonies = colonies.unique()
     return colonies.tolist()
 
-def load_side_mask(masks_folder, day_info, frame_num, side):
-    """Load comb mask from assosiated with frame_num and side in day_info.
+def get_side_mask_file(masks_folder, day_info, frame_num, side):
+    """Get path of comb mask assosiated with frame_num and side in day_info.
     
     Args:
         masks_folder: path to nest_photos folder
         day_info: dataframe info like in 'img_to_text_df_TOEDIT.csv' but
             just for one day of one colony. Only rows that have frame 
-            and side info.
+            and side info. Or FramePositionIndex subset to one colony and day.
         frame_num: frame num for mask
         side: frame side of mask
         
     Return:
-        2D numpy array of comb mask or None if no file.
+        path to .png mask file or None if not in day_info.
     """
     
+    if isinstance(day_info, FramePositionIndex):
+        mask_filename = day_info.get_filename(frame_num, side)
+        if mask_filename is None:
+            return None
+        return os.path.join(masks_folder, mask_filename+".png")
+    
     frame_rows = day_info['beeframe'] == frame_num
     target_side = day_info['side'] == side
     mask_filename = day_info.loc[frame_rows&target_side, 'filename']
@@ -47,13 +72,61 @@ def load_side_mask(masks_folder, day_info, frame_num, side):
     # Get the actual filename (and the first one if there is overlap)
     mask_filename = mask_filename.iloc[0]
     mask_filename = os.path.splitext(mask_filename)[0]
-    mask = cv2.imread(os.path.join(masks_folder, mask_filename+".png"), 
-                      cv2.IMREAD_GRAYSCALE
-                      )
-    return mask
+    return os.path.join(masks_folder, mask_filename+".png")
 
+@instrument
+def _read_mask(mask_file, transform=None, aligned_shape=None):
+    """ Read grayscale mask, None if mask_file is None or can't be read.
+    If transform (2x3) is given, warp mask with it to aligned_shape
+    (height, width), or to the mask's own shape if aligned_shape is None."""
+    if mask_file is None:
+        return None
+    mask = cv2.imread(mask_file, cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        return mask
+    record_file_read(mask_file)
+    if transform is None:
+        return mask
+    if aligned_shape is None:
+        aligned_shape = mask.shape
+    return cv2.warpAffine(mask, M=np.asarray(transform, dtype=float), 
+                          dsize=(aligned_shape[1], aligned_shape[0])
+                         )
+
+def _get_side_transform(transforms, date, frame_num, side):
+    """ Transform for frame side from transforms (see load_colony_comb)."""
+    if transforms is None:
+        return None
+    if callable(transforms):
+        return transforms(date, frame_num, side)
+    return transforms.get((date, frame_num, side))
 
-def _combine_ab_mask(side_a, side_b, mirror_b):
+@instrument
+def load_side_mask(masks_folder, day_info, frame_num, side, transform=None,
+                   aligned_shape=None):
+    """Load comb mask from assosiated with frame_num and side in day_info.
+    
+    Args:
+        masks_folder: path to nest_photos folder
+        day_info: dataframe info like in 'img_to_text_df_TOEDIT.csv' but
+            just for one day of one colony. Only rows that have frame 
+            and side info. Or FramePositionIndex subset to one colony and day.
+        frame_num: frame num for mask
+        side: frame side of mask
+        transform: 2x3 affine matrix to warp the mask with after reading
+        aligned_shape: (height, width) of warped mask, default mask shape
+        
+    Return:
+        2D numpy array of comb mask or None if no file.
+    """
+    
+    mask_file = get_side_mask_file(masks_folder, day_info, frame_num, side)
+    return _read_mask(mask_file, transform, aligned_shape)
+
+
+@instrument
+def _combine_ab_mask(side_a, side_b, mirror_b, out=None, comb_class=2,
+                     scratch=None):
     """ Merge comb mask of side a and mask for side b into one comb mask.
     If either mask has comb at a point, will label that point as comb.
     Assumes 0 is background and wood and comb are 1 and 2 in mask.
@@ -63,9 +136,14 @@ def _combine_ab_mask(side_a, side_b, mirror_b):
         side_b: 2D numpy_array, comb_mask
         mirror_b: should b be horizonattally
             mirrored to match a's orientation
+        out: array to write merged mask to, can be side_a to merge in place
+        comb_class: value of comb in masks
+        scratch: 2 x mask_height x mask_width bool (or uint8) array used for 
+            the pixels taken from b, so merging many masks doesn't allocate
+            them each time. If None they are allocated.
         
     Return:
-        2D numpy array
+        2D numpy array (out if given)
     """
     
     if side_a.shape != side_b.shape:
@@ -77,17 +155,156 @@ def _combine_ab_mask(side_a, side_b, mirror_b):
     else:
         aligned_b = side_b
     
-    comb_mask = np.copy(side_a)
-    # Add all wood or comb present in b to a
-    comb_mask = np.where(aligned_b > 0, aligned_b, side_a)
-    # Any wood in b that replaced comb in a should be flipped back 
-    comb_mask = np.where(side_a == 2, side_a, comb_mask)
+    # Add all wood or comb present in b to a,
+    # except where a has comb (wood in b shouldn't replace comb in a)
+    if scratch is None:
+        use_b = aligned_b > 0
+        use_b &= side_a != comb_class
+    else:
+        use_b, not_comb = scratch.view(bool)
+        np.greater(aligned_b, 0, out=use_b)
+        np.not_equal(side_a, comb_class, out=not_comb)
+        use_b &= not_comb
+    if out is None:
+        out = np.copy(side_a)
+    elif out is not side_a:
+        np.copyto(out, side_a)
+    np.copyto(out, aligned_b, where=use_b)
+    
+    return out
+
+def _combine_ab_rle(side_a, side_b, mirror_b, comb_class=2):
+    """ Like load_colony_comb_frame's merge of dense side masks, but 
+    encoded as RLEMask and merged on the runs. Either side can be None.
+    
+    Return:
+        RLEMask or None if both sides are None
+    """
+    if side_a is None and side_b is None:
+        return None
+    if side_b is None:
+        return RLEMask.from_array(side_a)
+    side_b = RLEMask.from_array(side_b)
+    if side_a is None:
+        if mirror_b:
+            return side_b.mirror_horizontal()
+        return side_b
+    return RLEMask.from_array(side_a).merge_ab(side_b, mirror_b, comb_class)
+
+def _get_masks_folder(folder_root, colony_name, date, masks_folder_name):
+    return os.path.join(folder_root, colony_name, str(date), masks_folder_name)
+
+@instrument
+def _get_day_info(colony_df, date):
+    """ Rows (or FramePositionIndex subset) of colony_df for date."""
+    if isinstance(colony_df, FramePositionIndex):
+        return colony_df.subset(date=date)
+    return colony_df.loc[colony_df['date'] == date]
+
+def _get_mask_sides(combine_ab):
+    if combine_ab:
+        return ['a', 'b']
+    return ['a']
+
+def _submit_side_masks(executor, masks_folder, day_info, sides, num_frames=10,
+                       date=None, transforms=None, aligned_shape=None):
+    """ Start reading (and warping) every frame side of one day in executor.
+    
+    Return:
+        dict with (frame_num, side) keys and futures of masks as values
+    """
+    futures = {}
+    for frame_num in range(1, num_frames+1):
+        for side in sides:
+            mask_file = get_side_mask_file(masks_folder, day_info, frame_num, side)
+            transform = _get_side_transform(transforms, date, frame_num, side)
+            futures[(frame_num, side)] = executor.submit(_read_mask, mask_file,
+                                                         transform, aligned_shape)
+    return futures
+
+def _assemble_colony_day(get_side_mask, colony_name, date, combine_ab, 
+                         mirror_b, num_frames=10, get_out=None, 
+                         dilate_comb=False, comb_class=2, dilate_kernel_size=5,
+                         get_scratch=None):
+    """ Build num_frames x mask_height x mask_width array for one day.
+    
+    Args:
+        get_side_mask: function taking (frame_num, side) that returns mask or None
+        colony_name: name of colony (for messages)
+        date: date (for messages)
+        combine_ab: see load_colony_comb_at_date
+        mirror_b: see load_colony_comb_at_date
+        num_frames: number of frames in colony
+        get_out: function taking the first frame mask and returning the 
+            num_frames x mask_height x mask_width array to write the day to.
+            If None a new array is created.
+        dilate_comb: see load_colony_comb
+        comb_class: see load_colony_comb
+        dilate_kernel_size: see load_colony_comb
+        get_scratch: function taking the first frame mask and returning the
+            2 x mask_height x mask_width uint8 scratch array that merging 
+            and dilating every frame use for their temporaries. If None
+            one is created for the day.
+    
+    Returns: num_frames x mask_height x mask_width or None if missing info
+    """
+    nest = None
+    scratch = None
+    for frame_ind, frame_num in enumerate(range(1, num_frames+1)):
+        side_a = get_side_mask(frame_num, 'a')
+        side_b = None
+        if side_a is None:
+            if combine_ab:
+                side_b = get_side_mask(frame_num, 'b')
+                if side_b is None:
+                    print(f"No valid info for frame {frame_num},",
+                          f"{colony_name}, {date}."
+                         )
+                    print("returning None")
+                    return None
+                if mirror_b:
+                    side_a = side_b[:,::-1]
+                else:
+                    side_a = side_b
+            else:
+                print(f"No valid info for frame {frame_num} a,",
+                      f"{colony_name}, {date}."
+                     )
+                raise RuntimeError(f"Can't build day without frame {frame_num} a.")
+
+        if nest is None:
+            if get_out is None:
+                nest = np.empty((num_frames, *side_a.shape), dtype=side_a.dtype)
+            else:
+                nest = get_out(side_a)
+            if combine_ab or dilate_comb:
+                if get_scratch is None:
+                    scratch = np.empty((2, *side_a.shape), dtype=np.uint8)
+                else:
+                    scratch = get_scratch(side_a)
+        frame = nest[frame_ind]
+        if combine_ab:
+            if side_b is None:
+                side_b = get_side_mask(frame_num, 'b')
+            if side_b is not None:
+                _combine_ab_mask(side_a, side_b, mirror_b, out=frame, 
+                                 comb_class=comb_class, scratch=scratch)
+            else:
+                frame[...] = side_a
+        else:
+            frame[...] = side_a
+        if dilate_comb:
+            dilate_class(frame, comb_class, dilate_kernel_size, out=frame,
+                         scratch=scratch)
     
-    return comb_mask
+    return nest
 
+@instrument
 def load_colony_comb_at_date(colony_df, date, folder_root,
                              masks_folder_name, combine_ab, 
-                             mirror_b=False
+                             mirror_b=False, num_workers=None, dilate_comb=False,
+                             comb_class=2, dilate_kernel_size=5, out=None,
+                             transforms=None, aligned_shape=None
                             ):
     """ Load colony comb info for date into array.
     Just comb info, so assumes front side and back
@@ -96,6 +313,7 @@ def load_colony_comb_at_date(colony_df, date, folder_root,
     Args:
         colony_df: dataframe info like in 'img_to_text_df_TOEDIT.csv' but
             just for one colony. Only rows that have frame and side info.
+            Or FramePositionIndex subset to one colony.
         date: date user wants to load. Like: 20210412
         folder_root: path to the "nest_photos" folder
         masks_folder_name: name of the folder the masks that should be loaded are in.
@@ -105,58 +323,119 @@ def load_colony_comb_at_date(colony_df, date, folder_root,
             side but not other. Assumes missed comb in more likely than false 
             comb. If False, just use side a.
         mirror_b: should side b be mirrored if combining a and b side
+        num_workers: if given, read the mask files with this many threads
+        dilate_comb: see load_colony_comb
+        comb_class: see load_colony_comb
+        dilate_kernel_size: see load_colony_comb
+        out: num_frames x mask_height x mask_width array to write the day to
+        transforms: see load_colony_comb
+        aligned_shape: see load_colony_comb
         
                 
-    Returns: num_frames x mask_height x mask_width
+    Returns: num_frames x mask_height x mask_width (out if given)
     """
 
-    colony_name = colony_df.iloc[0]['colony']
-    masks_folder = os.path.join(folder_root, colony_name, 
-                                str(date), masks_folder_name
-                                )
+    if isinstance(colony_df, FramePositionIndex):
+        colony_name = colony_df.colonies()[0]
+    else:
+        colony_name = colony_df.iloc[0]['colony']
+    masks_folder = _get_masks_folder(folder_root, colony_name, date, 
+                                     masks_folder_name)
     
-    day_rows = colony_df['date'] == date
-    day_info = colony_df.loc[day_rows]
+    day_info = _get_day_info(colony_df, date)
+    get_out = None
+    if out is not None:
+        get_out = lambda first_frame: out
+    day_kwargs = {"get_out": get_out,
+                  "dilate_comb": dilate_comb,
+                  "comb_class": comb_class,
+                  "dilate_kernel_size": dilate_kernel_size
+                 }
     
-    nest = []
-    for frame_num in range(1, 11):
-        side_a = load_side_mask(masks_folder, day_info, frame_num, 'a')
-        if side_a is None:
-            if combine_ab:
-                side_b = load_side_mask(masks_folder, day_info, frame_num, 'b')
-                if side_b is None:
-                    print(f"No valid info for frame {frame_num},",
-                          f"{colony_name}, {date}."
-                         )
-                    print("returning None")
-                    return None
-                if mirror_b:
-                    side_a = side_b[:,::-1]
-                else:
-                    side_a = side_b
-            else:
-                print(f"No valid info for frame {frame_num} a,",
-                      f"{colony_name}, {date}."
-                     )
-                nest.append(None)
+    if not num_workers:
+        def get_side_mask(frame_num, side):
+            transform = _get_side_transform(transforms, date, frame_num, side)
+            return load_side_mask(masks_folder, day_info, frame_num, side,
+                                  transform, aligned_shape)
+        return _assemble_colony_day(get_side_mask, colony_name, date, 
+                                    combine_ab, mirror_b, **day_kwargs)
+    
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = _submit_side_masks(executor, masks_folder, day_info, 
+                                     _get_mask_sides(combine_ab), date=date,
+                                     transforms=transforms, 
+                                     aligned_shape=aligned_shape)
+        def get_side_mask(frame_num, side):
+            return futures[(frame_num, side)].result()
+        return _assemble_colony_day(get_side_mask, colony_name, date, 
+                                    combine_ab, mirror_b, **day_kwargs)
 
-        if combine_ab:
-            side_b = load_side_mask(masks_folder, day_info, frame_num, 'b')
-            if side_b is not None:
-                side_a = _combine_ab_mask(side_a, side_b, mirror_b)
-        nest.append(side_a)
+@instrument
+def load_colony_comb_frame(colony_df, date, frame_num, folder_root,
+                           masks_folder_name, combine_ab, mirror_b=False,
+                           transforms=None, aligned_shape=None, rle=False):
+    """ Load colony comb info for a single frame at date.
+    Same as that frame in load_colony_comb_at_date.
     
-    nest = np.stack(nest, 0)
-    return nest
+    Args:
+        colony_df: dataframe info like in 'img_to_text_df_TOEDIT.csv' but
+            just for one colony. Only rows that have frame and side info.
+            Or FramePositionIndex subset to one colony.
+        date: date user wants to load. Like: 20210412
+        frame_num: frame to load (1 to 10)
+        folder_root: path to the "nest_photos" folder
+        masks_folder_name: name of the folder the masks that should be loaded are in.
+        combine_ab: see load_colony_comb_at_date
+        mirror_b: see load_colony_comb_at_date
+        transforms: see load_colony_comb
+        aligned_shape: see load_colony_comb
+        rle: if True, return the frame as an RLEMask, with the a and b
+            sides merged on their runs (RLEMask.merge_ab)
+        
+    Returns: mask_height x mask_width (RLEMask if rle) or None if no valid 
+        info for frame
+    """
+    if isinstance(colony_df, FramePositionIndex):
+        colony_name = colony_df.colonies()[0]
+    else:
+        colony_name = colony_df.iloc[0]['colony']
+    masks_folder = _get_masks_folder(folder_root, colony_name, date, 
+                                     masks_folder_name)
+    day_info = _get_day_info(colony_df, date)
+    
+    side_a = load_side_mask(masks_folder, day_info, frame_num, 'a',
+                            _get_side_transform(transforms, date, frame_num, 'a'),
+                            aligned_shape)
+    side_b = None
+    if combine_ab:
+        side_b = load_side_mask(masks_folder, day_info, frame_num, 'b',
+                                _get_side_transform(transforms, date, frame_num, 'b'),
+                                aligned_shape)
+    if rle:
+        return _combine_ab_rle(side_a, side_b, mirror_b)
+    if side_a is None:
+        if side_b is None:
+            return None
+        if mirror_b:
+            side_a = side_b[:,::-1]
+        else:
+            side_a = side_b
+    if side_b is not None:
+        side_a = _combine_ab_mask(side_a, side_b, mirror_b)
+    return side_a
 
+@instrument
 def load_colony_comb(beeframe_meta, colony_name, folder_root, 
-                     masks_folder_name, combine_ab, mirror_b=False):
+                     masks_folder_name, combine_ab, mirror_b=False,
+                     num_workers=None, dilate_comb=False, comb_class=2,
+                     dilate_kernel_size=5, transforms=None, aligned_shape=None):
     """ Load colony comb info in 4D array (days x frames x height x width).
     Just comb info, so assumes front side and back
     side are the same.
         
     Args:
         beeframe_meta: dataframe info like in 'img_to_text_df_TOEDIT.csv'
+            or FramePositionIndex (faster when loading many colonies)
         colony_name: name of colony
         folder_root: path to the "nest_photos" folder
         masks_folder_name: name of the folder the masks that should be loaded are in.
@@ -166,82 +445,319 @@ def load_colony_comb(beeframe_meta, colony_name, folder_root,
             side but not other. Assumes missed comb in more likely than false 
             comb. If False, just use side a.
         mirror_b: should side b be mirrored if combining a and b side 
+        num_workers: if given, read the mask files with this many threads,
+            the next date is read while a date is put together. Result is 
+            the same as reading one by one.
+        dilate_comb: if True, dilate comb in every frame (like 
+            mask_processing.dilate_class) to remove thin false wood around comb
+        comb_class: value of comb in masks
+        dilate_kernel_size: kernel size for comb dilation
+        transforms: 2x3 affine matrices (like from comb_registration) to warp
+            masks with when they are read, so aligned masks don't have to be 
+            saved. Either dict with (date, frame_num, side) keys (dates like
+            in beeframe_meta) or function taking date, frame_num and side. 
+            Frame sides without a transform (None) aren't warped. Transforms
+            apply to masks as saved, so b side transforms should include any
+            mirroring and mirror_b should be False.
+        aligned_shape: (height, width) of warped masks, default the shape
+            of each mask
         
+    Frames are merged and dilated directly into one preallocated colony array,
+    reusing one scratch array for the temporaries of every frame.
                 
     Returns: days x num_frames x mask_height x mask_width
     """
     
-    colony_rows = beeframe_meta['colony'] == colony_name
+    if isinstance(beeframe_meta, FramePositionIndex):
+        colony_df = beeframe_meta.subset(colony_name)
+        dates = colony_df.dates()
+    else:
+        colony_rows = beeframe_meta['colony'] == colony_name
 
-    has_frame_info = ~beeframe_meta['beeframe'].isna()
-    has_side_info = ~beeframe_meta['side'].isna()
-    is_organized = has_frame_info & has_side_info
-
-    colony_df = beeframe_meta.loc[colony_rows & is_organized]
-    
-    colony = []
-    
-    dates = sorted(colony_df['date'].unique())
-    for date in dates:
-        colony_day = load_colony_comb_at_date(colony_df, date, 
-                                              folder_root, masks_folder_name,
-                                              combine_ab, mirror_b
-                                             )
-        if colony_day is None:
-            print(f"Colony is missing frame info. Returning day until this point.")
-            break
-        colony.append(colony_day)
-    if len(colony) >= 1:
-        colony = np.stack(colony, axis=0)
+        has_frame_info = ~beeframe_meta['beeframe'].isna()
+        has_side_info = ~beeframe_meta['side'].isna()
+        is_organized = has_frame_info & has_side_info
+
+        colony_df = beeframe_meta.loc[colony_rows & is_organized]
+        dates = sorted(colony_df['date'].unique())
+    
+    colony = None
+    num_days = 0
+    
+    def get_day_out(first_frame):
+        nonlocal colony
+        if colony is None:
+            colony = np.empty((len(dates), 10, *first_frame.shape), 
+                              dtype=first_frame.dtype)
+        return colony[num_days]
+    scratch = None
+    
+    def get_scratch(first_frame):
+        # One scratch array for merging and dilating every frame of the colony
+        nonlocal scratch
+        if scratch is None:
+            scratch = np.empty((2, *first_frame.shape), dtype=np.uint8)
+        return scratch
+    day_kwargs = {"get_out": get_day_out,
+                  "dilate_comb": dilate_comb,
+                  "comb_class": comb_class,
+                  "dilate_kernel_size": dilate_kernel_size,
+                  "get_scratch": get_scratch
+                 }
+    
+    def submit_date(executor, date):
+        masks_folder = _get_masks_folder(folder_root, colony_name, date, 
+                                         masks_folder_name)
+        day_info = _get_day_info(colony_df, date)
+        return _submit_side_masks(executor, masks_folder, day_info, 
+                                  _get_mask_sides(combine_ab), date=date, 
+                                  transforms=transforms, 
+                                  aligned_shape=aligned_shape)
+    
+    executor = None
+    next_futures = None
+    if num_workers and len(dates) > 0:
+        executor = ThreadPoolExecutor(max_workers=num_workers)
+        # Only the date being put together and the next one are read at a 
+        # time, so at most two days of masks are held besides the colony
+        next_futures = submit_date(executor, dates[0])
+    try:
+        for date_ind, date in enumerate(dates):
+            if executor is None:
+                masks_folder = _get_masks_folder(folder_root, colony_name, date, 
+                                                 masks_folder_name)
+                day_info = _get_day_info(colony_df, date)
+                get_side_mask = lambda frame_num, side: load_side_mask(
+                    masks_folder, day_info, frame_num, side,
+                    _get_side_transform(transforms, date, frame_num, side),
+                    aligned_shape)
+            else:
+                futures = next_futures
+                next_futures = None
+                if date_ind + 1 < len(dates):
+                    next_futures = submit_date(executor, dates[date_ind+1])
+                get_side_mask = lambda frame_num, side: futures[(frame_num, side)].result()
+            colony_day = _assemble_colony_day(get_side_mask, colony_name, date, 
+                                              combine_ab, mirror_b, **day_kwargs)
+            # Masks of this day are in colony now
+            futures = None
+            if colony_day is None:
+                print(f"Colony is missing frame info. Returning day until this point.")
+                break
+            num_days += 1
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    if num_days == len(dates):
+        return colony
+    if num_days >= 1:
+        # Copy so the rows of the missing days aren't kept alive
+        colony = colony[:num_days].copy()
     else:
         colony = None
     return colony
 
+def _stack_class_counts(counts_list, min_classes=0):
+    """ Stack class count arrays (1D, or 2D with a row per frame) of
+    different lengths into one 2D int64 array padded with zeros."""
+    counts_list = [np.atleast_2d(counts) for counts in counts_list]
+    num_classes = max([counts.shape[1] for counts in counts_list] + [min_classes])
+    num_rows = sum(len(counts) for counts in counts_list)
+    all_counts = np.zeros((num_rows, num_classes), dtype=np.int64)
+    row = 0
+    for counts in counts_list:
+        all_counts[row:row+len(counts), :counts.shape[1]] = counts
+        row += len(counts)
+    return all_counts
+
+def _count_block_classes(frames, interior=None):
+    """ Count of every class in each frame of a block of frames.
+
+    Args:
+        frames: n x height x width array of masks
+        interior: None or bool array of the pixels to count, either
+            height x width for every frame or n x height x width
+
+    Return:
+        n x num_classes int64 array with each row like np.bincount of a
+        frame, array with number of pixels counted in each frame
+    """
+    num_frames = len(frames)
+    if interior is None:
+        num_pixels = np.full(num_frames, frames[0].size if num_frames else 0, 
+                             dtype=np.int64)
+    else:
+        interior = np.broadcast_to(interior, frames.shape)
+        if interior.strides[0] == 0:
+            num_pixels = np.full(num_frames, np.count_nonzero(interior[0]), 
+                                 dtype=np.int64)
+        else:
+            num_pixels = np.count_nonzero(interior.reshape(num_frames, -1), axis=1)
+    if frames.dtype.kind not in "ub":
+        # Not unsigned, bincount checks the values
+        counts = _stack_class_counts([np.bincount(frame.ravel() if interior is None 
+                                                  else frame[interior[ind]])
+                                      for ind, frame in enumerate(frames)])
+        return counts, num_pixels
+    
+    num_classes = int(frames.max()) + 1 if frames.size else 0
+    counts = np.zeros((num_frames, num_classes), dtype=np.int64)
+    if (num_classes > MAX_COMPARE_CLASSES and frames.dtype == np.uint8
+            and frames[0].size < CALC_HIST_MAX_PIXELS):
+        for ind, frame in enumerate(frames):
+            frame_interior = None
+            if interior is not None:
+                frame_interior = np.ascontiguousarray(interior[ind]).view(np.uint8)
+            hist = cv2.calcHist([np.ascontiguousarray(frame)], [0], frame_interior, 
+                                [num_classes], [0, num_classes])
+            counts[ind] = hist.ravel()
+        return counts, num_pixels
+    # Few classes (or frames too big for exact calcHist counts), compare the
+    # block with each class (no int64 copy of frames)
+    is_class = np.empty(frames.shape, dtype=bool)
+    for class_id in range(1, num_classes):
+        np.equal(frames, class_id, out=is_class)
+        if interior is not None:
+            is_class &= interior
+        for ind in range(num_frames):
+            counts[ind, class_id] = np.count_nonzero(is_class[ind])
+    # Every other pixel counted is class 0
+    if num_classes:
+        counts[:, 0] = num_pixels - counts[:, 1:].sum(axis=1)
+    return counts, num_pixels
+
+def _get_colony_class_counts(colony, interior_mask=None, wood_class=1):
+    """ Count of every class in every frame of colony.
+
+    Frames of each day are counted in blocks of up to CLASS_COUNT_BLOCK_BYTES,
+    so there is no colony sized temporary and LazyColony frames are only
+    loaded one block at a time.
+
+    Args:
+        colony: days x frames x height x width array or LazyColony
+        interior_mask: None, 2D mask with nonzero inside frame or 'auto' to
+            use get_interior_mask on each frame
+        wood_class: value of wood in frames (for 'auto')
+
+    Return:
+        days*frames x num_classes int64 array of counts (each row like 
+        np.bincount of a frame), days*frames array of pixels counted
+    """
+    auto_interior = False
+    interior = None
+    if isinstance(interior_mask, str):
+        if interior_mask != 'auto':
+            raise ValueError(f"interior_mask must be None, 'auto' or an array "
+                             f"not '{interior_mask}'.")
+        auto_interior = True
+    elif interior_mask is not None:
+        interior = np.asarray(interior_mask) > 0
+    
+    block_counts = []
+    block_pixels = []
+    for day in colony:
+        if not hasattr(day, "shape"):
+            day = np.asarray(day)
+        num_frames = len(day)
+        frame_bytes = int(np.prod(day.shape[1:])) * np.dtype(day.dtype).itemsize
+        block_size = max(1, CLASS_COUNT_BLOCK_BYTES // max(1, frame_bytes))
+        if auto_interior:
+            block_size = 1
+        for start in range(0, num_frames, block_size):
+            block = np.asarray(day[start:start+block_size])
+            if auto_interior:
+                interior = get_interior_mask(block[0], wood_class) > 0
+            counts, num_pixels = _count_block_classes(block, interior)
+            block_counts.append(counts)
+            block_pixels.append(num_pixels)
+    
+    all_pixels = np.concatenate(block_pixels + [np.zeros(0, dtype=np.int64)])
+    return _stack_class_counts(block_counts), all_pixels
+
+@instrument
 def create_colonies_summary(colonies, comb_class, wood_class,
-                            num_interior_pixels=None
+                            num_interior_pixels=None, interior_mask=None,
+                            class_names=None
                            ):
     """Sumarize frame contents for list of colonies.
     
-    For each frame compute number of wood and comb pixels.
+    For each frame count pixels of every class (see _get_colony_class_counts).
     And fraction of interior if given.
     
     Args:
-        colonies: list of colony arrays (WxFxHxW)
+        colonies: list of colony arrays (WxFxHxW), can be LazyColony
         comb_class: the value of comb in frame masks
         wood_class: the value of wood in frame masks
         num_interior_pixels: how many pixels within the wooden
             border of the frame. Used to normalize pixel counts
             of comb (and wood but less meaningful)
+        interior_mask: if given, only count pixels inside the frame and
+            normalize each frame by its own number of interior pixels (unless
+            num_interior_pixels is given). Either a 2D mask used for all frames
+            or 'auto' to use get_interior_mask on every frame.
+        class_names: list of class names where the index is the value in
+            the masks, used to name the per class columns. Raises ValueError
+            if two classes get the same column (only wood_class can be 
+            named wood and comb_class comb)
     
     Returns:
         data frame with columns: colony, week, frame, type,
         wood_pixels, comb_pixels, wood_fraction, comb_fraction
+        and a {class name}_pixels (or class_{id}_pixels) column for every
+        class present
     """
-    frame_summaries = []
+    frame_info = []
+    colony_counts = []
+    colony_pixels = []
     for colony_dict in colonies:
         colony = colony_dict['colony']
-        colony_name = colony_dict['name']
-        colony_type = colony_dict['type']
-        for week_num, week in enumerate(colony):
-            for frame_num, frame in enumerate(week):
-                wood_pixel_count = np.sum(frame==wood_class)
-                comb_pixel_count = np.sum(frame==comb_class)
-                frame_summary = {'colony': colony_name,
-                                 'week': week_num,
-                                 'frame': frame_num,
-                                 'type': colony_type,
-                                 'wood_pixels': wood_pixel_count,
-                                 'comb_pixels': comb_pixel_count,
-                                 'wood_fraction': np.nan,
-                                 'comb_fraction': np.nan
-                                }
-                if num_interior_pixels:
-                    frac_wood = wood_pixel_count / num_interior_pixels
-                    frac_comb = comb_pixel_count / num_interior_pixels
-                    frame_summary['wood_fraction'] = frac_wood
-                    frame_summary['comb_fraction'] = frac_comb
-                frame_summaries.append(frame_summary)
-    frame_contents = pd.DataFrame(frame_summaries)
+        counts, num_pixels = _get_colony_class_counts(colony, interior_mask, 
+                                                      wood_class)
+        num_frames = len(colony[0]) if len(colony) else 1
+        for ind in range(len(counts)):
+            frame_info.append((colony_dict['name'], ind // num_frames, 
+                               ind % num_frames, colony_dict['type']))
+        colony_counts.append(counts)
+        colony_pixels.append(num_pixels)
+    
+    all_counts = _stack_class_counts(colony_counts, 
+                                     min_classes=max(comb_class, wood_class) + 1)
+    frame_pixels = np.concatenate(colony_pixels + [np.zeros(0, dtype=np.int64)])
+
+    frame_contents = pd.DataFrame(frame_info,
+                                  columns=['colony', 'week', 'frame', 'type'])
+    frame_contents['wood_pixels'] = all_counts[:, wood_class]
+    frame_contents['comb_pixels'] = all_counts[:, comb_class]
+    frame_contents['wood_fraction'] = np.nan
+    frame_contents['comb_fraction'] = np.nan
+    if num_interior_pixels:
+        normalization = num_interior_pixels
+    elif interior_mask is not None:
+        normalization = np.array(frame_pixels, dtype=float)
+        normalization[normalization == 0] = np.nan
+    else:
+        normalization = None
+    if normalization is not None:
+        frame_contents['wood_fraction'] = all_counts[:, wood_class] / normalization
+        frame_contents['comb_fraction'] = all_counts[:, comb_class] / normalization
+
+    # Class of every pixel count column, a class named wood or comb can reuse
+    # the column of wood_class or comb_class but no other class can
+    column_classes = {'wood_pixels': wood_class, 'comb_pixels': comb_class}
+    present_classes = np.flatnonzero(all_counts.sum(axis=0))
+    for class_id in present_classes:
+        if class_names is not None and class_id < len(class_names):
+            column = f"{class_names[class_id]}_pixels"
+        else:
+            column = f"class_{class_id}_pixels"
+        column_class = column_classes.setdefault(column, class_id)
+        if column_class != class_id:
+            raise ValueError(f"Column {column} of class {class_id} is already "
+                             f"used for class {column_class}, class names "
+                             f"must be unique and only name wood_class wood "
+                             f"and comb_class comb.")
+        if column not in frame_contents:
+            frame_contents[column] = all_counts[:, class_id]
     return frame_contents
 
 def visualize_colony(colony, figsize=(20, 10), max_class=2,
@@ -1,12 +1,17 @@
 """ A range of functions commonly used across tasks related to the comb segmentation data."""
 
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import cv2
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
+from frame_positions import FramePositionIndex
+from instrumentation import instrument, record_file_read
+from mask_pyramid import get_level_class_counts, load_pyramid_level
+
 
 def get_comb_types():
     comb_classes = ["background",
@@ -67,7 +72,7 @@ def get_frame_filename(frame_positions, frame_num, side):
     Args:
         frame_positions: dataframe info like in 'img_to_text_df_TOEDIT.csv' but
             just for one colony at single date. Only rows that have frame 
-            and side info.
+            and side info. Or FramePositionIndex subset to one colony and date.
         frame_num: frame num for mask
         side: frame side of mask
         
@@ -76,6 +81,9 @@ def get_frame_filename(frame_positions, frame_num, side):
         With file extension removed.
     """
     
+    if isinstance(frame_positions, FramePositionIndex):
+        return frame_positions.get_filename(frame_num, side)
+    
     frame_rows = frame_positions['beeframe'] == frame_num
     target_side = frame_positions['side'] == side
     filenames = frame_positions.loc[frame_rows&target_side, 'filename']
@@ -94,9 +102,37 @@ def get_frame_filename(frame_positions, frame_num, side):
 
     return filename
 
-def load_colony(colony_folder, label_type, dates, colony_frame_positions, 
-               downsample=None, verbose=True, num_frames=10):
-    """Load colony data of given label type at specified dates.
+@instrument
+def _load_frameside(frameside_file, downsample=None, use_pyramid=False):
+    """ Load .npy frame side, or placeholder of 255s if frameside_file is None.
+    
+    Args:
+        frameside_file: path to .npy file or None
+        downsample: load data arrays with shape / downsample 
+        use_pyramid: if True (and downsample) load majority class level 
+            from the mask pyramid instead (see mask_pyramid)
+    """
+    if downsample and use_pyramid:
+        if frameside_file is None:
+            full_shape = np.array(default_frame_array_size())
+            return np.full(-(-full_shape // downsample), 255, dtype=np.uint8)
+        return load_pyramid_level(frameside_file, downsample)
+    if frameside_file is None:
+        frameside = np.ones(default_frame_array_size(), dtype=np.uint8) * 255
+    else:
+        frameside = np.load(frameside_file)
+        record_file_read(frameside_file)
+    if downsample:
+        scale = 1 / downsample
+        frameside = cv2.resize(frameside, (0,0), fx=scale, fy=scale,
+                               interpolation=cv2.INTER_NEAREST) 
+    return frameside
+
+@instrument
+def get_colony_frameside_files(colony_folder, label_type, dates, 
+                               colony_frame_positions, verbose=True, 
+                               num_frames=10):
+    """ Get the .npy file for every frame side at every date.
     
     Args:
         colony_folder: path folder containing colony data in date subfolders 
@@ -104,25 +140,27 @@ def load_colony(colony_folder, label_type, dates, colony_frame_positions,
             comb information.
         dates: list of dates
         colony_frame_positions: dataframe info like in 'img_to_text_df_TOEDIT.csv' 
-            but just for one colony.
-            and side info.
-        downsample: load data arrays with shape / downsample 
+            but just for one colony. Or FramePositionIndex subset to one colony.
         verbose: if True print info about missing frame data
+        num_frames: number of frames in colony
         
     Return:
-        Dict with dates as keys and 20 x h x w arrays as values
-            """
-
+        Dict with dates as keys and lists of files (frame 1 side a, frame 1 side b,
+        frame 2 side a...) as values. Missing frame sides are None.
+    """
     
     side_names = ["a", "b"]
     
-    colony = {}
-
+    colony_files = {}
+    
     for date in dates:
-        date_rows = colony_frame_positions['date'] == date
-        date_frame_positions = colony_frame_positions[date_rows]
+        if isinstance(colony_frame_positions, FramePositionIndex):
+            date_frame_positions = colony_frame_positions.subset(date=date)
+        else:
+            date_rows = colony_frame_positions['date'] == date
+            date_frame_positions = colony_frame_positions[date_rows]
         date_folder = os.path.join(colony_folder, date, label_type)
-        framesides = []
+        frameside_files = []
         for frame_num in range(1, num_frames+1): # frames labeled 1 through 10
             for side_name in side_names:
                 filename = get_frame_filename(date_frame_positions, frame_num, 
@@ -130,16 +168,72 @@ def load_colony(colony_folder, label_type, dates, colony_frame_positions,
                 if filename is None:
                     if verbose:
                         print(f"{date}: frame {frame_num}, side {side_name} wasn't found.")
-                    frameside = np.ones(default_frame_array_size(), dtype=np.uint8) * 255
+                    frameside_files.append(None)
                 else:
-                    frameside_file = os.path.join(date_folder, f"{filename}.npy")
-                    frameside = np.load(frameside_file)
-                if downsample:
-                    scale = 1 / downsample
-                    frameside = cv2.resize(frameside, (0,0), fx=scale, fy=scale,
-                                           interpolation=cv2.INTER_NEAREST) 
-                framesides.append(frameside)
-        colony[date] = np.stack(framesides)
+                    frameside_files.append(os.path.join(date_folder, f"{filename}.npy"))
+        colony_files[date] = frameside_files
+    
+    return colony_files
+
+@instrument
+def load_colony(colony_folder, label_type, dates, colony_frame_positions, 
+               downsample=None, verbose=True, num_frames=10, num_workers=None,
+               use_pyramid=False):
+    """Load colony data of given label type at specified dates.
+    
+    Args:
+        colony_folder: path folder containing colony data in date subfolders 
+        label_type: name of folder that contains the .npy files with the relevant
+            comb information.
+        dates: list of dates
+        colony_frame_positions: dataframe info like in 'img_to_text_df_TOEDIT.csv' 
+            but just for one colony. Or FramePositionIndex subset to one colony.
+        downsample: load data arrays with shape / downsample 
+        verbose: if True print info about missing frame data
+        num_workers: if given, read (and downsample) frame sides with this
+            many threads, the next date is read while a date is stacked
+        use_pyramid: if True, downsampled data is the majority class of each
+            downsample x downsample block read from the saved mask pyramid
+            (built the first time), so only the small level is read. Classes
+            thinner than a block are still dropped, like with nearest 
+            resizing. Only the class counts saved in the pyramid are exact
+            (see get_frameside_class_counts).
+        
+    Return:
+        Dict with dates as keys and 20 x h x w arrays as values
+            """
+
+    colony_files = get_colony_frameside_files(colony_folder, label_type, dates, 
+                                              colony_frame_positions, 
+                                              verbose=verbose, 
+                                              num_frames=num_frames)
+    
+    colony = {}
+    
+    if not num_workers:
+        for date, frameside_files in colony_files.items():
+            framesides = [_load_frameside(frameside_file, downsample, use_pyramid) 
+                          for frameside_file in frameside_files]
+            colony[date] = np.stack(framesides)
+        return colony
+
+    def submit_date(executor, frameside_files):
+        return [executor.submit(_load_frameside, frameside_file, downsample, 
+                                use_pyramid)
+                for frameside_file in frameside_files]
+    
+    dates = list(colony_files)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        # Only the date being stacked and the next one are read at a time
+        next_futures = None
+        if dates:
+            next_futures = submit_date(executor, colony_files[dates[0]])
+        for date_ind, date in enumerate(dates):
+            futures = next_futures
+            next_futures = None
+            if date_ind + 1 < len(dates):
+                next_futures = submit_date(executor, colony_files[dates[date_ind+1]])
+            colony[date] = np.stack([future.result() for future in futures])
     
     return colony
 
@@ -163,6 +257,7 @@ def show_colony(colony, num_classes=None, title=None):
             axs[row, column].axis('off')
     fig.suptitle(title)
     
+@instrument
 def create_class_count_df(colony, class_names):
     """ Create a dataframe with date and all class name columns and coresponding counts.
     
@@ -183,6 +278,147 @@ def create_class_count_df(colony, class_names):
     date_counts = pd.DataFrame(date_counts)
     return date_counts
 
+def get_class_count_columns(class_names):
+    """ Columns of the per frame side class count table."""
+    return ["colony_name", "experiment_type", "date", "frame", "side", *class_names]
+
+@instrument
+def get_frameside_class_counts(frameside_file, num_classes, downsample=None,
+                               use_pyramid=False):
+    """ Pixel count of each class in one frame side.
+
+    Args:
+        frameside_file: path to .npy file
+        num_classes: number of classes to count
+        downsample: count data loaded with shape / downsample (see load_colony)
+        use_pyramid: if True (and downsample) only read the pyramid level 
+            and return its saved counts, which are the exact counts of the 
+            full resolution frame side (see mask_pyramid)
+
+    Return:
+        array of num_classes counts, prints a warning if the frame side has
+        values >= num_classes (they aren't in the counts)
+    """
+    if frameside_file is None:
+        # Placeholder of 255s, which is never a class
+        return np.zeros(num_classes, dtype=np.int64)
+    if downsample and use_pyramid:
+        level = load_pyramid_level(frameside_file, downsample, counts=True)
+        counts = get_level_class_counts(level, minlength=num_classes)
+    else:
+        frameside = _load_frameside(frameside_file, downsample, use_pyramid)
+        counts = np.bincount(np.ravel(frameside), minlength=num_classes)
+    _check_unknown_classes(counts, num_classes, frameside_file)
+    return counts[:num_classes]
+
+def _check_unknown_classes(counts, num_classes, frameside_file):
+    """ Warn if counts has pixels of classes >= num_classes, which aren't counted."""
+    unknown = np.flatnonzero(counts[num_classes:]) + num_classes
+    if unknown.size:
+        print(f"Warning {frameside_file} has {counts[unknown].sum()} pixels",
+              f"with values {unknown.tolist()} >= num_classes {num_classes}.",
+              "They aren't counted."
+             )
+
+def _count_frameside_task(task):
+    frameside_file, num_classes, downsample, use_pyramid = task
+    return get_frameside_class_counts(frameside_file, num_classes, downsample,
+                                      use_pyramid)
+
+@instrument
+def build_class_count_table(root_folder, label_type, frame_positions, class_names,
+                            counts_file, colony_names=None, max_dates=None,
+                            downsample=None, use_pyramid=False, num_workers=None,
+                            verbose=True, num_frames=10):
+    """ Count every class in every frame side of every colony and save as csv.
+
+    Frame sides are read and counted one at a time in worker processes, and
+    rows are written to counts_file as each date finishes, so memory doesn't
+    grow with the number of colonies or dates. Summing the rows of a date
+    gives the counts of create_class_count_df. Frame sides without a file
+    have no row.
+
+    Args:
+        root_folder: folder with colony folders (the "nest_photos" folder)
+        label_type: name of folder that contains the .npy files
+        frame_positions: dataframe info like in 'img_to_text_df_TOEDIT.csv'
+            or FramePositionIndex
+        class_names: list of class names where the index corresponds with integer
+            value for that class in the arrays
+        counts_file: path to csv file to write
+        colony_names: colonies to count, if None use get_colony_names(root_folder)
+        max_dates: if given, only count the first max_dates dates of each colony
+        downsample: count data loaded with shape / downsample
+        use_pyramid: see get_frameside_class_counts
+        num_workers: number of processes to use. If None use os.cpu_count(),
+            if 1 don't start any extra processes.
+        verbose: if True print progress and info about missing frame data
+        num_frames: number of frames in colony
+
+    Return:
+        number of rows written
+    """
+    if not isinstance(frame_positions, FramePositionIndex):
+        frame_positions = FramePositionIndex(frame_positions, verbose=verbose)
+    if colony_names is None:
+        colony_names = get_colony_names(root_folder)
+    if num_workers is None:
+        num_workers = os.cpu_count()
+
+    def framesides():
+        for colony_name in colony_names:
+            colony_folder = os.path.join(root_folder, colony_name)
+            dates = get_dates(colony_folder)[:max_dates]
+            if verbose:
+                print(f"Counting colony: {colony_name}, {len(dates)} dates")
+            colony_files = get_colony_frameside_files(colony_folder, label_type, dates,
+                                                      frame_positions.subset(colony_name),
+                                                      verbose=verbose,
+                                                      num_frames=num_frames)
+            for date, frameside_files in colony_files.items():
+                for ind, frameside_file in enumerate(frameside_files):
+                    if frameside_file is not None:
+                        yield (colony_name, date, ind // 2 + 1, "ab"[ind % 2],
+                               frameside_file)
+
+    def tasks(frameside_infos):
+        for *_, frameside_file in frameside_infos:
+            yield (frameside_file, len(class_names), downsample, use_pyramid)
+
+    columns = get_class_count_columns(class_names)
+    num_rows = 0
+    with open(counts_file, "w", newline="") as f:
+        pd.DataFrame(columns=columns).to_csv(f, index=False)
+        frameside_infos = list(framesides())
+        if num_workers == 1:
+            executor = None
+            all_counts = map(_count_frameside_task, tasks(frameside_infos))
+        else:
+            executor = ProcessPoolExecutor(max_workers=num_workers)
+            all_counts = executor.map(_count_frameside_task, tasks(frameside_infos))
+        try:
+            rows = []
+            for frameside_ind, counts in enumerate(all_counts):
+                colony_name, date, frame_num, side, _ = frameside_infos[frameside_ind]
+                rows.append([colony_name, colony_name[:2], date, frame_num, side,
+                             *counts])
+                next_ind = frameside_ind + 1
+                date_done = (next_ind == len(frameside_infos)
+                             or frameside_infos[next_ind][:2] != (colony_name, date))
+                if date_done:
+                    pd.DataFrame(rows, columns=columns).to_csv(f, header=False,
+                                                               index=False)
+                    num_rows += len(rows)
+                    rows = []
+                    if verbose:
+                        print(f"{colony_name} {date}: {next_ind} of "
+                              f"{len(frameside_infos)} frame sides counted.")
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+    return num_rows
+
 def get_dates(colony_folder):
     """ Get list of date folders in colony_folder that can be represented as numbers.
     
@@ -0,0 +1,141 @@
+""" Fast lookup of mask filenames from frame position tables like 'img_to_text_df_TOEDIT.csv'."""
+
+import os
+
+import pandas as pd
+
+
+def _date_key(date):
+    """ Dates may be stored as int, float or string, compare them as strings."""
+    try:
+        return str(int(float(date)))
+    except (TypeError, ValueError):
+        return str(date)
+
+
+class FramePositionIndex:
+    """ (colony, date, frame, side) -> filename lookup built once from a
+    frame position table.
+
+    Only rows with frame and side info are used. If there are multiple
+    files for the same position the first one is kept and a warning is
+    printed once when the index is built.
+
+    Can be passed to the loaders in comb_loading and contents_processing
+    instead of the dataframe.
+    """
+
+    def __init__(self, frame_positions, verbose=True):
+        """
+        Args:
+            frame_positions: dataframe with columns like 'img_to_text_df_TOEDIT.csv'
+            verbose: if True print warning about duplicate positions
+        """
+        # colony -> date key -> (frame_num, side) -> filename (no extension)
+        self._filenames = {}
+        # date key -> date as stored in frame_positions
+        self._dates = {}
+        self.duplicates = []
+
+        has_frame_info = ~frame_positions['beeframe'].isna()
+        has_side_info = ~frame_positions['side'].isna()
+        organized = frame_positions.loc[has_frame_info & has_side_info]
+
+        columns = ['colony', 'date', 'beeframe', 'side', 'filename']
+        for colony_name, date, frame_num, side, filename in organized[columns].itertuples(index=False):
+            date_key = _date_key(date)
+            self._dates.setdefault(date_key, date)
+            date_filenames = self._filenames.setdefault(colony_name, {}).setdefault(date_key, {})
+            position = (int(frame_num), str(side))
+            if position in date_filenames:
+                self.duplicates.append((colony_name, date, *position))
+                continue
+            date_filenames[position] = os.path.splitext(filename)[0]
+
+        if verbose:
+            for colony_name, date, frame_num, side in self.duplicates:
+                print(f"Warning multiple images for {colony_name} {date}",
+                      f" position {frame_num} side {side}.",
+                      f"Taking first one."
+                     )
+
+    @classmethod
+    def from_csv(cls, frame_positions_file, verbose=True):
+        """ Build index from csv like 'img_to_text_df_TOEDIT.csv'."""
+        return cls(pd.read_csv(frame_positions_file), verbose=verbose)
+
+    @classmethod
+    def _from_filenames(cls, filenames, dates):
+        index = cls.__new__(cls)
+        index._filenames = filenames
+        index._dates = dates
+        index.duplicates = []
+        return index
+
+    def __len__(self):
+        return sum(len(positions) for date_filenames in self._filenames.values()
+                   for positions in date_filenames.values())
+
+    def colonies(self):
+        """ Sorted names of all colonies in index."""
+        return sorted(self._filenames)
+
+    def dates(self, colony_name=None):
+        """ Sorted dates (as stored in the table) for colony_name.
+
+        Args:
+            colony_name: name of colony, can be None if index only has one colony
+        """
+        colony_name = self._get_colony_name(colony_name)
+        dates = [self._dates[date_key] for date_key in self._filenames.get(colony_name, {})]
+        return sorted(dates)
+
+    def subset(self, colony_name=None, date=None):
+        """ Index with just one colony (and optionally one date).
+
+        Doesn't copy the table so is cheap to call for every date.
+
+        Args:
+            colony_name: name of colony, can be None if index only has one colony
+            date: if given, only keep this date
+        """
+        colony_name = self._get_colony_name(colony_name)
+        date_filenames = self._filenames.get(colony_name, {})
+        if date is not None:
+            date_key = _date_key(date)
+            date_filenames = {date_key: date_filenames.get(date_key, {})}
+        return FramePositionIndex._from_filenames({colony_name: date_filenames},
+                                                  self._dates)
+
+    def get_filename(self, frame_num, side, colony_name=None, date=None):
+        """ Get filename (with extension removed) for position.
+
+        Args:
+            frame_num: frame num for mask
+            side: frame side of mask
+            colony_name: name of colony, can be None if index only has one colony
+            date: date, can be None if index only has one date
+
+        Return:
+            filename or None if no file at that position
+        """
+        colony_name = self._get_colony_name(colony_name)
+        date_filenames = self._filenames.get(colony_name, {})
+        if date is None:
+            if len(date_filenames) != 1:
+                raise ValueError(f"date must be given, index has {len(date_filenames)} "
+                                 f"dates for colony {colony_name}."
+                                )
+            positions = next(iter(date_filenames.values()))
+        else:
+            positions = date_filenames.get(_date_key(date), {})
+        return positions.get((int(frame_num), str(side)))
+
+    def _get_colony_name(self, colony_name):
+        if colony_name is not None:
+            return colony_name
+        if len(self._filenames) != 1:
+            raise ValueError(f"colony_name must be given, index has "
+                             f"{len(self._filenames)} colonies."
+                            )
+        return next(iter(self._filenames))
@@ -0,0 +1,209 @@
+""" Disk cache of results computed from pairs of consecutive week masks."""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from comb_growth import get_perpendicular_growth_for_contours
+from mask_processing import get_class_contours, get_mask_hash
+
+
+# Default max bytes of results kept on disk by a WeekPairCache
+WEEK_PAIR_CACHE_BYTES = 4 * 1024**3
+
+
+def get_week_pair_key(mask0, mask1, analysis, params):
+    """ Cache key for result of analysis on mask0 and mask1 with params.
+
+    Args:
+        mask0: 2D mask for this week
+        mask1: 2D mask for the next week
+        analysis: name of the analysis (like 'perpendicular_growth')
+        params: dict of json serializable parameters that change the result
+    """
+    key = hashlib.sha1()
+    key.update(get_mask_hash(mask0).encode())
+    key.update(get_mask_hash(mask1).encode())
+    key.update(analysis.encode())
+    key.update(json.dumps(params, sort_keys=True).encode())
+    return key.hexdigest()
+
+
+class WeekPairCache:
+    """ Results (dicts of arrays) of week pair analyses saved as .npz files.
+
+    Keys come from get_week_pair_key so results are reused whenever the two
+    masks and parameters are the same, no matter which colony, frame or
+    week they came from. When the files are bigger than max_bytes in total,
+    the least recently used results are deleted.
+    """
+
+    def __init__(self, cache_folder, max_bytes=WEEK_PAIR_CACHE_BYTES):
+        """
+        Args:
+            cache_folder: folder to save results in
+            max_bytes: max total size of saved results
+        """
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+        os.makedirs(cache_folder, exist_ok=True)
+        # key -> (size, last use time)
+        self._files = {}
+        for entry in os.scandir(cache_folder):
+            if entry.name.endswith(".npz"):
+                stat = entry.stat()
+                self._files[entry.name[:-4]] = (stat.st_size, stat.st_mtime)
+        self.nbytes = sum(size for size, _ in self._files.values())
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, key):
+        return key in self._files
+
+    def _get_file(self, key):
+        return os.path.join(self.cache_folder, f"{key}.npz")
+
+    def get(self, key):
+        """ Return result dict for key or None if not cached."""
+        if key not in self._files:
+            return None
+        result_file = self._get_file(key)
+        try:
+            with np.load(result_file) as result:
+                result = {name: result[name] for name in result.files}
+            # Mark as recently used
+            os.utime(result_file)
+        except FileNotFoundError:
+            # Removed by another process
+            self.nbytes -= self._files.pop(key)[0]
+            return None
+        self._files[key] = (self._files[key][0], os.path.getmtime(result_file))
+        return result
+
+    def add(self, key, result):
+        """ Save result dict of arrays for key."""
+        result_file = self._get_file(key)
+        temp_file = f"{result_file}.{os.getpid()}.tmp"
+        with open(temp_file, "wb") as f:
+            np.savez(f, **result)
+        os.replace(temp_file, result_file)
+        if key in self._files:
+            self.nbytes -= self._files[key][0]
+        size = os.path.getsize(result_file)
+        self._files[key] = (size, os.path.getmtime(result_file))
+        self.nbytes += size
+        self._evict(keep=key)
+
+    def _evict(self, keep=None):
+        """ Delete least recently used results until under max_bytes."""
+        if self.nbytes <= self.max_bytes:
+            return
+        for key in sorted(self._files, key=lambda key: self._files[key][1]):
+            if self.nbytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            try:
+                os.remove(self._get_file(key))
+            except FileNotFoundError:
+                pass
+            self.nbytes -= self._files.pop(key)[0]
+
+    def clear(self):
+        for key in list(self._files):
+            try:
+                os.remove(self._get_file(key))
+            except FileNotFoundError:
+                pass
+        self._files.clear()
+        self.nbytes = 0
+
+    def get_or_compute(self, mask0, mask1, analysis, params, compute):
+        """ Cached result of compute(mask0, mask1, **params).
+
+        Args:
+            mask0: 2D mask for this week
+            mask1: 2D mask for the next week
+            analysis: name of the analysis
+            params: dict of parameters passed to compute (part of the key)
+            compute: function returning dict of arrays
+
+        Return:
+            result dict
+        """
+        key = get_week_pair_key(mask0, mask1, analysis, params)
+        result = self.get(key)
+        if result is None:
+            result = compute(mask0, mask1, **params)
+            self.add(key, result)
+        return result
+
+
+def _perpendicular_growth_result(mask0, mask1, step_size, target, background,
+                                 num_points, spacing):
+    """ get_perpendicular_growth_for_contours on target contours of mask0
+    as a dict of arrays that can be cached."""
+    contours = get_class_contours(mask0, class_id=target)
+    growth = get_perpendicular_growth_for_contours(mask0, mask1, contours,
+                                                   step_size, target, background,
+                                                   num_points, spacing)
+    lengths = np.array([len(distances) for _, distances in growth], dtype=int)
+    if len(growth) == 0:
+        return {"points": np.zeros((0, 2), dtype=int),
+                "distances": np.zeros(0),
+                "lengths": lengths
+               }
+    return {"points": np.concatenate([points for points, _ in growth]),
+            "distances": np.concatenate([distances for _, distances in growth]),
+            "lengths": lengths
+           }
+
+def get_colony_perpendicular_growth(colony, step_size, target, background,
+                                    num_points, spacing=1, cache=None):
+    """ Perpendicular growth from every target contour in every frame to the
+    same frame the next week.
+
+    Args:
+        colony: WxFxHxW colony array (can be LazyColony)
+        step_size: how far along line to look for next intersection
+        target: comb value in mask
+        background: background value in mask
+        num_points: how many points to average on each size when calculating tangent
+        spacing: use every spacing'th point on each contour
+        cache: WeekPairCache (or path to its folder) so only week pairs that
+            changed are computed
+
+    Return:
+        dict with (week, frame) keys and lists of (points, distances) for
+        each contour of get_class_contours(colony[week, frame], target)
+        as values (see get_perpendicular_growth_for_contours)
+    """
+    if isinstance(cache, str):
+        cache = WeekPairCache(cache)
+    params = {"step_size": step_size,
+              "target": target,
+              "background": background,
+              "num_points": num_points,
+              "spacing": spacing
+             }
+
+    growth = {}
+    for week in range(len(colony) - 1):
+        for frame in range(colony.shape[1]):
+            mask0 = np.asarray(colony[week, frame])
+            mask1 = np.asarray(colony[week+1, frame])
+            if cache is None:
+                result = _perpendicular_growth_result(mask0, mask1, **params)
+            else:
+                result = cache.get_or_compute(mask0, mask1, "perpendicular_growth",
+                                              params, _perpendicular_growth_result)
+            if len(result['lengths']) == 0:
+                growth[(week, frame)] = []
+                continue
+            splits = np.cumsum(result['lengths'])[:-1]
+            growth[(week, frame)] = list(zip(np.split(result['points'], splits),
+                                             np.split(result['distances'], splits)))
+    return growth
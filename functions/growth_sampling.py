@@ -0,0 +1,254 @@
+""" Build datasets of random points in empty frame space and whether comb grows there."""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from growth_cache import WeekPairCache, get_week_pair_key
+from mask_processing import ClassDistanceField, get_interior_mask, get_mask_hash
+
+
+def get_growth_dataset_columns():
+    return ["colony",
+            "type",
+            "week",
+            "frame_position",
+            "growth",
+            "wood_distance",
+            "comb_distance"
+           ]
+
+def sample_growth_groups(colonies, num_points, seed=None):
+    """ Choose colony, week and frame for each of num_points samples and
+    group the samples that share the same frame.
+
+    Each sample chooses a colony, then a week (not the last week since
+    we don't know about future growth there), then a frame, all uniformly.
+
+    Args:
+        colonies: list of dicts with keys 'colony' (WxFxHxW array),
+            'type' and 'name'
+        num_points: number of samples
+        seed: seed for the random choices
+
+    Return:
+        list of (colony_ind, week, frame_num, num_samples, seed_sequence)
+        sorted by colony_ind, week, frame_num. Every group gets its own
+        independent seed_sequence for choosing points within the frame.
+    """
+
+    seed_sequence = np.random.SeedSequence(seed)
+    group_seed, *_ = seed_sequence.spawn(1)
+    rng = np.random.default_rng(group_seed)
+
+    num_weeks = np.array([len(colony_dict['colony']) for colony_dict in colonies])
+    num_frames = np.array([colony_dict['colony'].shape[1] for colony_dict in colonies])
+
+    colony_inds = rng.integers(len(colonies), size=num_points)
+    # -1 so we don't choose the last week where we don't know about future growth
+    weeks = (rng.random(num_points) * (num_weeks[colony_inds] - 1)).astype(int)
+    frame_nums = (rng.random(num_points) * num_frames[colony_inds]).astype(int)
+
+    groups, counts = np.unique(np.stack([colony_inds, weeks, frame_nums], axis=1),
+                               axis=0, return_counts=True)
+    point_seeds = seed_sequence.spawn(len(groups))
+
+    return [(int(colony_ind), int(week), int(frame_num), int(count), point_seed)
+            for (colony_ind, week, frame_num), count, point_seed
+            in zip(groups, counts, point_seeds)
+           ]
+
+def sample_growth_in_frame(mask0, mask1, num_samples, seed, comb_class=2,
+                           wood_class=1, interior_mask=None):
+    """ Sample points in empty space within frame and record distances to
+    comb and wood and if there is comb at that point in the next week.
+
+    Args:
+        mask0: 2D comb mask for this week
+        mask1: 2D comb mask for the next week
+        num_samples: how many points to sample
+        seed: seed or np.random.SeedSequence for choosing points
+        comb_class: value of comb in mask
+        wood_class: value of wood in mask
+        interior_mask: 2D mask with 1 inside frame, if None use
+            get_interior_mask on mask0
+
+    Return:
+        dict with 'growth', 'wood_distance' and 'comb_distance' arrays.
+        Arrays are empty if there is no comb (or no empty space) in mask0.
+    """
+    rng = np.random.default_rng(seed)
+    if interior_mask is None:
+        interior_mask = get_interior_mask(mask0, wood_class)
+
+    empty_inds = np.flatnonzero((mask0 == 0) & (interior_mask > 0))
+    comb_field = ClassDistanceField(mask0, comb_class)
+    if empty_inds.size == 0 or not comb_field.has_class:
+        # no comb present yet in this frame so ignore for this initial analysis
+        empty = np.zeros(0)
+        return {"growth": empty.astype(int),
+                "wood_distance": empty,
+                "comb_distance": empty
+               }
+
+    points = empty_inds[rng.integers(empty_inds.size, size=num_samples)]
+    points = np.stack(np.unravel_index(points, mask0.shape), axis=1)
+
+    comb_distance, _ = comb_field.query(points, exact_positions=False)
+    wood_field = ClassDistanceField(mask0, wood_class)
+    wood_distance, _ = wood_field.query(points, exact_positions=False)
+
+    # Is there comb next week
+    growth = (mask1[points[:, 0], points[:, 1]] == comb_class).astype(int)
+
+    return {"growth": growth,
+            "wood_distance": wood_distance,
+            "comb_distance": comb_distance
+           }
+
+def _get_seed_params(seed):
+    """ json serializable version of seed (int, None or np.random.SeedSequence)."""
+    if isinstance(seed, np.random.SeedSequence):
+        return {"entropy": seed.entropy, 
+                "spawn_key": list(seed.spawn_key),
+                "pool_size": seed.pool_size
+               }
+    return seed
+
+def _sample_growth_group(task):
+    """ Run sample_growth_in_frame for one group (unless its samples are
+    cached) and return its rows, cache key and the new samples (None if
+    they were cached)."""
+    (colony_name, colony_type, week, frame_num, num_samples, seed, kwargs, 
+     cache_key, samples) = task
+    new_samples = None
+    if samples is None:
+        samples = sample_growth_in_frame(num_samples=num_samples, seed=seed, 
+                                         **kwargs)
+        new_samples = samples
+    rows = pd.DataFrame({"colony": colony_name,
+                         "type": colony_type,
+                         "week": week,
+                         "frame_position": frame_num,
+                         **samples
+                        }, columns=get_growth_dataset_columns())
+    return rows, cache_key, new_samples
+
+def _map_in_order(executor, function, tasks, max_pending):
+    """ Like executor.map, but only keep max_pending tasks submitted at once
+    so the inputs of all tasks aren't held in memory together."""
+    pending = []
+    for task in tasks:
+        pending.append(executor.submit(function, task))
+        if len(pending) >= max_pending:
+            yield pending.pop(0).result()
+    for future in pending:
+        yield future.result()
+
+def build_growth_dataset(colonies, num_points, dataset_file, comb_class=2,
+                         wood_class=1, interior_mask=None, seed=None,
+                         num_workers=None, verbose=True, cache=None
+                        ):
+    """ Build dataset of random empty points within frames with distance to
+    comb and wood and if comb grows there in the next week. Save as csv.
+
+    Samples that fall on the same colony, week and frame are done together
+    so the empty space and distance transforms are only computed once per
+    frame. Each group uses its own random stream derived from seed, so the
+    dataset is the same for any num_workers. Rows are written to
+    dataset_file as groups finish.
+
+    Like the original notebook, samples from frames with no comb are dropped,
+    so the dataset can have fewer than num_points rows.
+
+    Args:
+        colonies: list of dicts with keys 'colony' (WxFxHxW array),
+            'type' and 'name'
+        num_points: number of points to sample
+        dataset_file: path to csv file to write
+        comb_class: value of comb in masks
+        wood_class: value of wood in masks
+        interior_mask: 2D mask with 1 inside frame used for all frames.
+            If None, use get_interior_mask on each frame.
+        seed: seed for the random choices
+        num_workers: number of processes to use. If None use os.cpu_count(),
+            if 1 don't start any extra processes.
+        verbose: if True print progress
+        cache: WeekPairCache (or path to its folder) so frames whose masks,
+            samples and parameters are the same as a previous run aren't
+            sampled again
+
+    Return:
+        number of rows written
+    """
+
+    valid_colonies = []
+    for colony_dict in colonies:
+        if len(colony_dict['colony']) < 2:
+            if verbose:
+                print(f"skipping colony {colony_dict['name']}, needs at least two weeks.")
+            continue
+        valid_colonies.append(colony_dict)
+
+    groups = sample_growth_groups(valid_colonies, num_points, seed)
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    if isinstance(cache, str):
+        cache = WeekPairCache(cache)
+    interior_hash = None
+    if cache is not None and interior_mask is not None:
+        interior_hash = get_mask_hash(interior_mask)
+
+    def tasks():
+        for colony_ind, week, frame_num, num_samples, point_seed in groups:
+            colony_dict = valid_colonies[colony_ind]
+            colony = colony_dict['colony']
+            mask0 = np.asarray(colony[week, frame_num])
+            mask1 = np.asarray(colony[week+1, frame_num])
+            cache_key = None
+            samples = None
+            if cache is not None:
+                params = {"num_samples": num_samples,
+                          "seed": _get_seed_params(point_seed),
+                          "comb_class": comb_class,
+                          "wood_class": wood_class,
+                          "interior_mask": interior_hash
+                         }
+                cache_key = get_week_pair_key(mask0, mask1, "growth_samples", params)
+                samples = cache.get(cache_key)
+            kwargs = None
+            if samples is None:
+                kwargs = {"mask0": mask0,
+                          "mask1": mask1,
+                          "comb_class": comb_class,
+                          "wood_class": wood_class,
+                          "interior_mask": interior_mask
+                         }
+            yield (colony_dict['name'], colony_dict['type'], week, frame_num,
+                   num_samples, point_seed, kwargs, cache_key, samples)
+
+    num_rows = 0
+    with open(dataset_file, "w", newline="") as f:
+        pd.DataFrame(columns=get_growth_dataset_columns()).to_csv(f, index=False)
+        if num_workers == 1:
+            group_rows = map(_sample_growth_group, tasks())
+            executor = None
+        else:
+            executor = ProcessPoolExecutor(max_workers=num_workers)
+            group_rows = _map_in_order(executor, _sample_growth_group, tasks(),
+                                       max_pending=2*num_workers)
+        try:
+            for group_ind, (rows, cache_key, new_samples) in enumerate(group_rows):
+                if cache is not None and new_samples is not None:
+                    cache.add(cache_key, new_samples)
+                rows.to_csv(f, header=False, index=False)
+                num_rows += len(rows)
+                if verbose and (group_ind + 1) % 100 == 0:
+                    print(f"{group_ind+1} of {len(groups)} frames, {num_rows} points.")
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+    return num_rows
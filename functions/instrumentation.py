@@ -0,0 +1,201 @@
+""" Opt-in call counts, wall time, bytes read and peak memory of instrumented functions.
+
+Off by default. Functions decorated with instrument only check a flag
+until enable is called (or the COLONY3D_INSTRUMENT environment variable
+is set to 1 before import).
+
+    import instrumentation
+    with instrumentation.profile("profile.json"):
+        colony = load_colony_comb(...)
+
+Times, bytes read and peaks include nested instrumented calls. Bytes read
+and peaks are counted for the whole process (including worker threads)
+while the call is running, but not in worker processes.
+"""
+
+import csv
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+_enabled = os.environ.get("COLONY3D_INSTRUMENT") == "1"
+_trace_memory = False
+# If tracemalloc was started by enable (so disable should stop it)
+_started_tracemalloc = False
+_lock = threading.Lock()
+# name -> {"calls", "seconds", "max_seconds", "bytes_read", "peak_bytes"}
+_records = {}
+# Total bytes read while enabled, see record_file_read
+_bytes_read = 0
+# [memory at start, peak so far] of every running call (in any thread)
+_active_peaks = []
+
+
+def get_report_columns():
+    return ["name", "calls", "seconds", "mean_seconds", "max_seconds",
+            "bytes_read", "peak_bytes"]
+
+def enable(trace_memory=False):
+    """ Start recording instrumented calls.
+
+    Args:
+        trace_memory: if True also record peak memory allocated during each
+            call with tracemalloc (only allocations Python knows about, like
+            numpy arrays). Makes allocation a lot slower.
+    """
+    global _enabled, _trace_memory, _started_tracemalloc
+    _trace_memory = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracemalloc = True
+    _enabled = True
+
+def disable():
+    """ Stop recording (keeps what was recorded)."""
+    global _enabled, _trace_memory, _started_tracemalloc
+    _enabled = False
+    _trace_memory = False
+    with _lock:
+        _active_peaks.clear()
+    if _started_tracemalloc:
+        tracemalloc.stop()
+        _started_tracemalloc = False
+
+def is_enabled():
+    return _enabled
+
+def reset():
+    """ Remove everything recorded."""
+    global _bytes_read
+    with _lock:
+        _records.clear()
+        _bytes_read = 0
+
+def record_file_read(file):
+    """ Count size of file as read (if enabled)."""
+    global _bytes_read
+    if not _enabled:
+        return
+    num_bytes = os.path.getsize(file)
+    with _lock:
+        _bytes_read += num_bytes
+
+def _update_peaks():
+    """ Add peak since last reset to every running call and reset it.
+    Call with _lock held."""
+    _, peak = tracemalloc.get_traced_memory()
+    for call_peak in _active_peaks:
+        call_peak[1] = max(call_peak[1], peak)
+    tracemalloc.reset_peak()
+
+def _start_peak():
+    """ Start tracking peak memory of a call, returns its entry for _stop_peak."""
+    with _lock:
+        _update_peaks()
+        current, _ = tracemalloc.get_traced_memory()
+        call_peak = [current, current]
+        _active_peaks.append(call_peak)
+    return call_peak
+
+def _stop_peak(call_peak):
+    """ Peak traced memory above what was allocated when call_peak started."""
+    with _lock:
+        _update_peaks()
+        # Remove this exact entry, another call may have the same values
+        for ind, entry in enumerate(_active_peaks):
+            if entry is call_peak:
+                del _active_peaks[ind]
+                break
+    return call_peak[1] - call_peak[0]
+
+def _add_record(name, seconds, bytes_read, peak_bytes):
+    with _lock:
+        record = _records.setdefault(name, {"calls": 0,
+                                            "seconds": 0.0,
+                                            "max_seconds": 0.0,
+                                            "bytes_read": 0,
+                                            "peak_bytes": 0
+                                           })
+        record['calls'] += 1
+        record['seconds'] += seconds
+        record['max_seconds'] = max(record['max_seconds'], seconds)
+        record['bytes_read'] += bytes_read
+        record['peak_bytes'] = max(record['peak_bytes'], peak_bytes)
+
+def instrument(function):
+    """ Decorator that records calls of function while enabled.
+
+    Recorded as module.function name.
+    """
+    name = f"{function.__module__}.{function.__qualname__}"
+
+    @functools.wraps(function)
+    def instrumented(*args, **kwargs):
+        if not _enabled:
+            return function(*args, **kwargs)
+        call_peak = None
+        if _trace_memory:
+            call_peak = _start_peak()
+        start_bytes = _bytes_read
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            peak_bytes = 0
+            if call_peak is not None and tracemalloc.is_tracing():
+                peak_bytes = _stop_peak(call_peak)
+            _add_record(name, seconds, _bytes_read - start_bytes, peak_bytes)
+    return instrumented
+
+def get_report():
+    """ Recorded calls as list of dicts (see get_report_columns),
+    slowest total time first."""
+    with _lock:
+        report = [{"name": name,
+                   "calls": record['calls'],
+                   "seconds": record['seconds'],
+                   "mean_seconds": record['seconds'] / record['calls'],
+                   "max_seconds": record['max_seconds'],
+                   "bytes_read": record['bytes_read'],
+                   "peak_bytes": record['peak_bytes']
+                  } for name, record in _records.items()]
+    return sorted(report, key=lambda row: row['seconds'], reverse=True)
+
+def save_report(report_file):
+    """ Save get_report as .json (with run info) or .csv."""
+    report = get_report()
+    if os.path.splitext(report_file)[1] == ".csv":
+        with open(report_file, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=get_report_columns())
+            writer.writeheader()
+            writer.writerows(report)
+        return
+    with open(report_file, "w") as f:
+        json.dump({"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "pid": os.getpid(),
+                   "trace_memory": _trace_memory,
+                   "functions": report
+                  }, f, indent=2)
+
+@contextmanager
+def profile(report_file=None, trace_memory=True):
+    """ Record instrumented calls made inside with block.
+
+    Args:
+        report_file: if given, save report here (.json or .csv) at the end
+        trace_memory: see enable
+    """
+    reset()
+    enable(trace_memory)
+    try:
+        yield
+    finally:
+        if report_file is not None:
+            save_report(report_file)
+        disable()
@@ -0,0 +1,316 @@
+""" Colony arrays (days x frames x height x width) that only load frames when they are used."""
+
+from collections import OrderedDict
+
+import numpy as np
+
+from comb_loading import load_colony_comb_frame
+from colony_store import load_colony_store
+from contents_processing import get_colony_frameside_files, _load_frameside
+from frame_positions import FramePositionIndex
+
+
+# Default max bytes of frames kept in memory by a LazyColony
+DEFAULT_FRAME_CACHE_BYTES = 1024**3
+
+
+class FrameCache:
+    """ Least recently used cache of frames with a max total size in bytes."""
+
+    def __init__(self, max_bytes=DEFAULT_FRAME_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._frames = OrderedDict()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def get(self, key):
+        frame = self._frames.get(key)
+        if frame is not None:
+            self._frames.move_to_end(key)
+        return frame
+
+    def add(self, key, frame):
+        if key in self._frames:
+            self.nbytes -= self._frames.pop(key).nbytes
+        self._frames[key] = frame
+        self.nbytes += frame.nbytes
+        # Always keep the newest frame, even if it is bigger than max_bytes
+        while self.nbytes > self.max_bytes and len(self._frames) > 1:
+            _, removed = self._frames.popitem(last=False)
+            self.nbytes -= removed.nbytes
+
+    def clear(self):
+        self._frames.clear()
+        self.nbytes = 0
+
+
+def _get_inds(key, length):
+    """ Turn int, slice or list key into list of positive indices.
+    Return int for int key."""
+    if isinstance(key, (int, np.integer)):
+        if key < -length or key >= length:
+            raise IndexError(f"index {key} is out of bounds for size {length}")
+        return int(key) % length
+    if isinstance(key, slice):
+        return list(range(length))[key]
+    inds = np.arange(length)[key]
+    return inds.tolist()
+
+
+class LazyColony:
+    """ Array like colony (days x frames x height x width) that loads frames
+    on demand and keeps recently used frames in a FrameCache.
+
+    Supports colony[day, frame] (2D array), colony[day] (LazyDay),
+    colony[start:stop] (LazyColony of those days, sharing the cache),
+    len, shape and iteration over days, so functions like visualize_colony
+    and create_colonies_summary work in constant memory.
+
+    Frames returned are read only since they may be shared through the cache.
+    """
+
+    def __init__(self, load_frame, num_days, num_frames, frame_shape=None,
+                 dtype=np.uint8, dates=None, cache_bytes=DEFAULT_FRAME_CACHE_BYTES,
+                 cache=None, day_inds=None):
+        """
+        Args:
+            load_frame: function taking (day_ind, frame_ind) and returning 2D array
+            num_days: number of days load_frame can load
+            num_frames: number of frames each day
+            frame_shape: (height, width), if None load the first frame to find it
+            dtype: dtype of frames
+            dates: list of dates, one for each day
+            cache_bytes: max bytes of frames to keep in memory
+            cache: existing FrameCache to share (cache_bytes is ignored)
+            day_inds: which of load_frame's days this colony uses
+        """
+        self._load_frame = load_frame
+        self._num_frames = num_frames
+        if day_inds is None:
+            day_inds = list(range(num_days))
+        self._day_inds = list(day_inds)
+        self._all_dates = dates
+        if cache is None:
+            cache = FrameCache(cache_bytes)
+        self.cache = cache
+        self.dtype = np.dtype(dtype)
+        self._frame_shape = frame_shape
+
+    @classmethod
+    def from_colony_comb(cls, beeframe_meta, colony_name, folder_root,
+                         masks_folder_name, combine_ab, mirror_b=False,
+                         cache_bytes=DEFAULT_FRAME_CACHE_BYTES, num_frames=10,
+                         transforms=None, aligned_shape=None):
+        """ Lazy version of load_colony_comb.
+
+        Like load_colony_comb, only uses dates until the first date with
+        missing frame info (found from the frame positions, not the files).
+
+        Args:
+            beeframe_meta: dataframe info like in 'img_to_text_df_TOEDIT.csv'
+                or FramePositionIndex
+            colony_name: name of colony
+            folder_root: path to the "nest_photos" folder
+            masks_folder_name: name of the folder the masks that should be loaded are in.
+            combine_ab: see load_colony_comb
+            mirror_b: see load_colony_comb
+            cache_bytes: max bytes of frames to keep in memory
+            num_frames: number of frames in colony
+            transforms: see load_colony_comb
+            aligned_shape: see load_colony_comb
+
+        Return:
+            LazyColony or None if no dates have frame info
+        """
+        if not isinstance(beeframe_meta, FramePositionIndex):
+            beeframe_meta = FramePositionIndex(beeframe_meta, verbose=False)
+        colony_df = beeframe_meta.subset(colony_name)
+
+        sides = ['a', 'b'] if combine_ab else ['a']
+        dates = []
+        for date in colony_df.dates():
+            frames_found = [any(colony_df.get_filename(frame_num, side, date=date)
+                                is not None for side in sides)
+                            for frame_num in range(1, num_frames+1)]
+            if not all(frames_found):
+                print(f"Colony is missing frame info on {date}. "
+                      f"Using days until this point.")
+                break
+            dates.append(date)
+        if len(dates) == 0:
+            return None
+
+        def load_frame(day_ind, frame_ind):
+            return load_colony_comb_frame(colony_df, dates[day_ind], frame_ind+1,
+                                          folder_root, masks_folder_name,
+                                          combine_ab, mirror_b, transforms,
+                                          aligned_shape)
+
+        return cls(load_frame, len(dates), num_frames, dates=dates,
+                   cache_bytes=cache_bytes)
+
+    @classmethod
+    def from_colony_contents(cls, colony_folder, label_type, dates,
+                             colony_frame_positions, downsample=None,
+                             verbose=True, cache_bytes=DEFAULT_FRAME_CACHE_BYTES,
+                             num_frames=10, use_pyramid=False):
+        """ Lazy version of contents_processing.load_colony with days as
+        the first axis and the 20 frame sides as frames.
+
+        Args:
+            colony_folder: path folder containing colony data in date subfolders
+            label_type: name of folder that contains the .npy files
+            dates: list of dates
+            colony_frame_positions: dataframe info like in 'img_to_text_df_TOEDIT.csv'
+                but just for one colony. Or FramePositionIndex subset to one colony.
+            downsample: load data arrays with shape / downsample
+            verbose: if True print info about missing frame data
+            cache_bytes: max bytes of frames to keep in memory
+            num_frames: number of frames in colony
+            use_pyramid: see contents_processing.load_colony
+        """
+        colony_files = get_colony_frameside_files(colony_folder, label_type, dates,
+                                                  colony_frame_positions,
+                                                  verbose=verbose,
+                                                  num_frames=num_frames)
+        colony_files = [colony_files[date] for date in dates]
+
+        def load_frame(day_ind, frame_ind):
+            return _load_frameside(colony_files[day_ind][frame_ind], downsample,
+                                   use_pyramid)
+
+        return cls(load_frame, len(dates), 2*num_frames, dates=list(dates),
+                   cache_bytes=cache_bytes)
+
+    @classmethod
+    def from_store(cls, store_file, cache_bytes=DEFAULT_FRAME_CACHE_BYTES):
+        """ LazyColony reading from colony store file (see colony_store)."""
+        store, header = load_colony_store(store_file)
+
+        def load_frame(day_ind, frame_ind):
+            return np.array(store[day_ind, frame_ind])
+
+        return cls(load_frame, store.shape[0], store.shape[1],
+                   frame_shape=store.shape[2:], dtype=store.dtype,
+                   dates=header['dates'], cache_bytes=cache_bytes)
+
+    @property
+    def dates(self):
+        if self._all_dates is None:
+            return None
+        return [self._all_dates[day_ind] for day_ind in self._day_inds]
+
+    @property
+    def frame_shape(self):
+        if self._frame_shape is None:
+            self._frame_shape = self.get_frame(0, 0).shape
+        return tuple(self._frame_shape)
+
+    @property
+    def shape(self):
+        return (len(self._day_inds), self._num_frames, *self.frame_shape)
+
+    @property
+    def ndim(self):
+        return 4
+
+    def __len__(self):
+        return len(self._day_inds)
+
+    def __iter__(self):
+        for day_ind in range(len(self)):
+            yield LazyDay(self, day_ind)
+
+    def get_frame(self, day_ind, frame_ind):
+        """ 2D frame at day_ind (in this colony) and frame_ind."""
+        key = (self._day_inds[day_ind], frame_ind)
+        frame = self.cache.get(key)
+        if frame is None:
+            frame = self._load_frame(*key)
+            if frame is None:
+                raise RuntimeError(f"No valid info for day {day_ind} frame {frame_ind}.")
+            frame = np.asarray(frame)
+            frame.flags.writeable = False
+            self.cache.add(key, frame)
+        return frame
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if key and key[0] is Ellipsis:
+            key = (slice(None),) * (5 - len(key)) + key[1:]
+        day_key, frame_key, rest = key[0], None, key[1:]
+        if len(rest) > 0:
+            frame_key, rest = rest[0], rest[1:]
+
+        day_inds = _get_inds(day_key, len(self))
+        if frame_key is None:
+            if isinstance(day_inds, int):
+                return LazyDay(self, day_inds)
+            return LazyColony(self._load_frame, None, self._num_frames,
+                              frame_shape=self._frame_shape, dtype=self.dtype,
+                              dates=self._all_dates, cache=self.cache,
+                              day_inds=[self._day_inds[ind] for ind in day_inds])
+
+        frame_inds = _get_inds(frame_key, self._num_frames)
+        if isinstance(day_inds, int) and isinstance(frame_inds, int):
+            return self.get_frame(day_inds, frame_inds)[rest]
+        if isinstance(day_inds, int):
+            return np.stack([self.get_frame(day_inds, frame_ind)[rest]
+                             for frame_ind in frame_inds])
+        if isinstance(frame_inds, int):
+            return np.stack([self.get_frame(day_ind, frame_inds)[rest]
+                             for day_ind in day_inds])
+        return np.stack([np.stack([self.get_frame(day_ind, frame_ind)[rest]
+                                   for frame_ind in frame_inds])
+                         for day_ind in day_inds])
+
+    def __array__(self, dtype=None, copy=None):
+        colony = self[:, :]
+        if dtype is not None:
+            colony = colony.astype(dtype)
+        return colony
+
+    def __repr__(self):
+        return f"LazyColony(shape={self.shape}, cached_frames={len(self.cache)})"
+
+
+class LazyDay:
+    """ One day of a LazyColony (frames x height x width). Frames are loaded
+    when indexed or iterated."""
+
+    def __init__(self, colony, day_ind):
+        self.colony = colony
+        self.day_ind = day_ind
+
+    @property
+    def shape(self):
+        return self.colony.shape[1:]
+
+    @property
+    def dtype(self):
+        return self.colony.dtype
+
+    @property
+    def ndim(self):
+        return 3
+
+    def __len__(self):
+        return self.colony.shape[1]
+
+    def __iter__(self):
+        for frame_ind in range(len(self)):
+            yield self.colony.get_frame(self.day_ind, frame_ind)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        return self.colony[(self.day_ind, *key)]
+
+    def __array__(self, dtype=None, copy=None):
+        day = self[:]
+        if dtype is not None:
+            day = day.astype(dtype)
+        return day
@@ -1,7 +1,22 @@
+import hashlib
+from collections import OrderedDict
+
 import numpy as np
 import cv2
+from scipy import ndimage
+
+from instrumentation import instrument
+
+
+# Max total bytes of ClassDistanceField objects kept by get_class_distance_field
+DISTANCE_FIELD_CACHE_BYTES = 1024**3
+_distance_field_cache = OrderedDict()
+# Max number of (mask, class) contour results kept by extract_class_contours
+CLASS_CONTOURS_CACHE_SIZE = 1024
+_class_contours_cache = OrderedDict()
 
 
+@instrument
 def get_class_contours(mask, class_id):
     """ Get contours for class_id in mask. 
     
@@ -11,22 +26,262 @@ def get_class_contours(mask, class_id):
     Return:
         list of cv2 contours
     """
-    class_mask = np.where(mask==class_id, 1, 0)
-    class_mask = class_mask.astype(np.uint8)
-    contours, hierarchy = cv2.findContours(class_mask, 
-                                           cv2.RETR_TREE, 
-                                           cv2.CHAIN_APPROX_NONE
-                                          )
-    
+    contours, _ = _find_class_contours(mask, class_id)
     return contours
 
-def get_distance_to_class(point, mask, class_id):
+def _find_class_contours(mask, class_id):
+    # bool and uint8 have the same layout so cv2 can use the comparison directly
+    class_mask = (mask == class_id).view(np.uint8)
+    return cv2.findContours(class_mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
+
+def _copy_contours(contours, hierarchy):
+    return (tuple(contour.copy() for contour in contours), 
+            None if hierarchy is None else hierarchy.copy())
+
+@instrument
+def extract_class_contours(mask, class_ids, mask_hash=None):
+    """ Get contours and hierarchy (cv2.RETR_TREE) for several classes in mask.
+    
+    Each class is traced with its own cv2.findContours call (on a uint8 
+    view of mask == class_id, so no int64 copy of the mask). If mask_hash
+    is given, results are cached on it and the class id, so tracing the 
+    same boundaries again is free. Keeps the CLASS_CONTOURS_CACHE_SIZE most
+    recently used. The caller is responsible for mask_hash matching the 
+    current mask values. Cached results are returned as copies.
+    
+    Args:
+        mask: 2D numpy array
+        class_ids: values of classes of interest in mask
+        mask_hash: get_mask_hash(mask) to cache the results on, if None 
+            the contours are always traced
+        
+    Return:
+        dict with class ids as keys and (contours, hierarchy) as values
+    """
+    if mask_hash is None:
+        return {class_id: _find_class_contours(mask, class_id) 
+                for class_id in class_ids}
+    class_contours = {}
+    for class_id in class_ids:
+        key = (mask_hash, class_id)
+        if key in _class_contours_cache:
+            _class_contours_cache.move_to_end(key)
+        else:
+            _class_contours_cache[key] = _find_class_contours(mask, class_id)
+        class_contours[class_id] = _copy_contours(*_class_contours_cache[key])
+    while len(_class_contours_cache) > CLASS_CONTOURS_CACHE_SIZE:
+        _class_contours_cache.popitem(last=False)
+    return class_contours
+
+@instrument
+def get_colony_class_contours(colony, class_ids):
+    """ extract_class_contours for every frame of colony.
+    
+    Args:
+        colony: WxFxHxW colony array (can be LazyColony)
+        class_ids: values of classes of interest in masks
+        
+    Return:
+        dict with (week, frame) keys and extract_class_contours dicts as values
+    """
+    colony_contours = {}
+    for week, week_frames in enumerate(colony):
+        for frame, mask in enumerate(week_frames):
+            colony_contours[(week, frame)] = extract_class_contours(np.asarray(mask), 
+                                                                    class_ids)
+    return colony_contours
+
+def clear_class_contours_cache():
+    """ Remove all cached contours."""
+    _class_contours_cache.clear()
+
+def get_mask_hash(mask):
+    """ Return hash of mask values (and shape and dtype) as hex string.
+    
+    Args:
+        mask: numpy array
+    """
+    mask = np.ascontiguousarray(mask)
+    mask_hash = hashlib.sha1()
+    mask_hash.update(f"{mask.shape}{mask.dtype.str}".encode())
+    mask_hash.update(mask.reshape(-1).view(np.uint8))
+    return mask_hash.hexdigest()
+
+
+class ClassDistanceField:
+    """ Euclidean distance transform to class_id in a mask with the
+    position of the nearest class_id pixel for every pixel.
+    
+    Build once, then query as many points as needed. Use 
+    get_class_distance_field to get a cached instance.
+    
+    Attributes:
+        class_id: value of class of interest in mask
+        shape: shape of the mask
+        has_class: False if class_id isn't in mask
+        nearest_index: flat index of nearest class_id pixel for every pixel
+            (None if has_class is False)
+        nbytes: memory used by the field
+    """
+    
+    def __init__(self, mask, class_id):
+        self.class_id = class_id
+        self.shape = mask.shape
+        self._class_mask = mask == class_id
+        self.has_class = bool(self._class_mask.any())
+        self.nearest_index = None
+        if self.has_class:
+            indices = ndimage.distance_transform_edt(~self._class_mask, 
+                                                     return_distances=False,
+                                                     return_indices=True
+                                                    )
+            index_dtype = np.int32 if mask.size < 2**31 else np.int64
+            self.nearest_index = np.ravel_multi_index(tuple(indices), 
+                                                      self.shape
+                                                     ).astype(index_dtype)
+        self.nbytes = self._class_mask.nbytes
+        if self.nearest_index is not None:
+            self.nbytes += self.nearest_index.nbytes
+    
+    def query(self, points, exact_positions=True):
+        """ Closest distance from each point to class_id and that position.
+        
+        Args:
+            points: n x 2 (i, j) numpy indexing (from top left: (row, column))
+            exact_positions: when several class_id pixels are equally close, 
+                return the first in row major order (like get_distance_to_class).
+                If False, return whichever the distance transform found, 
+                which is faster. Distances are the same either way.
+            
+        Return:
+            distances: n float array (nan if class_id not in mask)
+            positions: n x 2 int array (-1 if class_id not in mask)
+        """
+        points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+        if not self.has_class:
+            return (np.full(points.shape[0], np.nan), 
+                    np.full(points.shape, -1, dtype=np.int64)
+                   )
+        flat_index = self.nearest_index[points[:, 0], points[:, 1]]
+        positions = np.stack(np.unravel_index(flat_index, self.shape), axis=1)
+        squared_distances = np.sum((positions - points) ** 2, axis=1)
+        if exact_positions:
+            positions = self._first_equally_close(points, positions, 
+                                                  squared_distances)
+        distances = np.sqrt(squared_distances.astype(float))
+        return distances, positions
+    
+    def _first_equally_close(self, points, positions, squared_distances):
+        """ For each point, the first class_id pixel in row major order that
+        is exactly as close as the pixel in positions.
+        
+        Checks every row from the top of the circle around each point down
+        to the row of the known closest pixel, looking at the (at most two)
+        pixels on that row at exactly that distance.
+        """
+        positions = positions.copy()
+        radius = _integer_sqrt(squared_distances)
+        first_rows = points[:, 0] - radius
+        num_rows = positions[:, 0] - first_rows + 1
+        
+        active = np.flatnonzero(squared_distances > 0)
+        # Limit how many (point, row) pairs are checked at once
+        chunk_ends = np.searchsorted(np.cumsum(num_rows[active]), 
+                                     np.arange(2**22, num_rows[active].sum(), 2**22)
+                                    )
+        for chunk in np.split(active, chunk_ends):
+            if chunk.size == 0:
+                continue
+            chunk_rows = num_rows[chunk]
+            query = np.repeat(np.arange(chunk.size), chunk_rows)
+            offsets = np.arange(query.size) - np.repeat(np.cumsum(chunk_rows) 
+                                                       - chunk_rows, chunk_rows)
+            row = first_rows[chunk][query] + offsets
+            dy = row - points[chunk, 0][query]
+            dx_squared = squared_distances[chunk][query] - dy * dy
+            dx = _integer_sqrt(dx_squared)
+            on_circle = (dx * dx == dx_squared) & (row >= 0) & (row < self.shape[0])
+            
+            # Left pixel comes before right pixel on each row
+            query = np.repeat(query, 2)
+            row = np.repeat(row, 2)
+            on_circle = np.repeat(on_circle, 2)
+            col = (np.repeat(points[chunk, 1][query[::2]], 2) 
+                   + np.stack([-dx, dx], axis=1).ravel())
+            valid = on_circle & (col >= 0) & (col < self.shape[1])
+            valid[valid] = self._class_mask[row[valid], col[valid]]
+            
+            valid_inds = np.flatnonzero(valid)
+            # The known closest pixel is always valid so every point has one
+            found_query, first_valid = np.unique(query[valid_inds], 
+                                                 return_index=True)
+            first_valid = valid_inds[first_valid]
+            positions[chunk[found_query], 0] = row[first_valid]
+            positions[chunk[found_query], 1] = col[first_valid]
+        return positions
+
+
+def _integer_sqrt(values):
+    """ Floor of the square root of non-negative int array values."""
+    roots = np.floor(np.sqrt(np.maximum(values, 0))).astype(np.int64)
+    # Float square root can be off by one for large values
+    roots -= roots * roots > values
+    roots += (roots + 1) * (roots + 1) <= values
+    return roots
+
+
+@instrument
+def get_class_distance_field(mask, class_id, mask_hash=None):
+    """ Get (cached) ClassDistanceField for class_id in mask.
+    
+    Cached on the mask values (not the object) and class_id, so the mask 
+    is hashed on every call. Keeps the most recently used fields up to 
+    DISTANCE_FIELD_CACHE_BYTES total.
+    
+    Args:
+        mask: 2D numpy array
+        class_id: value of class of interest in mask
+        mask_hash: get_mask_hash(mask) if already known
+        
+    Return:
+        ClassDistanceField
+    """
+    if mask_hash is None:
+        mask_hash = get_mask_hash(mask)
+    key = (mask_hash, class_id)
+    field = _distance_field_cache.get(key)
+    if field is not None:
+        _distance_field_cache.move_to_end(key)
+        return field
+    
+    field = ClassDistanceField(mask, class_id)
+    _distance_field_cache[key] = field
+    cache_bytes = sum(f.nbytes for f in _distance_field_cache.values())
+    while cache_bytes > DISTANCE_FIELD_CACHE_BYTES and len(_distance_field_cache) > 1:
+        _, removed = _distance_field_cache.popitem(last=False)
+        cache_bytes -= removed.nbytes
+    return field
+
+def clear_distance_field_cache():
+    """ Remove all cached ClassDistanceField objects."""
+    _distance_field_cache.clear()
+
+@instrument
+def get_distance_to_class(point, mask, class_id, mask_hash=None, field=None):
     """ Return closest distance from point to class_id in mask and that postion.
     
+    Uses the cached distance transform from get_class_distance_field, so 
+    repeated queries on the same mask only pay for hashing the mask. To 
+    skip that too, build the field once and pass it (or use field.query
+    for many points at once).
+    
     Args:
         point: (i, j) numpy indexing (from top left: (row, column))
         mask: 2D numpy array
         class_id: value of class of interest in mask
+        mask_hash: get_mask_hash(mask) if already known
+        field: ClassDistanceField of class_id in mask (like from
+            get_class_distance_field) to use instead of the cache
     
     Return:
         distance value and position if exists, otherwise returns False, False
@@ -41,15 +296,15 @@ def get_distance_to_class(point, mask, class_id):
                            f"but has shape {point.shape} instead."
                           )
     
-    class_inds = np.argwhere(mask==class_id)
-    if class_inds.size > 0:
-        diffs = class_inds - point
-        distances = np.linalg.norm(diffs, axis=1)
-        closest_ind = np.argmin(distances)
-        return distances[closest_ind], class_inds[closest_ind]
+    if field is None:
+        field = get_class_distance_field(mask, class_id, mask_hash)
+    if field.has_class:
+        distances, positions = field.query(point[np.newaxis])
+        return distances[0], positions[0]
     
     return False, False
 
+@instrument
 def get_interior_mask(content_mask, wood_class=1):
     """Return mask of all space within the wood frame in mask of comb contents.
     
@@ -65,7 +320,8 @@ def get_interior_mask(content_mask, wood_class=1):
     cv2.drawContours(interior_mask, wood_contours, 1, 1, -1)
     return interior_mask
 
-def dilate_class(mask, class_id, kernel_size=5):
+@instrument
+def dilate_class(mask, class_id, kernel_size=5, out=None, scratch=None):
     """ Make blobs of class_id slightly larger with dialation.
     
     Sometimes there is a thin layer of false wood around the
@@ -74,13 +330,24 @@ def dilate_class(mask, class_id, kernel_size=5):
     mask: 2D numpy array
     class_id: value of class of interest in mask
     kernel_size: kernel size for dialation
+    out: array to write result to, can be mask to dilate in place
+    scratch: 2 x mask_height x mask_width uint8 array used for the class
+        mask and its dilation, so dilating many masks doesn't allocate them
+        each time. Created if None.
     
-    return copy of mask with dialation applied
+    return copy of mask (or out) with dialation applied
     """
     kernel = np.ones((kernel_size, kernel_size), np.uint8)
-    class_mask = np.where(mask==class_id, 1, 0)
-    class_mask = class_mask.astype(np.uint8)
-    dilation = cv2.dilate(class_mask, kernel, iterations=1)
-    dilated_mask = np.where(dilation, class_id, mask)
-    return dilated_mask
+    if scratch is None:
+        scratch = np.empty((2, *mask.shape), dtype=np.uint8)
+    class_mask, dilation = scratch[0], scratch[1]
+    # bool and uint8 have the same layout so cv2 can use the comparison directly
+    np.equal(mask, class_id, out=class_mask.view(bool))
+    cv2.dilate(class_mask, kernel, dst=dilation, iterations=1)
+    if out is None:
+        out = np.copy(mask)
+    elif out is not mask:
+        np.copyto(out, mask)
+    np.copyto(out, class_id, where=dilation.view(bool))
+    return out
     
\ No newline at end of file
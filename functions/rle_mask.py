@@ -0,0 +1,173 @@
+""" Run length encoded class masks that can be counted and merged without decoding."""
+
+import numpy as np
+
+
+class RLEMask:
+    """ 2D class mask stored as runs of equal values in row major order.
+
+    Comb and contents masks are mostly large areas of the same class, so
+    this is much smaller than the uint8 array. Class counts, areas, bounding
+    boxes, mirroring and a/b side merging work directly on the runs.
+
+    Attributes:
+        shape: (height, width) of the mask
+        starts: flat index where each run starts (first is always 0)
+        values: class value of each run
+    """
+
+    def __init__(self, shape, starts, values):
+        self.shape = tuple(int(size) for size in shape)
+        index_dtype = np.uint32 if np.prod(self.shape) < 2**32 else np.uint64
+        self.starts = np.asarray(starts).astype(index_dtype, copy=False)
+        self.values = np.asarray(values)
+
+    @classmethod
+    def from_array(cls, mask):
+        """ Encode 2D array."""
+        flat = np.ravel(mask)
+        if flat.size == 0:
+            return cls(mask.shape, np.zeros(0), flat)
+        changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+        starts = np.concatenate([[0], changes])
+        return cls(mask.shape, starts, flat[starts])
+
+    @classmethod
+    def load(cls, rle_file):
+        """ Load RLEMask saved with save."""
+        with np.load(rle_file) as data:
+            return cls(data['shape'], data['starts'], data['values'])
+
+    def save(self, rle_file):
+        """ Save as compressed .npz file."""
+        np.savez_compressed(rle_file, shape=np.array(self.shape),
+                            starts=self.starts, values=self.values)
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def lengths(self):
+        """ Number of pixels in each run."""
+        return np.diff(self.starts.astype(np.int64), append=self.size)
+
+    @property
+    def nbytes(self):
+        return self.starts.nbytes + self.values.nbytes
+
+    def __len__(self):
+        """ Number of runs."""
+        return self.values.size
+
+    def to_array(self):
+        """ Decode to 2D array."""
+        return np.repeat(self.values, self.lengths).reshape(self.shape)
+
+    def __array__(self, dtype=None, copy=None):
+        mask = self.to_array()
+        if dtype is not None:
+            mask = mask.astype(dtype)
+        return mask
+
+    def bincount(self, minlength=0):
+        """ Same as np.bincount(mask.ravel(), minlength=minlength)."""
+        counts = np.bincount(self.values, weights=self.lengths, minlength=minlength)
+        return counts.astype(np.int64)
+
+    def class_area(self, class_id):
+        """ Number of pixels with value class_id."""
+        return int(self.lengths[self.values == class_id].sum())
+
+    def bounding_box(self, class_id):
+        """ Smallest box containing all class_id pixels.
+
+        Return:
+            (min_row, max_row, min_col, max_col) inclusive, or None if no class_id
+        """
+        width = self.shape[1]
+        class_runs = np.flatnonzero(self.values == class_id)
+        if class_runs.size == 0:
+            return None
+        run_starts = self.starts[class_runs].astype(np.int64)
+        run_ends = run_starts + self.lengths[class_runs] - 1
+        start_rows = run_starts // width
+        end_rows = run_ends // width
+        # Runs that go over the end of a row cover the first and last column
+        one_row = start_rows == end_rows
+        min_col = np.where(one_row, run_starts % width, 0).min()
+        max_col = np.where(one_row, run_ends % width, width-1).max()
+        return int(start_rows.min()), int(end_rows.max()), int(min_col), int(max_col)
+
+    def _from_breakpoints(self, starts, values):
+        """ RLEMask from (possibly repeated) runs, merging neighbours with the same value."""
+        if values.size == 0:
+            return RLEMask(self.shape, starts, values)
+        keep = np.concatenate([[True], values[1:] != values[:-1]])
+        return RLEMask(self.shape, starts[keep], values[keep])
+
+    def _values_at(self, positions):
+        """ Values at sorted flat positions."""
+        runs = np.searchsorted(self.starts, positions, side='right') - 1
+        return self.values[runs]
+
+    def mirror_horizontal(self):
+        """ RLEMask of mask[:, ::-1]."""
+        width = self.shape[1]
+        run_starts = self.starts.astype(np.int64)
+        run_ends = run_starts + self.lengths
+        # Split runs where they cross from one row to the next
+        first_rows = run_starts // width
+        num_rows = (run_ends - 1) // width - first_rows + 1
+        segment_runs = np.repeat(np.arange(len(self)), num_rows)
+        segment_rows = (np.repeat(first_rows, num_rows)
+                        + np.arange(segment_runs.size)
+                        - np.repeat(np.cumsum(num_rows) - num_rows, num_rows))
+        row_starts = segment_rows * width
+        segment_ends = np.minimum(run_ends[segment_runs], row_starts + width)
+        # Segment that ended at column c now starts at column width - c
+        mirrored_starts = row_starts + width - (segment_ends - row_starts)
+        order = np.argsort(mirrored_starts, kind='stable')
+        return self._from_breakpoints(mirrored_starts[order],
+                                      self.values[segment_runs[order]])
+
+    def merge_ab(self, side_b, mirror_b=False, comb_class=2):
+        """ Merge this (side a) with side_b like comb_loading._combine_ab_mask.
+
+        Anything that isn't background in b replaces a, except comb in a
+        is always kept.
+
+        Args:
+            side_b: RLEMask of other side
+            mirror_b: should b be horizontally mirrored to match a's orientation
+            comb_class: value of comb in the masks
+
+        Return:
+            RLEMask
+        """
+        if self.shape != side_b.shape:
+            raise RuntimeError(f"side_a.shape {self.shape} "
+                               f"must match side_b.shape {side_b.shape}"
+                              )
+        if mirror_b:
+            side_b = side_b.mirror_horizontal()
+        breakpoints = np.union1d(self.starts, side_b.starts)
+        a_values = self._values_at(breakpoints)
+        b_values = side_b._values_at(breakpoints)
+        merged = np.where(b_values > 0, b_values, a_values)
+        merged = np.where(a_values == comb_class, a_values, merged)
+        return self._from_breakpoints(breakpoints, merged)
+
+    def __eq__(self, other):
+        if not isinstance(other, RLEMask):
+            return NotImplemented
+        return (self.shape == other.shape
+                and np.array_equal(self.starts, other.starts)
+                and np.array_equal(self.values, other.values))
+
+    def __repr__(self):
+        return f"RLEMask(shape={self.shape}, runs={len(self)})"
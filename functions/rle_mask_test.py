@@ -0,0 +1,111 @@
+""" Tests that RLEMask gives the same results as the dense masks.
+
+Run from the repository root with: python -m pytest functions/rle_mask_test.py
+"""
+
+import cv2
+import numpy as np
+import pandas as pd
+import pytest
+
+from comb_loading import _combine_ab_mask, load_colony_comb_frame
+from rle_mask import RLEMask
+
+
+def make_class_mask(rng, shape, num_classes=5, num_blobs=12):
+    """ Mask of rectangles of random classes on background, plus a few noisy
+    pixels so there are runs of length one and runs crossing rows."""
+    mask = np.zeros(shape, dtype=np.uint8)
+    for _ in range(num_blobs):
+        row, col = rng.integers(0, shape[0]), rng.integers(0, shape[1])
+        height, width = rng.integers(1, shape[0]+1), rng.integers(1, shape[1]+1)
+        mask[row:row+height, col:col+width] = rng.integers(0, num_classes)
+    noise = rng.random(shape) < 0.02
+    mask[noise] = rng.integers(0, num_classes, size=noise.sum())
+    return mask
+
+@pytest.fixture
+def masks():
+    rng = np.random.default_rng(0)
+    shapes = [(1, 1), (1, 9), (7, 1), (13, 17), (40, 31)]
+    return [make_class_mask(rng, shape) for shape in shapes]
+
+
+def test_round_trip(masks):
+    for mask in masks + [np.full((6, 4), 3, dtype=np.uint8)]:
+        rle = RLEMask.from_array(mask)
+        decoded = rle.to_array()
+        assert decoded.dtype == mask.dtype
+        np.testing.assert_array_equal(decoded, mask)
+        np.testing.assert_array_equal(np.asarray(rle), mask)
+
+def test_save_load(masks, tmp_path):
+    rle = RLEMask.from_array(masks[-1])
+    rle_file = tmp_path / "mask.npz"
+    rle.save(rle_file)
+    assert RLEMask.load(rle_file) == rle
+
+def test_reductions(masks):
+    for mask in masks:
+        rle = RLEMask.from_array(mask)
+        np.testing.assert_array_equal(rle.bincount(minlength=5),
+                                      np.bincount(mask.ravel(), minlength=5))
+        for class_id in range(5):
+            assert rle.class_area(class_id) == np.count_nonzero(mask == class_id)
+            rows, cols = np.nonzero(mask == class_id)
+            if rows.size == 0:
+                assert rle.bounding_box(class_id) is None
+            else:
+                assert rle.bounding_box(class_id) == (rows.min(), rows.max(),
+                                                      cols.min(), cols.max())
+
+def test_mirror_horizontal(masks):
+    for mask in masks:
+        mirrored = RLEMask.from_array(mask).mirror_horizontal()
+        np.testing.assert_array_equal(mirrored.to_array(), mask[:, ::-1])
+        # Neighbouring runs with the same value are merged like from_array
+        assert mirrored == RLEMask.from_array(mask[:, ::-1])
+
+@pytest.mark.parametrize("mirror_b", [False, True])
+def test_merge_ab_matches_combine_ab_mask(masks, mirror_b):
+    rng = np.random.default_rng(1)
+    for side_a in masks:
+        side_b = make_class_mask(rng, side_a.shape)
+        expected = _combine_ab_mask(side_a, side_b, mirror_b)
+        merged = RLEMask.from_array(side_a).merge_ab(RLEMask.from_array(side_b),
+                                                     mirror_b)
+        np.testing.assert_array_equal(merged.to_array(), expected)
+        assert merged == RLEMask.from_array(expected)
+
+def test_merge_ab_shape_mismatch():
+    side_a = RLEMask.from_array(np.zeros((3, 4), dtype=np.uint8))
+    side_b = RLEMask.from_array(np.zeros((4, 3), dtype=np.uint8))
+    with pytest.raises(RuntimeError):
+        side_a.merge_ab(side_b)
+
+@pytest.mark.parametrize("sides", [("a", "b"), ("a",), ("b",)])
+@pytest.mark.parametrize("mirror_b", [False, True])
+def test_load_colony_comb_frame_rle(tmp_path, masks, sides, mirror_b):
+    rng = np.random.default_rng(2)
+    date = 20210412
+    masks_folder = tmp_path / "AB1" / str(date) / "masks"
+    masks_folder.mkdir(parents=True)
+    rows = []
+    for side in sides:
+        filename = f"DSC_{side}.JPG"
+        cv2.imwrite(str(masks_folder / f"DSC_{side}.png"),
+                    make_class_mask(rng, masks[-1].shape))
+        rows.append({"colony": "AB1", "date": date, "beeframe": 1, "side": side,
+                     "filename": filename})
+    colony_df = pd.DataFrame(rows)
+
+    kwargs = dict(colony_df=colony_df, date=date, frame_num=1,
+                  folder_root=str(tmp_path), masks_folder_name="masks",
+                  combine_ab=True, mirror_b=mirror_b)
+    dense = load_colony_comb_frame(**kwargs)
+    rle = load_colony_comb_frame(**kwargs, rle=True)
+    assert isinstance(rle, RLEMask)
+    np.testing.assert_array_equal(rle.to_array(), dense)
+
+    kwargs["frame_num"] = 2
+    assert load_colony_comb_frame(**kwargs, rle=True) is None
@@ -0,0 +1,336 @@
+""" Sparse 3D model of the frames of a colony on one day."""
+
+import cv2
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def _union_find(num_nodes, nodes_a, nodes_b):
+    """ Root of every node after joining nodes_a[i] and nodes_b[i] for all i.
+
+    Roots always point to a lower index, so the forest can be built and
+    compressed with array operations instead of one union at a time.
+    """
+    parent = np.arange(num_nodes)
+    while True:
+        # Full path compression
+        grandparent = parent[parent]
+        while not np.array_equal(grandparent, parent):
+            parent = grandparent
+            grandparent = parent[parent]
+        root_a = parent[nodes_a]
+        root_b = parent[nodes_b]
+        differ = root_a != root_b
+        if not differ.any():
+            return parent
+        # Joining the roots joins everything under them
+        root_a = root_a[differ]
+        root_b = root_b[differ]
+        parent[np.maximum(root_a, root_b)] = np.minimum(root_a, root_b)
+
+
+class SparseVolume:
+    """ Frames of one day as runs of class pixels along each row.
+
+    Only the classes in class_ids are stored, everything else is empty
+    space. Frame f sits at depth f * frame_spacing, so a pixel is a
+    voxel of size frame_spacing x 1 x 1 (in mask pixels).
+
+    Runs are sorted by frame, row and start column.
+
+    Attributes:
+        shape: (num_frames, height, width)
+        frame_spacing: distance between neighbouring frames in mask pixels
+        class_ids: classes that are stored
+        frames: frame of each run
+        rows: row of each run
+        starts: first column of each run
+        ends: column after the last column of each run
+        values: class of each run
+    """
+
+    def __init__(self, shape, frame_spacing, class_ids, frames, rows, starts,
+                 ends, values):
+        self.shape = tuple(int(size) for size in shape)
+        self.frame_spacing = frame_spacing
+        self.class_ids = tuple(class_ids)
+        self.frames = np.asarray(frames).astype(np.min_scalar_type(self.shape[0]), copy=False)
+        self.rows = np.asarray(rows).astype(np.min_scalar_type(self.shape[1]), copy=False)
+        col_dtype = np.min_scalar_type(self.shape[2])
+        self.starts = np.asarray(starts).astype(col_dtype, copy=False)
+        self.ends = np.asarray(ends).astype(col_dtype, copy=False)
+        self.values = np.asarray(values)
+        # Boundary voxel KDTree for each class, see nearest
+        self._boundary_trees = {}
+
+    @classmethod
+    def from_frames(cls, frames, frame_spacing, class_ids):
+        """ Encode the frames of one day.
+
+        Frames are encoded one at a time so frames can be a LazyDay.
+
+        Args:
+            frames: FxHxW array (like colony[day])
+            frame_spacing: distance between neighbouring frames in mask pixels
+            class_ids: classes to store (like comb and contents classes)
+        """
+        frames_shape = None
+        run_frames, rows, starts, ends, values = [], [], [], [], []
+        for frame_ind, mask in enumerate(frames):
+            mask = np.asarray(mask)
+            frames_shape = mask.shape
+            kept = np.isin(mask, class_ids)
+            changes = mask[:, 1:] != mask[:, :-1]
+            is_start = kept.copy()
+            is_start[:, 1:] &= changes | ~kept[:, :-1]
+            is_end = kept.copy()
+            is_end[:, :-1] &= changes | ~kept[:, 1:]
+            # Every run has one start and one end and runs don't overlap,
+            # so the nth start and nth end (row major) are the same run
+            frame_rows, frame_starts = np.nonzero(is_start)
+            _, frame_ends = np.nonzero(is_end)
+            run_frames.append(np.full(frame_rows.size, frame_ind))
+            rows.append(frame_rows)
+            starts.append(frame_starts)
+            ends.append(frame_ends + 1)
+            values.append(mask[frame_rows, frame_starts])
+        if frames_shape is None:
+            raise RuntimeError("frames is empty.")
+        return cls((len(run_frames), *frames_shape), frame_spacing, class_ids,
+                   np.concatenate(run_frames), np.concatenate(rows),
+                   np.concatenate(starts), np.concatenate(ends),
+                   np.concatenate(values))
+
+    @property
+    def lengths(self):
+        """ Number of voxels in each run."""
+        return self.ends.astype(np.int64) - self.starts
+
+    @property
+    def nbytes(self):
+        return (self.frames.nbytes + self.rows.nbytes + self.starts.nbytes
+                + self.ends.nbytes + self.values.nbytes)
+
+    def __len__(self):
+        """ Number of runs."""
+        return self.values.size
+
+    def __repr__(self):
+        return f"SparseVolume(shape={self.shape}, runs={len(self)})"
+
+    def _row_keys(self):
+        """ Index of each run's (frame, row)."""
+        return self.frames.astype(np.int64) * self.shape[1] + self.rows
+
+    def _flat_positions(self, row_keys, cols):
+        # Gap of one between rows so run ends never reach the next row
+        return row_keys * (self.shape[2] + 1) + cols
+
+    def _get_run_pixels(self, runs):
+        """ Run index, row and column of every voxel in runs."""
+        lengths = self.lengths[runs]
+        run_inds = np.repeat(runs, lengths)
+        cols = (np.repeat(self.starts[runs].astype(np.int64), lengths)
+                + np.arange(run_inds.size)
+                - np.repeat(np.cumsum(lengths) - lengths, lengths))
+        return run_inds, self.rows[run_inds], cols
+
+    def get_frame(self, frame_ind, fill_value=0):
+        """ Decode one frame to 2D array (classes that aren't stored are fill_value)."""
+        frame = np.full(self.shape[1:], fill_value, dtype=self.values.dtype)
+        run_inds, rows, cols = self._get_run_pixels(np.flatnonzero(self.frames == frame_ind))
+        frame[rows, cols] = self.values[run_inds]
+        return frame
+
+    def get_class_mask(self, frame_ind, class_id):
+        """ 2D bool mask of class_id in one frame."""
+        class_mask = np.zeros(self.shape[1:], dtype=bool)
+        _, rows, cols = self._get_run_pixels(
+            np.flatnonzero((self.frames == frame_ind) & (self.values == class_id))
+        )
+        class_mask[rows, cols] = True
+        return class_mask
+
+    def to_array(self, fill_value=0):
+        """ Decode to FxHxW array."""
+        return np.stack([self.get_frame(frame_ind, fill_value)
+                         for frame_ind in range(self.shape[0])])
+
+    def get_values(self, points):
+        """ Class at each (frame, row, col) point.
+
+        Args:
+            points: n x 3 int array of (frame, row, col)
+
+        Return:
+            n array of class values (-1 where nothing is stored)
+        """
+        points = np.asarray(points, dtype=np.int64).reshape(-1, 3)
+        row_keys = points[:, 0] * self.shape[1] + points[:, 1]
+        positions = self._flat_positions(row_keys, points[:, 2])
+        run_keys = self._row_keys()
+        run_starts = self._flat_positions(run_keys, self.starts)
+        run_ends = self._flat_positions(run_keys, self.ends)
+        runs = np.searchsorted(run_starts, positions, side='right') - 1
+        inside = runs >= 0
+        inside[inside] = positions[inside] < run_ends[runs[inside]]
+        point_values = np.full(points.shape[0], -1, dtype=np.int64)
+        point_values[inside] = self.values[runs[inside]]
+        return point_values
+
+    def class_voxel_counts(self):
+        """ dict with number of voxels of each stored class."""
+        lengths = self.lengths
+        return {class_id: int(lengths[self.values == class_id].sum())
+                for class_id in self.class_ids}
+
+    def class_volumes(self):
+        """ dict with volume of each stored class in cubic mask pixels."""
+        return {class_id: count * self.frame_spacing
+                for class_id, count in self.class_voxel_counts().items()}
+
+    def _get_neighbour_runs(self, row_key_offset, valid):
+        """ Pairs of runs that touch runs row_key_offset (frame, row)s later.
+
+        Args:
+            row_key_offset: 1 for next row, shape[1] for next frame
+            valid: which runs have a neighbour (frame, row)
+
+        Return:
+            two arrays of run indices
+        """
+        run_keys = self._row_keys()
+        run_starts = self._flat_positions(run_keys, self.starts)
+        run_ends = self._flat_positions(run_keys, self.ends)
+        runs = np.flatnonzero(valid)
+        neighbour_keys = run_keys[runs] + row_key_offset
+        # Neighbour runs overlap when they start before this run ends
+        # and end after this run starts
+        first = np.searchsorted(run_ends, self._flat_positions(neighbour_keys,
+                                                                self.starts[runs]),
+                                side='right')
+        last = np.searchsorted(run_starts, self._flat_positions(neighbour_keys,
+                                                                 self.ends[runs]),
+                               side='left')
+        counts = np.maximum(last - first, 0)
+        runs_a = np.repeat(runs, counts)
+        runs_b = (np.repeat(first, counts) + np.arange(runs_a.size)
+                  - np.repeat(np.cumsum(counts) - counts, counts))
+        return runs_a, runs_b
+
+    def connected_components(self, class_ids=None):
+        """ 3D connected components of each class.
+
+        Voxels are connected to the 4 voxels next to them in their frame
+        and the voxels at the same position in the neighbouring frames.
+
+        Args:
+            class_ids: classes to label, if None all stored classes
+
+        Return:
+            labels: component of each run (-1 for runs not in class_ids)
+            num_components: number of components
+        """
+        if class_ids is None:
+            class_ids = self.class_ids
+        included = np.isin(self.values, class_ids)
+        next_row = self.rows.astype(np.int64) + 1 < self.shape[1]
+        next_frame = self.frames.astype(np.int64) + 1 < self.shape[0]
+        row_a, row_b = self._get_neighbour_runs(1, included & next_row)
+        frame_a, frame_b = self._get_neighbour_runs(self.shape[1],
+                                                    included & next_frame)
+        runs_a = np.concatenate([row_a, frame_a])
+        runs_b = np.concatenate([row_b, frame_b])
+        same_class = self.values[runs_a] == self.values[runs_b]
+        roots = _union_find(len(self), runs_a[same_class], runs_b[same_class])
+
+        labels = np.full(len(self), -1, dtype=np.int64)
+        components, labels[included] = np.unique(roots[included],
+                                                 return_inverse=True)
+        return labels, components.size
+
+    def component_voxel_counts(self, labels):
+        """ Number of voxels in each component from connected_components."""
+        included = labels >= 0
+        return np.bincount(labels[included],
+                           weights=self.lengths[included]).astype(np.int64)
+
+    def _get_boundary_tree(self, class_id):
+        """ KDTree and (frame, row, col) of class_id voxels with a non class_id voxel (or the
+        image edge) next to them in their frame, z scaled by frame_spacing."""
+        if class_id in self._boundary_trees:
+            return self._boundary_trees[class_id]
+        kernel = cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3))
+        boundary_points = []
+        for frame_ind in np.unique(self.frames[self.values == class_id]):
+            # bool and uint8 have the same layout so cv2 can use the comparison directly
+            class_mask = self.get_class_mask(frame_ind, class_id).view(np.uint8)
+            interior = cv2.erode(class_mask, kernel, borderType=cv2.BORDER_CONSTANT,
+                                 borderValue=0)
+            rows, cols = np.nonzero(class_mask > interior)
+            boundary_points.append(np.stack([np.full(rows.size, frame_ind),
+                                             rows, cols], axis=1))
+        tree = None
+        if boundary_points:
+            boundary_points = np.concatenate(boundary_points)
+            tree = (cKDTree(boundary_points * np.array([self.frame_spacing, 1, 1])),
+                    boundary_points)
+        self._boundary_trees[class_id] = tree
+        return tree
+
+    def nearest(self, points, class_id):
+        """ Closest class_id voxel to each point across all frames.
+
+        Distances count frame_spacing between frames. The closest voxel
+        is either right in front of/behind the point in another frame or
+        on the edge of class_id in its frame, so only edge voxels are
+        searched.
+
+        Args:
+            points: n x 3 array of (frame, row, col). Row and col are pixel
+                indices, frame can be fractional (between frames).
+            class_id: stored class to look for
+
+        Return:
+            distances: n float array (inf if class_id isn't stored)
+            voxels: n x 3 int array of (frame, row, col) (-1 if class_id isn't stored)
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        distances = np.full(points.shape[0], np.inf)
+        voxels = np.full(points.shape, -1, dtype=np.int64)
+        boundary_tree = self._get_boundary_tree(class_id)
+        if boundary_tree is None:
+            return distances, voxels
+        tree, boundary_voxels = boundary_tree
+        distances, inds = tree.query(points * np.array([self.frame_spacing, 1, 1]))
+        voxels = boundary_voxels[inds].astype(np.int64)
+
+        # Straight across to a frame that has class_id at the same position
+        pixels = points[:, 1:].astype(np.int64)
+        in_image = np.all((pixels >= 0) & (pixels < self.shape[1:]), axis=1)
+        for frame_ind in range(self.shape[0]):
+            frame_points = np.column_stack([np.full(points.shape[0], frame_ind),
+                                            pixels])
+            is_class = in_image.copy()
+            is_class[in_image] = self.get_values(frame_points[in_image]) == class_id
+            frame_distances = np.abs(points[:, 0] - frame_ind) * self.frame_spacing
+            closer = is_class & (frame_distances < distances)
+            distances[closer] = frame_distances[closer]
+            voxels[closer] = frame_points[closer]
+        return distances, voxels
+
+
+def get_colony_sparse_volumes(colony, frame_spacing, class_ids):
+    """ SparseVolume for every day of colony.
+
+    Args:
+        colony: DxFxHxW colony array (can be LazyColony, so only one frame
+            is dense at a time)
+        frame_spacing: distance between neighbouring frames in mask pixels
+        class_ids: classes to store
+
+    Return:
+        list of SparseVolume
+    """
+    return [SparseVolume.from_frames(day, frame_spacing, class_ids)
+            for day in colony]
@@ -0,0 +1,110 @@
+""" Tests that SparseVolume gives the same results as the dense volume.
+
+Run from the repository root with: python -m pytest functions/sparse_volume_test.py
+"""
+
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from sparse_volume import SparseVolume
+
+
+CLASS_IDS = (1, 2)
+
+
+def make_volume(seed, shape=(4, 20, 25), num_classes=4):
+    """ Random class volume: blobs that span frames plus noisy voxels."""
+    rng = np.random.default_rng(seed)
+    volume = np.zeros(shape, dtype=np.uint8)
+    for _ in range(6):
+        start = [rng.integers(0, size) for size in shape]
+        size = [rng.integers(1, size + 1) for size in shape]
+        volume[tuple(slice(first, first + length)
+                     for first, length in zip(start, size))] = rng.integers(num_classes)
+    noise = rng.random(shape) < 0.3
+    volume[noise] = rng.integers(0, num_classes, size=noise.sum())
+    return volume
+
+def get_voxel_labels(sparse, labels):
+    """ FxHxW array with the connected_components label of every voxel
+    (-1 for voxels that aren't labeled)."""
+    voxel_labels = np.full(sparse.shape, -1, dtype=np.int64)
+    run_inds, rows, cols = sparse._get_run_pixels(np.arange(len(sparse)))
+    voxel_labels[sparse.frames[run_inds], rows, cols] = labels[run_inds]
+    return voxel_labels
+
+@pytest.fixture(params=[0, 1, 2])
+def volume(request):
+    return make_volume(request.param)
+
+
+def test_round_trip(volume):
+    sparse = SparseVolume.from_frames(volume, 3.0, CLASS_IDS)
+    expected = np.where(np.isin(volume, CLASS_IDS), volume, 0)
+    np.testing.assert_array_equal(sparse.to_array(), expected)
+    points = np.stack(np.indices(volume.shape), axis=-1).reshape(-1, 3)
+    np.testing.assert_array_equal(sparse.get_values(points),
+                                  np.where(np.isin(volume, CLASS_IDS),
+                                           volume.astype(np.int64), -1).ravel())
+
+def test_connected_components_match_scipy(volume):
+    sparse = SparseVolume.from_frames(volume, 3.0, CLASS_IDS)
+    labels, num_components = sparse.connected_components()
+    voxel_labels = get_voxel_labels(sparse, labels)
+    voxel_counts = sparse.component_voxel_counts(labels)
+
+    # 4 neighbours in the frame and the same position in the next and last frame
+    structure = ndimage.generate_binary_structure(3, 1)
+    expected_components = 0
+    for class_id in CLASS_IDS:
+        is_class = volume == class_id
+        expected, num_expected = ndimage.label(is_class, structure=structure)
+        expected_components += num_expected
+        # Same partition of the class voxels, one label for one label
+        pairs = np.unique(np.stack([voxel_labels[is_class], expected[is_class]]),
+                          axis=1)
+        assert pairs.shape[1] == num_expected
+        assert np.unique(pairs[0]).size == num_expected
+        np.testing.assert_array_equal(np.sort(voxel_counts[pairs[0]]),
+                                      np.sort(np.bincount(expected.ravel())[1:]))
+    assert num_components == expected_components
+    assert np.all(voxel_labels[~np.isin(volume, CLASS_IDS)] == -1)
+
+def test_connected_components_subset(volume):
+    sparse = SparseVolume.from_frames(volume, 3.0, CLASS_IDS)
+    labels, num_components = sparse.connected_components(class_ids=[2])
+    _, expected = ndimage.label(volume == 2,
+                                structure=ndimage.generate_binary_structure(3, 1))
+    assert num_components == expected
+    assert np.all(labels[sparse.values != 2] == -1)
+
+@pytest.mark.parametrize("frame_spacing", [1.0, 4.5])
+def test_nearest_matches_brute_force(volume, frame_spacing):
+    sparse = SparseVolume.from_frames(volume, frame_spacing, CLASS_IDS)
+    rng = np.random.default_rng(3)
+    num_points = 200
+    # Fractional frames are between frames
+    points = np.column_stack([rng.uniform(0, volume.shape[0] - 1, num_points),
+                              rng.integers(0, volume.shape[1], num_points),
+                              rng.integers(0, volume.shape[2], num_points)])
+    points[:50, 0] = np.round(points[:50, 0])
+    scale = np.array([frame_spacing, 1, 1])
+    for class_id in CLASS_IDS:
+        class_voxels = np.argwhere(volume == class_id)
+        expected = np.linalg.norm((points[:, None] - class_voxels[None]) * scale,
+                                  axis=2).min(axis=1)
+        distances, voxels = sparse.nearest(points, class_id)
+        np.testing.assert_allclose(distances, expected)
+        # With ties any of the closest voxels is fine
+        assert np.all(volume[tuple(voxels.T)] == class_id)
+        np.testing.assert_allclose(np.linalg.norm((points - voxels) * scale, axis=1),
+                                   expected)
+
+def test_nearest_missing_class():
+    volume = make_volume(0)
+    volume[volume == 2] = 1
+    sparse = SparseVolume.from_frames(volume, 2.0, CLASS_IDS)
+    distances, voxels = sparse.nearest([[0, 1, 1], [1.5, 3, 4]], 2)
+    assert np.all(np.isinf(distances))
+    assert np.all(voxels == -1)